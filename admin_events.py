@@ -0,0 +1,133 @@
+import datetime
+import json
+from typing import Awaitable, Callable, List, Optional, Set
+
+from keycloak.exceptions import KeycloakError
+import tornado.ioloop
+
+from logger_factory import get_logger
+
+logger = get_logger(__name__)
+
+# only these admin events can change the users, groups and memberships of the user directory
+RESOURCE_TYPES = ["USER", "GROUP", "GROUP_MEMBERSHIP"]
+
+
+class AdminEventPoller:
+    """
+    polls keycloak's admin events and applies them to the user directory, so that changes of users and groups show up
+    within seconds without re-listing every group and member.
+    The cursor is the time of the newest applied event (keycloak doesn't give admin events an id in all versions,
+    so events that happened in the same millisecond are told apart by their content).
+    Requires "Save Events" for admin events to be enabled in the realm, the periodic full sync of the directory
+    remains as a fallback.
+    """
+
+    def __init__(self, user_directory, event_source: Callable[[dict], Awaitable[List[dict]]], interval: float = 10, page_size: int = 100):
+        """
+        :param user_directory: the UserDirectory the events are applied to
+        :param event_source: async function returning the admin events for the given query parameters, newest first
+                             (usually AsyncKeycloak.get_admin_events)
+        :param interval: seconds between two polls
+        :param page_size: number of events requested at once
+        """
+
+        self._user_directory = user_directory
+        self._event_source = event_source
+        self.interval = interval
+        self.page_size = page_size
+        self.cursor: Optional[int] = None  # time (ms) of the newest applied event
+        self._seen: Set[str] = set()  # events at exactly the cursor time that were already applied
+        self._periodic_poll: Optional[tornado.ioloop.PeriodicCallback] = None
+        self.applied = 0
+
+    @staticmethod
+    def _fingerprint(event: dict) -> str:
+        return event.get("id") or json.dumps(event, sort_keys=True)
+
+    def _is_new(self, event: dict) -> bool:
+        return self.cursor is None or event["time"] > self.cursor or (event["time"] == self.cursor and self._fingerprint(event) not in self._seen)
+
+    def _query(self, first: int, max_results: int) -> dict:
+        query = {"resourceTypes": RESOURCE_TYPES, "first": first, "max": max_results}
+        if self.cursor is not None:
+            # keycloak filters by day only, the exact filtering is done by the cursor
+            query["dateFrom"] = datetime.datetime.fromtimestamp(self.cursor / 1000, tz=datetime.timezone.utc).strftime("%Y-%m-%d")
+        return query
+
+    async def init_cursor(self) -> None:
+        """
+        start at the newest existing event. Call this before the initial full sync of the directory,
+        so that no change between the sync and the first poll gets lost
+        """
+
+        events = await self._event_source(self._query(0, 1))
+        self._advance(events)
+        if self.cursor is None:
+            self.cursor = 0
+
+    def _advance(self, events: List[dict]) -> None:
+        """
+        move the cursor to the newest of the events
+        """
+
+        if not events:
+            return
+        newest = max(event["time"] for event in events)
+        if newest != self.cursor:
+            self._seen = set()
+        self.cursor = newest
+        self._seen.update(self._fingerprint(event) for event in events if event["time"] == newest)
+
+    async def poll(self) -> int:
+        """
+        fetch all events since the cursor and apply them to the directory.
+        The cursor is only moved once the events were applied, so failed polls are retried completely
+
+        :return: the number of applied events
+        """
+
+        if self.cursor is None:
+            await self.init_cursor()
+            return 0
+
+        events = []
+        first = 0
+        while True:
+            page = await self._event_source(self._query(first, self.page_size))
+            new_events = [event for event in page if self._is_new(event)]
+            events.extend(new_events)
+            # newest first, so we are done as soon as we reach events we know
+            if len(page) < self.page_size or len(new_events) < len(page):
+                break
+            first += self.page_size
+
+        if not events:
+            return 0
+
+        events.sort(key=lambda event: event["time"])
+        await self._user_directory.apply_events(events)
+        self._advance(events)
+        self.applied += len(events)
+        return len(events)
+
+    async def _periodic(self) -> None:
+        try:
+            await self.poll()
+        except KeycloakError as e:
+            # the next poll tries again from the same cursor
+            logger.info("Keycloak Error occured while trying to poll admin events: {}".format(e))
+
+    def start(self) -> None:
+        if self._periodic_poll is None:
+            self._periodic_poll = tornado.ioloop.PeriodicCallback(self._periodic, self.interval * 1000)
+            self._periodic_poll.start()
+
+    def stop(self) -> None:
+        if self._periodic_poll is not None:
+            self._periodic_poll.stop()
+            self._periodic_poll = None
+
+    def stats(self) -> dict:
+        return {"cursor": self.cursor,
+                "applied": self.applied}
@@ -0,0 +1,75 @@
+import time
+
+from keycloak.exceptions import KeycloakError
+import tornado.ioloop
+
+from logger_factory import get_logger
+from single_flight import SingleFlight
+
+logger = get_logger(__name__)
+
+
+class AdminTokenManager:
+    """
+    owns the token of the KeycloakAdmin client and refreshes it proactively in the background before it expires,
+    so that requests to the admin API never have to pay for a token refresh themselves.
+    All callers share the current token, concurrent refreshes (e.g. after a 401) are coalesced into one.
+    """
+
+    def __init__(self, async_keycloak, refresh_margin: float = 30, check_interval: float = 5):
+        """
+        :param async_keycloak: the AsyncKeycloak facade whose admin client's token is managed
+        :param refresh_margin: seconds before the expiry of the admin token in which it gets refreshed
+        :param check_interval: seconds between two checks if the token needs to be refreshed
+        """
+
+        self._async_keycloak = async_keycloak
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self._single_flight = SingleFlight()
+        self._obtained_at = time.time()  # KeycloakAdmin requests its first token on construction
+        self._periodic_check = None
+        self.refreshes = 0
+
+    @property
+    def expires_at(self) -> float:
+        token = getattr(self._async_keycloak.keycloak_admin, "token", None) or {}
+        return self._obtained_at + token.get("expires_in", 60)
+
+    def needs_refresh(self) -> bool:
+        return time.time() >= self.expires_at - self.refresh_margin
+
+    async def refresh(self) -> None:
+        """
+        refresh the admin token now (coalesced with a refresh that is already in flight)
+        """
+
+        await self._single_flight.do("admin_token", self._refresh)
+
+    async def _refresh(self) -> None:
+        await self._async_keycloak.run(self._async_keycloak.keycloak_admin.refresh_token)
+        self._obtained_at = time.time()
+        self.refreshes += 1
+
+    async def _check(self) -> None:
+        if not self.needs_refresh():
+            return
+        try:
+            await self.refresh()
+        except KeycloakError as e:
+            # the next check (or a 401 on a request) tries again
+            logger.info("Keycloak Error occured while trying to refresh the admin token: {}".format(e))
+
+    def start(self) -> None:
+        if self._periodic_check is None:
+            self._periodic_check = tornado.ioloop.PeriodicCallback(self._check, self.check_interval * 1000)
+            self._periodic_check.start()
+
+    def stop(self) -> None:
+        if self._periodic_check is not None:
+            self._periodic_check.stop()
+            self._periodic_check = None
+
+    def stats(self) -> dict:
+        return {"expires_in": max(0, int(self.expires_at - time.time())),
+                "refreshes": self.refreshes}
@@ -1,15 +1,42 @@
+import asyncio
+import base64
 import json
 import os
-
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from jose import jwt
+import nacl.encoding
+import nacl.public
+import nacl.signing
 from keycloak import KeycloakAdmin, KeycloakOpenID
+from keycloak.exceptions import KeycloakConnectionError, KeycloakGetError
 from tornado import gen
 from tornado.ioloop import IOLoop
 from tornado.options import options
-from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+import tornado.locks
 import tornado.websocket
 
+from admin_events import AdminEventPoller
+from async_keycloak import AsyncKeycloak
+from circuit_breaker import CircuitBreaker, CircuitOpenError
 import global_vars
+from handlers.base_handler import BaseHandler, needs_refresh, stamp_token
+from handlers.module_communication_handlers import WebsocketHandler, invalidate_cached_permissions, lookup_user
 from main import make_app
+import message_codec
+from session_auth import SESSION_PUBLIC_KEY_HEADER, derive_session_key, session_mac, session_transcript
+from session_store import SessionStore, SQLiteSessionStore
+from single_flight import SingleFlight
+from token_validation import TokenValidator
+from ttl_cache import TTLCache
+from user_directory import UserDirectory
+from verification_pool import VerificationPool
+from verify_key_store import VerifyKeyStore
 
 MESSAGE_FORMAT_ERROR = "message_format_error"
 KEYCLOAK_ERROR = "keycloak_error"
@@ -30,7 +57,9 @@ def setup():
     global_vars.keycloak = KeycloakOpenID(config["keycloak_base_url"], realm_name=config["keycloak_realm"], client_id=config["keycloak_client_id"],
                                           client_secret_key=config["keycloak_client_secret"])
     global_vars.keycloak_admin = KeycloakAdmin(config["keycloak_base_url"], realm_name=config["keycloak_realm"], username=config["keycloak_admin_username"],
-                                               password=config["keycloak_admin_password"], verify=True, auto_refresh_token=['get', 'put', 'post', 'delete'])
+                                               password=config["keycloak_admin_password"], verify=True)
+    global_vars.async_keycloak = AsyncKeycloak(global_vars.keycloak, global_vars.keycloak_admin)
+    global_vars.user_directory = UserDirectory(global_vars.async_keycloak)
     global_vars.keycloak_callback_url = config["keycloak_callback_url"]
     global_vars.config_path = options.config
     global_vars.domain = config["domain"]
@@ -69,6 +98,25 @@ class ApiTest(AsyncHTTPTestCase):
         response = self.fetch("/main", follow_redirects=False)
         self.assertEqual(response.code, 302)
 
+    def test_health_check(self):
+        """
+        expect: 200 response, reporting the state of the keycloak circuit breaker
+        """
+        global_vars.token_cache = TTLCache(maxsize=10, ttl=60)
+        global_vars.token_cache.get("unittest")
+        try:
+            response = self.fetch("/health")
+        finally:
+            global_vars.token_cache = None
+        self.assertEqual(response.code, 200)
+
+        content = json.loads(response.body)
+        self.assertIn("keycloak", content)
+        self.assertEqual(content["keycloak"]["circuit_breaker"]["state"], CircuitBreaker.CLOSED)
+        # hits and misses of the caches of validated sessions
+        self.assertEqual(content["token_cache"]["misses"], 1)
+        self.assertIn("stale_session_cache", content)
+
     def test_main_handler_success(self):
         """
         expect: 200 response, containing a string, with an opening html tag (easy assertion that content is actual html)
@@ -79,6 +127,767 @@ class ApiTest(AsyncHTTPTestCase):
         self.assertIsInstance(content, str)
         self.assertIn("<html", content)
 
+    def test_login_callback_keycloak_unavailable(self):
+        """
+        expect: 503 response with Retry-After, if keycloak can't be reached to exchange the code
+        """
+        global_vars.async_keycloak.circuit_breaker._open()
+
+        response = self.fetch("/login/callback?code=abc", follow_redirects=False)
+        self.assertEqual(response.code, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(json.loads(response.body)["reason"], "keycloak_unavailable")
+
+    def test_user_list_refresh_keycloak_unavailable(self):
+        """
+        expect: 503 response with Retry-After, if the user directory can't be synced with keycloak
+        """
+        global_vars.async_keycloak.circuit_breaker._open()
+
+        response = self.fetch("/users?refresh=true")
+        self.assertEqual(response.code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+
+class TokenValidatorTest(AsyncTestCase):
+
+    class LocalJWKS:
+        """
+        stand-in for KeycloakOpenID that only serves a symmetric JWKS, so that no keycloak is needed to sign test tokens
+        """
+
+        def __init__(self):
+            self.secret = base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=").decode()
+            self.calls = 0
+
+        def certs(self):
+            self.calls += 1
+            return {"keys": [{"kid": "test_kid", "kty": "oct", "alg": "HS256", "use": "sig", "k": self.secret}]}
+
+        def sign(self, claims: dict, kid: str = "test_kid") -> str:
+            return jwt.encode(claims, {"kty": "oct", "k": self.secret}, algorithm="HS256", headers={"kid": kid})
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.jwks = self.LocalJWKS()
+        self.validator = TokenValidator(AsyncKeycloak(self.jwks, None))
+        self.io_loop.run_sync(self.validator.load_keys)
+        self.claims = {"sub": "aaaaaaaa-bbbb-0000-cccc-dddddddddddd", "typ": "Bearer", "exp": int(time.time()) + 300,
+                       "preferred_username": TEST_USER.NAME, "resource_access": {"test": {"roles": ["user"]}}}
+
+    def test_validate_success(self):
+        userinfo = self.validator.validate(self.jwks.sign(self.claims))
+
+        # expect the same shape as the introspection result
+        self.assertIsNotNone(userinfo)
+        self.assertEqual(userinfo["sub"], self.claims["sub"])
+        self.assertEqual(userinfo["resource_access"], self.claims["resource_access"])
+        self.assertEqual(userinfo["username"], TEST_USER.NAME)
+        self.assertTrue(userinfo["active"])
+
+    def test_validate_error_expired(self):
+        self.claims["exp"] = int(time.time()) - 10
+        self.assertIsNone(self.validator.validate(self.jwks.sign(self.claims)))
+
+    def test_validate_error_unknown_kid(self):
+        # unknown key ids cannot be validated locally, caller has to fall back to introspection
+        self.assertIsNone(self.validator.validate(self.jwks.sign(self.claims, kid="rotated_kid")))
+
+    def test_validate_error_not_access_token(self):
+        self.claims["typ"] = "ID"
+        self.assertIsNone(self.validator.validate(self.jwks.sign(self.claims)))
+
+    @gen_test
+    def test_refresh_keys_through_circuit_breaker(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1)
+        validator = TokenValidator(AsyncKeycloak(self.jwks, None, circuit_breaker=circuit_breaker))
+        circuit_breaker.allow()
+        circuit_breaker.record_failure()
+
+        # while keycloak is considered unavailable, the JWKS isn't fetched (and the error is only logged)
+        calls = self.jwks.calls
+        yield validator.refresh_keys()
+        self.assertEqual(self.jwks.calls, calls)
+        self.assertEqual(validator.key_ids, [])
+
+
+class TTLCacheTest(AsyncTestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_expiry(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # touch a, so that b is the least recently used entry
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_invalidate_where(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", {"preferred_username": TEST_USER.NAME})
+        cache.set("b", {"preferred_username": "someone_else"})
+
+        removed = cache.invalidate_where(lambda key, value: value["preferred_username"] == TEST_USER.NAME)
+        self.assertEqual(removed, 1)
+        self.assertNotIn("a", cache)
+        self.assertIn("b", cache)
+
+
+class AsyncKeycloakTest(AsyncTestCase):
+
+    @gen_test
+    def test_run_success(self):
+        async_keycloak = AsyncKeycloak(None, None, max_workers=1)
+        result = yield async_keycloak.run(lambda a, b: a + b, 1, b=2)
+        self.assertEqual(result, 3)
+
+    @gen_test
+    def test_run_error_timeout(self):
+        # a hanging keycloak call has to surface as a keycloak error instead of blocking forever
+        async_keycloak = AsyncKeycloak(None, None, max_workers=1, timeout=0.05)
+        with self.assertRaises(KeycloakConnectionError):
+            yield async_keycloak.run(time.sleep, 0.5)
+
+    @gen_test
+    def test_run_queue_time_is_not_latency(self):
+        # healthy calls that only wait for a free worker must not open the circuit
+        circuit_breaker = CircuitBreaker(minimum_calls=1, latency_budget=0.2)
+        async_keycloak = AsyncKeycloak(None, None, max_workers=1, circuit_breaker=circuit_breaker)
+        yield [async_keycloak.run(time.sleep, 0.05) for _ in range(10)]
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(circuit_breaker.stats()["failures_in_window"], 0)
+
+    @gen_test
+    def test_run_queue_timeout_is_not_a_failure(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1)
+        async_keycloak = AsyncKeycloak(None, None, max_workers=1, circuit_breaker=circuit_breaker)
+        blocking = asyncio.ensure_future(async_keycloak.run(time.sleep, 0.2))
+        yield gen.moment
+        with self.assertRaises(KeycloakConnectionError):
+            yield async_keycloak.run(time.sleep, 0, timeout=0.05)
+        yield blocking
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(circuit_breaker.stats()["failures_in_window"], 0)
+
+
+class CircuitBreakerTest(AsyncTestCase):
+
+    def test_opens_on_failure_rate(self):
+        circuit_breaker = CircuitBreaker(failure_rate_threshold=0.5, minimum_calls=4)
+        for _ in range(2):
+            self.assertTrue(circuit_breaker.allow())
+            circuit_breaker.record_success(0.01)
+        for _ in range(2):
+            self.assertTrue(circuit_breaker.allow())
+            circuit_breaker.record_failure()
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(circuit_breaker.allow())
+
+    def test_latency_budget(self):
+        # slow answers count as failures as well
+        circuit_breaker = CircuitBreaker(minimum_calls=1, latency_budget=0.5)
+        circuit_breaker.allow()
+        circuit_breaker.record_success(1)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_probe(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1, open_duration=0)
+        circuit_breaker.allow()
+        circuit_breaker.record_failure()
+
+        # after the open duration, exactly one probe is let through
+        self.assertTrue(circuit_breaker.allow())
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(circuit_breaker.allow())
+
+        circuit_breaker.record_success(0.01)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failures_while_open_are_ignored(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1)
+        circuit_breaker.allow()
+        circuit_breaker.record_failure()
+        opened_at = circuit_breaker._opened_at
+
+        # late failures of calls that were in flight when the circuit opened
+        circuit_breaker.record_failure()
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.times_opened, 1)
+        self.assertEqual(circuit_breaker._opened_at, opened_at)
+
+    def test_release_only_resets_the_probe(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1, open_duration=0)
+        circuit_breaker.allow()
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+
+        # a cancelled call that isn't the probe doesn't let another probe through
+        circuit_breaker.release(probe=False)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(circuit_breaker.allow())
+
+        circuit_breaker.release(probe=True)
+        self.assertTrue(circuit_breaker.allow())
+
+    @gen_test
+    def test_open_circuit_rejects_calls(self):
+        circuit_breaker = CircuitBreaker(minimum_calls=1)
+        async_keycloak = AsyncKeycloak(None, None, max_workers=1, circuit_breaker=circuit_breaker)
+        circuit_breaker.allow()
+        circuit_breaker.record_failure()
+
+        # rejected immediately, but still a keycloak connection error for the callers
+        with self.assertRaises(CircuitOpenError):
+            yield async_keycloak.run(time.sleep, 0.5)
+        self.assertTrue(issubclass(CircuitOpenError, KeycloakConnectionError))
+
+
+class SingleFlightTest(AsyncTestCase):
+
+    @gen_test
+    def test_concurrent_calls_coalesced(self):
+        single_flight = SingleFlight()
+        executions = []
+
+        async def call():
+            executions.append(1)
+            await gen.sleep(0.01)
+            return {"access_token": "abcdefg"}
+
+        results = yield [single_flight.do("session", call) for _ in range(5)]
+
+        # only one call went out, but every caller got its result
+        self.assertEqual(len(executions), 1)
+        self.assertTrue(all(result == {"access_token": "abcdefg"} for result in results))
+        self.assertEqual(single_flight.stats()["coalesced"], 4)
+        self.assertEqual(len(single_flight), 0)
+
+        # once finished, the next call is executed again
+        yield single_flight.do("session", call)
+        self.assertEqual(len(executions), 2)
+
+    @gen_test
+    def test_exception_shared(self):
+        single_flight = SingleFlight()
+
+        async def call():
+            await gen.sleep(0.01)
+            raise KeycloakConnectionError("unreachable")
+
+        first = single_flight.do("session", call)
+        second = single_flight.do("session", call)
+        for future in (first, second):
+            with self.assertRaises(KeycloakConnectionError):
+                yield future
+
+
+class TokenRefreshTest(AsyncTestCase):
+
+    def test_fresh_token_no_refresh(self):
+        token = stamp_token({"access_token": "abcdefg", "refresh_token": "hijklmn", "expires_in": 3600})
+        self.assertEqual(token["expires_at"] - token["issued_at"], 3600)
+        self.assertFalse(needs_refresh(token))
+
+    def test_token_in_refresh_window(self):
+        # expires sooner than the refresh window
+        token = stamp_token({"access_token": "abcdefg", "refresh_token": "hijklmn", "expires_in": global_vars.token_refresh_window - 1})
+        self.assertTrue(needs_refresh(token))
+
+    def test_unstamped_token_refresh(self):
+        self.assertTrue(needs_refresh({"access_token": "abcdefg", "refresh_token": "hijklmn", "expires_in": 3600}))
+
+
+class SessionStoreTest(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.token = stamp_token({"access_token": "abcdefg", "refresh_token": "hijklmn", "expires_in": 300, "refresh_expires_in": 1800})
+
+    def test_create_get_delete(self):
+        store = SessionStore()
+        session_id = store.create(self.token)
+
+        self.assertEqual(store.get(session_id)["token"], self.token)
+        store.delete(session_id)
+        self.assertIsNone(store.get(session_id))
+
+    def test_expiry(self):
+        store = SessionStore()
+        self.token["refresh_expires_at"] = time.time() - 1
+        session_id = store.create(self.token)
+
+        self.assertIsNone(store.get(session_id))
+        self.assertEqual(len(store), 0)
+
+    def test_size_bound(self):
+        store = SessionStore(maxsize=2)
+        first = store.create(self.token)
+        second = store.create(self.token)
+        third = store.create(self.token)
+
+        # the least recently used session is evicted
+        self.assertIsNone(store.get(first))
+        self.assertIsNotNone(store.get(second))
+        self.assertIsNotNone(store.get(third))
+
+    def test_sqlite_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sessions.db")
+            store = SQLiteSessionStore(path)
+            session_id = store.create(self.token)
+            deleted_id = store.create(self.token)
+            store.delete(deleted_id)
+            store.close()
+
+            # sessions survive a restart of the platform
+            store = SQLiteSessionStore(path)
+            self.assertEqual(store.get(session_id)["token"], self.token)
+            self.assertIsNone(store.get(deleted_id))
+            store.close()
+
+    def test_sqlite_writes_off_the_ioloop(self):
+        class RecordingStore(SQLiteSessionStore):
+            threads = []
+
+            def _write(self, statement, parameters):
+                self.threads.append(threading.current_thread())
+                super()._write(statement, parameters)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = RecordingStore(os.path.join(directory, "sessions.db"))
+            store.delete(store.create(self.token))
+            store.close()
+
+        self.assertEqual(len(RecordingStore.threads), 2)
+        self.assertNotIn(threading.current_thread(), RecordingStore.threads)
+
+    def test_userinfo_stored_without_token_cache(self):
+        store = SessionStore(userinfo_ttl=60)
+        session_id = store.create(self.token)
+        userinfo = {"sub": "aaaaaaaa-bbbb-0000-cccc-dddddddddddd", "active": True}
+
+        # token_cache_size: 0 disables the token cache, but sessions still remember their last validation
+        global_vars.token_cache = None
+        global_vars.session_store = store
+        try:
+            handler = BaseHandler.__new__(BaseHandler)
+            handler._session_id = session_id
+            handler._cache_validation(userinfo, self.token)
+            self.assertEqual(handler._get_cached_validation(), (userinfo, self.token))
+            self.assertEqual(handler._get_stale_validation(), (userinfo, self.token))
+        finally:
+            global_vars.session_store = None
+        self.assertAlmostEqual(store.get(session_id)["validated_until"], time.time() + 60, delta=1)
+
+
+class AdminTokenManagerTest(AsyncTestCase):
+
+    class LocalAdmin:
+        """
+        stand-in for KeycloakAdmin that rejects the first request with a 401 and counts token refreshes
+        """
+
+        def __init__(self, expires_in: int = 60):
+            self.token = {"access_token": "abcdefg", "expires_in": expires_in}
+            self.refreshes = 0
+            self.rejected = False
+
+        def refresh_token(self):
+            self.refreshes += 1
+
+        def get_groups(self):
+            if not self.rejected:
+                self.rejected = True
+                raise KeycloakGetError("401: unauthorized", response_code=401)
+            return [{"id": "1", "name": TEST_USER.ROLE}]
+
+    @gen_test
+    def test_retry_once_on_401(self):
+        admin = self.LocalAdmin()
+        async_keycloak = AsyncKeycloak(None, admin, max_workers=1)
+
+        groups = yield async_keycloak.get_groups()
+        self.assertEqual(groups[0]["name"], TEST_USER.ROLE)
+        self.assertEqual(admin.refreshes, 1)
+
+    @gen_test
+    def test_proactive_refresh(self):
+        # token expires within the refresh margin --> the background check refreshes it
+        admin = self.LocalAdmin(expires_in=10)
+        async_keycloak = AsyncKeycloak(None, admin, max_workers=1)
+        self.assertTrue(async_keycloak.admin_token_manager.needs_refresh())
+
+        yield async_keycloak.admin_token_manager._check()
+        self.assertEqual(admin.refreshes, 1)
+
+
+class UserDirectoryTest(AsyncTestCase):
+
+    class LocalAdmin:
+        """
+        stand-in for KeycloakAdmin with a single group, counting the requests to the admin API
+        """
+
+        def __init__(self):
+            self.token = {"access_token": "abcdefg", "expires_in": 60}
+            self.groups = [{"id": "g1", "name": TEST_USER.ROLE}]
+            self.members = {"g1": [{"id": "u1", "username": TEST_USER.NAME, "email": TEST_USER.EMAIL}]}
+            self.deleted = set()
+            self.calls = 0
+
+        def get_groups(self):
+            self.calls += 1
+            return self.groups
+
+        def get_group_members(self, group_id):
+            self.calls += 1
+            if group_id not in self.members:
+                raise KeycloakGetError("500: group unavailable", response_code=500)
+            return self.members[group_id]
+
+        def get_user_id(self, username):
+            self.calls += 1
+            return "u2" if username == "new_user" else None
+
+        def get_user(self, user_id):
+            self.calls += 1
+            if user_id in self.deleted:
+                raise KeycloakGetError("404: user not found", response_code=404)
+            return {"id": user_id, "username": "new_user", "email": "new@mail.de"}
+
+        def get_group(self, group_id):
+            self.calls += 1
+            for group in self.groups:
+                if group["id"] == group_id:
+                    return group
+            raise KeycloakGetError("404: group not found", response_code=404)
+
+        def get_user_groups(self, user_id):
+            self.calls += 1
+            return self.groups
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.admin = self.LocalAdmin()
+        self.directory = UserDirectory(AsyncKeycloak(None, self.admin, max_workers=1))
+
+    @gen_test
+    def test_lookup_from_memory(self):
+        self.assertIsNone(self.directory.staleness)
+        yield self.directory.sync()
+        calls = self.admin.calls
+
+        user = yield self.directory.lookup(TEST_USER.NAME)
+        self.assertEqual(user, {"id": "u1", "email": TEST_USER.EMAIL, "username": TEST_USER.NAME, "role": TEST_USER.ROLE})
+        self.assertEqual(self.directory.list_users(), ({TEST_USER.NAME: user}, None))
+        self.assertEqual(self.admin.calls, calls)
+        self.assertIsNotNone(self.directory.staleness)
+
+    @gen_test
+    def test_lookup_unknown_user(self):
+        yield self.directory.sync()
+
+        # users created after the sync are fetched from keycloak once, users that don't exist are None
+        user = yield self.directory.lookup("new_user")
+        self.assertEqual(user["role"], TEST_USER.ROLE)
+        self.assertIsNotNone(self.directory.get_user("new_user"))
+        self.assertIsNone((yield self.directory.lookup("nobody")))
+
+    @gen_test
+    def test_sync_replaces_directory(self):
+        yield self.directory.sync()
+        self.admin.members["g1"] = []
+        yield self.directory.sync()
+
+        self.assertIsNone(self.directory.get_user(TEST_USER.NAME))
+        self.assertEqual(self.directory.stats()["syncs"], 2)
+
+    @gen_test
+    def test_sync_notifies_changed_users(self):
+        self.admin.members["g1"].append({"id": "u0", "username": "another_user", "email": "another@unittest.com"})
+        yield self.directory.sync()
+        changed_users = []
+        self.directory.add_listener(changed_users.append)
+
+        # nothing changed
+        yield self.directory.sync()
+        self.assertEqual(changed_users, [])
+
+        # the role of u1 changed, the cached permissions of the other user stay valid
+        self.admin.groups = self.admin.groups + [{"id": "g2", "name": "admin"}]
+        self.admin.members = {"g1": [self.admin.members["g1"][1]], "g2": [self.admin.members["g1"][0]]}
+        yield self.directory.sync()
+        self.assertEqual(changed_users, ["u1"])
+
+    @gen_test
+    def test_sync_partial_failure(self):
+        yield self.directory.sync()
+        # members of g1 cannot be fetched anymore, the sync still succeeds and keeps the known members of g1
+        self.admin.groups = self.admin.groups + [{"id": "g2", "name": "admin"}]
+        self.admin.members = {"g2": []}
+        yield self.directory.sync()
+
+        self.assertEqual(self.directory.failed_groups, [TEST_USER.ROLE])
+        self.assertIsNotNone(self.directory.get_user(TEST_USER.NAME))
+
+    @gen_test
+    def test_page(self):
+        self.admin.members["g1"].append({"id": "u0", "username": "another_user", "email": "another@unittest.com"})
+        yield self.directory.sync()
+        etag = self.directory.etag
+
+        # pages are ordered by username, the cursor of the last page is None
+        users, cursor = self.directory.list_users(limit=1)
+        self.assertEqual(list(users), ["another_user"])
+        users, cursor = self.directory.list_users(cursor, limit=1)
+        self.assertEqual(list(users), [TEST_USER.NAME])
+        self.assertIsNone(cursor)
+
+        # the etag only changes if the content does
+        yield self.directory.sync()
+        self.assertEqual(self.directory.etag, etag)
+        self.admin.members["g1"].pop()
+        yield self.directory.sync()
+        self.assertNotEqual(self.directory.etag, etag)
+
+
+class VerifyKeyStoreTest(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "verify_keys.json")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def write_keys(self, verify_keys: dict) -> None:
+        with open(self.path, "w") as fp:
+            json.dump(verify_keys, fp)
+
+    @staticmethod
+    def new_key() -> str:
+        return nacl.signing.SigningKey.generate().verify_key.encode(nacl.encoding.Base64Encoder).decode("utf8")
+
+    def test_verify_key_store_cached(self):
+        key = self.new_key()
+        self.write_keys({"module1": key})
+        store = VerifyKeyStore(self.path)
+
+        self.assertEqual(store.get("module1").encode(nacl.encoding.Base64Encoder).decode("utf8"), key)
+        self.assertIsNone(store.get("module2"))
+        # the file is only read once
+        self.assertIs(store.get("module1"), store.get("module1"))
+        self.assertEqual(store.reloads, 1)
+
+    def test_verify_key_store_reload_on_change(self):
+        self.write_keys({"module1": self.new_key()})
+        store = VerifyKeyStore(self.path)
+        self.assertIsNone(store.get("module2"))
+
+        store.check_for_changes()
+        self.assertEqual(store.reloads, 1)
+
+        self.write_keys({"module1": self.new_key(), "module2": self.new_key()})
+        # make sure the change is visible, even with a coarse mtime resolution
+        os.utime(self.path, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+        store.check_for_changes()
+        self.assertIsNotNone(store.get("module2"))
+        self.assertEqual(store.reloads, 2)
+
+    def test_verify_key_store_keeps_keys_on_invalid_file(self):
+        self.write_keys({"module1": self.new_key()})
+        store = VerifyKeyStore(self.path)
+        store.get("module1")
+
+        with open(self.path, "w") as fp:
+            fp.write("{ not json")
+        self.assertFalse(store.reload())
+        self.assertIsNotNone(store.get("module1"))
+
+        self.write_keys({"module1": "not a key"})
+        self.assertFalse(store.reload())
+        self.assertIsNotNone(store.get("module1"))
+
+    @unittest.skipIf(not hasattr(signal, "SIGHUP"), "no SIGHUP on this platform")
+    @gen_test
+    def test_verify_key_store_reload_on_sighup(self):
+        self.write_keys({"module1": self.new_key()})
+        store = VerifyKeyStore(self.path, check_interval=3600)
+        previous_handler = signal.getsignal(signal.SIGHUP)
+        try:
+            store.start()
+            self.assertEqual(store.reloads, 1)
+            os.kill(os.getpid(), signal.SIGHUP)
+            while store.reloads < 2:
+                yield gen.sleep(0.01)
+        finally:
+            store.stop()
+            signal.signal(signal.SIGHUP, previous_handler)
+
+    def test_verify_key_store_missing_file(self):
+        store = VerifyKeyStore(os.path.join(self.tmp_dir.name, "missing.json"))
+        self.assertIsNone(store.get("module1"))
+
+
+class VerificationPoolTest(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.signing_key = nacl.signing.SigningKey.generate()
+
+    def sign(self, message: bytes) -> str:
+        return self.signing_key.sign(message, encoder=nacl.encoding.Base64Encoder).decode("utf8")
+
+    @gen_test
+    def test_verification_pool_batches(self):
+        pool = VerificationPool(workers=1, max_batch_size=3)
+        try:
+            verify_key = self.signing_key.verify_key
+            # the first message occupies the only worker, the others wait and are verified in batches
+            futures = [pool.verify(verify_key, self.sign(str(i).encode("utf8")), base64_encoded=True) for i in range(7)]
+            futures.append(pool.verify(verify_key, self.sign(b"tampered")[:-4] + "AAAA", base64_encoded=True))
+            self.assertEqual(pool.stats()["queue_depth"], 7)
+
+            results = yield futures
+            self.assertEqual(results, [str(i).encode("utf8") for i in range(7)] + [None])
+            stats = pool.stats()
+            self.assertEqual(stats["batches"], 4)
+            self.assertEqual(stats["verified"], 7)
+            self.assertEqual(stats["failed"], 1)
+            self.assertEqual(stats["queue_depth"], 0)
+            self.assertIsNotNone(stats["latency_avg"])
+        finally:
+            pool.shutdown()
+
+    @gen_test
+    def test_verification_pool_process(self):
+        pool = VerificationPool(workers=1, mode="process")
+        try:
+            signed = bytes(self.signing_key.sign(b"message"))
+            result = yield pool.verify(self.signing_key.verify_key, signed, base64_encoded=False)
+            self.assertEqual(result, b"message")
+        finally:
+            pool.shutdown()
+
+    def test_verification_pool_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            VerificationPool(mode="fibers")
+
+
+class PermissionCacheTest(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.admin = UserDirectoryTest.LocalAdmin()
+        global_vars.user_directory = UserDirectory(AsyncKeycloak(None, self.admin, max_workers=1))
+        global_vars.permission_cache = TTLCache(maxsize=10, ttl=60)
+
+    def tearDown(self) -> None:
+        global_vars.permission_cache = None
+        super().tearDown()
+
+    @gen_test
+    def test_negative_caching(self):
+        # unknown users are only requested from keycloak once
+        self.assertIsNone((yield lookup_user("nobody")))
+        calls = self.admin.calls
+        self.assertIsNone((yield lookup_user("nobody")))
+        self.assertEqual(self.admin.calls, calls)
+
+    @gen_test
+    def test_invalidation(self):
+        user = yield lookup_user(TEST_USER.NAME)
+        self.assertEqual(user["role"], TEST_USER.ROLE)
+        self.assertIn(TEST_USER.NAME, global_vars.permission_cache)
+
+        # e.g. on user_logout
+        invalidate_cached_permissions(user_id=user["id"])
+        self.assertNotIn(TEST_USER.NAME, global_vars.permission_cache)
+
+
+class AdminEventPollerTest(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.admin = UserDirectoryTest.LocalAdmin()
+        self.directory = UserDirectory(AsyncKeycloak(None, self.admin, max_workers=1))
+        self.changed_users = []
+        self.directory.add_listener(self.changed_users.append)
+        self.events = [{"time": 1000, "operationType": "UPDATE", "resourceType": "USER", "resourcePath": "users/u1"}]
+        self.poller = AdminEventPoller(self.directory, self.event_source, page_size=2)
+
+    async def event_source(self, query: dict) -> list:
+        """
+        stand-in for the admin events endpoint of keycloak, newest first
+        """
+
+        events = sorted(self.events, key=lambda event: event["time"], reverse=True)
+        return events[query["first"]:query["first"] + query["max"]]
+
+    def add_event(self, operation_type: str, resource_type: str, resource_path: str) -> None:
+        self.events.append({"time": self.events[-1]["time"] + 1, "operationType": operation_type,
+                            "resourceType": resource_type, "resourcePath": resource_path})
+
+    @gen_test
+    def test_apply_events(self):
+        yield self.poller.init_cursor()
+        yield self.directory.sync()
+        # events before the cursor are covered by the sync
+        self.assertEqual((yield self.poller.poll()), 0)
+
+        # new user joins a group
+        self.add_event("CREATE", "USER", "users/u2")
+        self.add_event("CREATE", "GROUP_MEMBERSHIP", "users/u2/groups/g1")
+        self.assertEqual((yield self.poller.poll()), 2)
+        self.assertEqual(self.directory.get_user("new_user")["role"], TEST_USER.ROLE)
+        self.assertEqual(self.changed_users, ["u2"])
+
+        # and gets deleted again, more events than fit on a page
+        self.add_event("UPDATE", "USER", "users/u2")
+        self.add_event("UPDATE", "USER", "users/u2")
+        self.add_event("DELETE", "USER", "users/u2")
+        self.admin.deleted.add("u2")
+        self.assertEqual((yield self.poller.poll()), 3)
+        self.assertIsNone(self.directory.get_user("new_user"))
+        self.assertIsNotNone(self.directory.get_user(TEST_USER.NAME))
+
+        # nothing is applied twice
+        self.assertEqual((yield self.poller.poll()), 0)
+
+    @gen_test
+    def test_group_deleted(self):
+        yield self.poller.init_cursor()
+        yield self.directory.sync()
+
+        self.add_event("DELETE", "GROUP", "groups/g1")
+        self.admin.groups = []
+        yield self.poller.poll()
+        self.assertIsNone(self.directory.get_user(TEST_USER.NAME)["role"])
+        self.assertEqual(self.changed_users, ["u1"])
+
 
 class BaseWebsocketTestCase(AsyncHTTPTestCase):
 
@@ -92,10 +901,13 @@ class BaseWebsocketTestCase(AsyncHTTPTestCase):
         self.module_name = "test_module"
         self.port = 12345
 
-    def connect_websocket(self):
-        ws_url = tornado.httpclient.HTTPRequest("ws://localhost:{}/websocket".format(self.get_http_port()), validate_cert=False, body=json.dumps({
-            "type": "module_socket_connect", "module": "test_module"}), allow_nonstandard_methods=True)
-        return tornado.websocket.websocket_connect(ws_url)
+    def connect_websocket(self, module_name: str = "test_module", subprotocols=None, compression_options=None, session_public_key=None):
+        body = {"type": "module_socket_connect", "module": module_name}
+        if session_public_key is not None:
+            body["session_public_key"] = base64.b64encode(session_public_key).decode("ascii")
+        ws_url = tornado.httpclient.HTTPRequest("ws://localhost:{}/websocket".format(self.get_http_port()), validate_cert=False, body=json.dumps(body),
+                                                allow_nonstandard_methods=True)
+        return tornado.websocket.websocket_connect(ws_url, subprotocols=subprotocols, compression_options=compression_options)
 
     def assert_has_matching_resolve_id(self, request: dict, response: dict):
         """
@@ -390,6 +1202,16 @@ class WebsocketTestGetUser(BaseWebsocketTestCase):
         self.assertIn("reason", response)
         self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
 
+    @gen_test
+    def test_websocket_get_user_error_invalid_username(self):
+        # the username has to be a string
+        request = {"type": "get_user",
+                   "resolve_id": "123456789",
+                   "username": [TEST_USER.NAME]}
+
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
     
     @gen_test
     def test_websocket_get_user_list_success(self):
@@ -419,6 +1241,40 @@ class WebsocketTestGetUser(BaseWebsocketTestCase):
         self.assertEqual(TEST_USER.NAME, response["users"][TEST_USER.NAME]["username"])
         self.assertEqual(TEST_USER.ROLE, response["users"][TEST_USER.NAME]["role"])
 
+    @gen_test
+    def test_websocket_get_user_list_paged(self):
+        request = {"type": "get_user_list",
+                   "limit": 1,
+                   "resolve_id": "123456789"}
+
+        try:
+            response = yield self.base_checks(request, True)
+        except RuntimeError:
+            print("Keycloak Error occured, Test skipped")
+            return
+
+        # expect a single user and a cursor to the next page
+        self.assertEqual(len(response["users"]), 1)
+        self.assertIn("next_cursor", response)
+
+    @gen_test
+    def test_websocket_get_user_list_error_invalid_limit(self):
+        request = {"type": "get_user_list",
+                   "limit": 0,
+                   "resolve_id": "123456789"}
+
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
+    @gen_test
+    def test_websocket_get_user_list_error_invalid_cursor(self):
+        request = {"type": "get_user_list",
+                   "cursor": 42,
+                   "resolve_id": "123456789"}
+
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
 
 class WebsocketTestCheckPermission(BaseWebsocketTestCase):
 
@@ -461,6 +1317,89 @@ class WebsocketTestCheckPermission(BaseWebsocketTestCase):
         self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
 
 
+class WebsocketTestBatchLookup(BaseWebsocketTestCase):
+
+    @gen_test
+    def test_websocket_get_users_success(self):
+        request = {"type": "get_users",
+                   "resolve_id": "123456789",
+                   "usernames": [TEST_USER.NAME, "unittest_nonexistent_user"]}
+
+        try:
+            response = yield self.base_checks(request, True)
+        except RuntimeError:
+            print("Keycloak Error occured, Test skipped")
+            return
+
+        # expect an entry per username, with a per-user success
+        self.assertTrue(response["users"][TEST_USER.NAME]["success"])
+        self.assertEqual(TEST_USER.EMAIL, response["users"][TEST_USER.NAME]["user"]["email"])
+        self.assertFalse(response["users"]["unittest_nonexistent_user"]["success"])
+        self.assertEqual(response["users"]["unittest_nonexistent_user"]["reason"], "user_not_found")
+
+    @gen_test
+    def test_websocket_check_permissions_success(self):
+        request = {"type": "check_permissions",
+                   "resolve_id": "123456789",
+                   "usernames": [TEST_USER.NAME]}
+
+        try:
+            response = yield self.base_checks(request, True)
+        except RuntimeError:
+            print("Keycloak Error occured, Test skipped")
+            return
+
+        self.assertEqual(TEST_USER.ROLE, response["permissions"][TEST_USER.NAME]["role"])
+
+    @gen_test
+    def test_websocket_get_users_error_missing_usernames(self):
+        request = {"type": "get_users",
+                   "resolve_id": "123456789",
+                   "username": TEST_USER.NAME}
+
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
+    @gen_test
+    def test_websocket_get_users_error_too_many_usernames(self):
+        request = {"type": "get_users",
+                   "resolve_id": "123456789",
+                   "usernames": ["unittest_user_{}".format(i) for i in range(global_vars.max_lookup_usernames + 1)]}
+
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], "protocol_error")
+
+    @gen_test
+    def test_resolve_users_bounded_concurrency(self):
+        class SlowDirectory:
+            in_flight = 0
+            max_in_flight = 0
+
+            async def ensure_synced(self):
+                pass
+
+            def get_user(self, username):
+                return None
+
+            async def lookup(self, username):
+                SlowDirectory.in_flight += 1
+                SlowDirectory.max_in_flight = max(SlowDirectory.max_in_flight, SlowDirectory.in_flight)
+                await gen.sleep(0.01)
+                SlowDirectory.in_flight -= 1
+                return {"username": username}
+
+        user_directory = global_vars.user_directory
+        global_vars.user_directory = SlowDirectory()
+        try:
+            handler = WebsocketHandler.__new__(WebsocketHandler)
+            users = yield handler._resolve_users(["unittest_user_{}".format(i) for i in range(10)])
+        finally:
+            global_vars.user_directory = user_directory
+
+        self.assertEqual(len(users), 10)
+        self.assertEqual(SlowDirectory.max_in_flight, global_vars.user_lookup_concurrency)
+
+
 class WebsocketTestGetRunningModules(BaseWebsocketTestCase):
 
     @gen_test
@@ -482,6 +1421,43 @@ class WebsocketTestGetRunningModules(BaseWebsocketTestCase):
         self.assertEqual(self.port, int(response["running_modules"][self.module_name]["port"]))
 
 
+class WebsocketTestRegisterMessageType(BaseWebsocketTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        def echo(handler: WebsocketHandler, json_message: dict) -> None:
+            handler.write_message({"type": "unittest_echo_response",
+                                   "success": True,
+                                   "text": json_message["text"],
+                                   "resolve_id": json_message["resolve_id"]})
+
+        WebsocketHandler.register_message_type("unittest_echo", echo, required_keys=["text"])
+        self.addCleanup(WebsocketHandler.message_types.pop, "unittest_echo")
+
+    @gen_test
+    def test_websocket_registered_message_type_success(self):
+        request = {"type": "unittest_echo",
+                   "text": "hello",
+                   "resolve_id": "123456789"}
+
+        response = yield self.base_checks(request, True)
+        self.assertEqual(response["text"], "hello")
+
+    @gen_test
+    def test_websocket_registered_message_type_error_missing_key(self):
+        request = {"type": "unittest_echo",
+                   "resolve_id": "123456789"}
+
+        # the missing key is reported generically, without calling the handler
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
+    def test_register_duplicate_message_type(self):
+        with self.assertRaises(ValueError):
+            WebsocketHandler.register_message_type("get_user", lambda handler, json_message: None)
+
+
 class WebsocketTestMessageModule(BaseWebsocketTestCase):
 
     @gen_test
@@ -562,6 +1538,568 @@ class WebsocketTestMessageModule(BaseWebsocketTestCase):
         self.assertEqual(response["reason"], "module_offline")
 
 
+class WebsocketTestReplicas(BaseWebsocketTestCase):
+
+    @gen.coroutine
+    def start_replica(self, port: int):
+        ws_client = yield self.connect_websocket("replica_module")
+        ws_client.write_message(json.dumps({"type": "module_start",
+                                            "module_name": "replica_module",
+                                            "port": port,
+                                            "resolve_id": "start"}))
+        response = json.loads((yield ws_client.read_message()))
+        self.assertTrue(response["success"])
+        return ws_client
+
+    @gen_test
+    def test_websocket_replicas_round_robin(self):
+        replicas = [(yield self.start_replica(1001)), (yield self.start_replica(1002))]
+        self.assertEqual(global_vars.servers["replica_module"]["replicas"], 2)
+        yield self.module_start()
+
+        # two messages go to different replicas, each response goes back to the sender
+        for i, replica in enumerate(replicas):
+            request = {"type": "message_module", "to": "replica_module", "msg": "test", "resolve_id": str(i)}
+            self.ws_client.write_message(json.dumps(request))
+            forwarded = json.loads((yield replica.read_message()))
+            self.assertEqual(forwarded["resolve_id"], str(i))
+            self.assertEqual(forwarded["origin"], self.module_name)
+
+            replica.write_message(json.dumps({"type": "message_module_response", "to": self.module_name, "msg": "ok",
+                                              "resolve_id": str(i)}))
+            response = json.loads((yield self.ws_client.read_message()))
+            self.assertEqual(response["resolve_id"], str(i))
+
+        self.ws_client.close()
+        for replica in replicas:
+            replica.close()
+        # wait for the platform to notice the closes, so that no connections are left over for the other tests
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_message_module_timeout(self):
+        replica = yield self.start_replica(1001)
+        yield self.module_start()
+
+        # the replica never answers, the platform does instead
+        self.ws_client.write_message(json.dumps({"type": "message_module", "to": "replica_module", "msg": "test",
+                                                 "timeout": 0.05, "resolve_id": "1"}))
+        yield replica.read_message()
+        self.assertEqual(WebsocketHandler.in_flight("replica_module"), 1)
+        response = json.loads((yield self.ws_client.read_message()))
+        self.assertEqual(response["type"], "message_module_response")
+        self.assertEqual(response["reason"], "timeout")
+        self.assertEqual(WebsocketHandler.in_flight("replica_module"), 0)
+
+        self.ws_client.close()
+        replica.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_message_module_offline_on_close(self):
+        replica = yield self.start_replica(1001)
+        yield self.module_start()
+
+        self.ws_client.write_message(json.dumps({"type": "message_module", "to": "replica_module", "msg": "test", "resolve_id": "1"}))
+        yield replica.read_message()
+
+        # the replica goes away before it answers
+        replica.close()
+        response = json.loads((yield self.ws_client.read_message()))
+        self.assertEqual(response["reason"], "module_offline")
+        self.assertEqual(response["resolve_id"], "1")
+
+        self.ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_replica_close(self):
+        replicas = [(yield self.start_replica(1001)), (yield self.start_replica(1002))]
+        replicas[0].close()
+        # wait for the platform to notice the close
+        while global_vars.servers["replica_module"]["replicas"] != 1:
+            yield gen.sleep(0.01)
+
+        # the module stays online with the remaining replica
+        self.assertEqual(global_vars.servers["replica_module"]["port"], 1002)
+        replicas[1].close()
+        while "replica_module" in global_vars.servers:
+            yield gen.sleep(0.01)
+
+
+class WebsocketTestSendQueue(BaseWebsocketTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        global_vars.outbound_queue_size = 2
+
+    def tearDown(self) -> None:
+        global_vars.outbound_queue_size = 1000
+        global_vars.slow_consumer_policy = "drop_oldest"
+        super().tearDown()
+
+    @gen_test
+    def test_websocket_send_queue_drop_oldest(self):
+        yield self.module_start()
+        client = WebsocketHandler.modules[self.module_name][0]
+
+        # more messages than fit into the queue at once, the oldest ones are dropped
+        for i in range(5):
+            client.write_message({"type": "unittest", "number": i})
+        self.assertEqual(WebsocketHandler.queue_stats()[self.module_name]["dropped"], 3)
+
+        self.assertEqual(json.loads((yield self.ws_client.read_message()))["number"], 3)
+        self.assertEqual(json.loads((yield self.ws_client.read_message()))["number"], 4)
+        self.ws_client.close()
+
+    @gen_test
+    def test_websocket_send_queue_disconnect(self):
+        global_vars.slow_consumer_policy = "disconnect"
+        yield self.module_start()
+        client = WebsocketHandler.modules[self.module_name][0]
+
+        for i in range(3):
+            client.write_message({"type": "unittest", "number": i})
+
+        # the queued messages are discarded together with the connection
+        self.assertIsNone((yield self.ws_client.read_message()))
+        self.assertEqual(self.ws_client.close_code, 1008)
+
+    @gen_test
+    def test_websocket_send_queue_block_overflow(self):
+        global_vars.slow_consumer_policy = "block"
+        yield self.module_start()
+        client = WebsocketHandler.modules[self.module_name][0]
+
+        # two messages fit into the queue, two more wait for space
+        queued = [client.write_message({"type": "unittest", "number": i}) for i in range(4)]
+        self.assertFalse(queued[2].done())
+        stats = WebsocketHandler.queue_stats()[self.module_name]
+        self.assertEqual(stats["queue_depth"], 4)
+        self.assertEqual(stats["queued_bytes"], sum(len(json.dumps({"type": "unittest", "number": i}).encode()) for i in range(4)))
+
+        # no more messages can wait, the connection is closed instead of growing without bounds
+        self.assertTrue(client.write_message({"type": "unittest", "number": 4}).cancelled())
+        self.assertTrue(queued[2].cancelled())
+        while (yield self.ws_client.read_message()) is not None:
+            pass
+        self.assertEqual(self.ws_client.close_code, 1008)
+
+
+class WebsocketTestPubSub(BaseWebsocketTestCase):
+
+    @gen.coroutine
+    def start_subscriber(self, module_name: str, topic: str):
+        ws_client = yield self.connect_websocket(module_name)
+        ws_client.write_message(json.dumps({"type": "module_start", "module_name": module_name, "port": 1001, "resolve_id": "start"}))
+        yield ws_client.read_message()
+        ws_client.write_message(json.dumps({"type": "subscribe", "topic": topic, "resolve_id": "subscribe"}))
+        response = json.loads((yield ws_client.read_message()))
+        self.assertTrue(response["success"])
+        return ws_client
+
+    @gen.coroutine
+    def publish(self, topic: str, data=None) -> dict:
+        self.ws_client.write_message(json.dumps({"type": "publish", "topic": topic, "data": data, "resolve_id": "publish"}))
+        return json.loads((yield self.ws_client.read_message()))
+
+    @gen_test
+    def test_websocket_publish_to_subscribers(self):
+        exact = yield self.start_subscriber("exact_module", "user.logout")
+        prefix = yield self.start_subscriber("prefix_module", "user.*")
+        other = yield self.start_subscriber("other_module", "template.changed")
+        yield self.module_start()
+
+        response = yield self.publish("user.logout", {"username": TEST_USER.NAME})
+        self.assertTrue(response["success"])
+        self.assertEqual(response["delivered"], 2)
+        for subscriber in (exact, prefix):
+            event = json.loads((yield subscriber.read_message()))
+            self.assertEqual(event, {"type": "event", "topic": "user.logout", "data": {"username": TEST_USER.NAME},
+                                     "origin": self.module_name})
+
+        # only the prefix subscription matches here, the exact subscriber doesn't get it
+        response = yield self.publish("user.created.admin")
+        self.assertEqual(response["delivered"], 1)
+        self.assertEqual(json.loads((yield prefix.read_message()))["topic"], "user.created.admin")
+
+        # the other subscriber never got anything
+        response = yield self.publish("template.changed")
+        self.assertEqual(response["delivered"], 1)
+        self.assertEqual(json.loads((yield other.read_message()))["topic"], "template.changed")
+
+        for ws_client in (self.ws_client, exact, prefix, other):
+            ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+        self.assertEqual(WebsocketHandler.subscribers, {})
+        self.assertEqual(WebsocketHandler.prefix_subscribers, {})
+
+    @gen_test
+    def test_websocket_unsubscribe(self):
+        subscriber = yield self.start_subscriber("sub_module", "*")
+        yield self.module_start()
+        self.assertEqual((yield self.publish("anything"))["delivered"], 1)
+        yield subscriber.read_message()
+
+        subscriber.write_message(json.dumps({"type": "unsubscribe", "topic": "*", "resolve_id": "1"}))
+        self.assertTrue(json.loads((yield subscriber.read_message()))["success"])
+        self.assertEqual((yield self.publish("anything"))["delivered"], 0)
+
+        subscriber.write_message(json.dumps({"type": "unsubscribe", "topic": "*", "resolve_id": "2"}))
+        self.assertEqual(json.loads((yield subscriber.read_message()))["reason"], "not_subscribed")
+
+        self.ws_client.close()
+        subscriber.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_subscribe_invalid_topic(self):
+        for topic in ("", "a*", "a.*.b", 5):
+            request = {"type": "subscribe", "topic": topic, "resolve_id": "1"}
+            response = yield self.base_checks(request, False)
+            self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+            while WebsocketHandler.connections:
+                yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_publish_wildcard_topic(self):
+        request = {"type": "publish", "topic": "user.*", "resolve_id": "1"}
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
+    @gen_test
+    def test_websocket_user_logout_published(self):
+        global_vars.broadcast_user_logout = False
+        try:
+            subscriber = yield self.start_subscriber("sub_module", "platform.user_logout")
+            bystander = yield self.start_subscriber("bystander_module", "user.*")
+            yield self.module_start()
+
+            self.ws_client.write_message(json.dumps({"type": "user_logout", "username": TEST_USER.NAME, "resolve_id": "1"}))
+            self.assertTrue(json.loads((yield self.ws_client.read_message()))["success"])
+            event = json.loads((yield subscriber.read_message()))
+            self.assertEqual(event["topic"], "platform.user_logout")
+            self.assertEqual(event["data"]["username"], TEST_USER.NAME)
+            # nothing arrived at the module that isn't subscribed
+            self.assertEqual(WebsocketHandler.queue_stats()["bystander_module"]["queue_depth"], 0)
+
+            for ws_client in (self.ws_client, subscriber, bystander):
+                ws_client.close()
+            while WebsocketHandler.connections:
+                yield gen.sleep(0.01)
+        finally:
+            global_vars.broadcast_user_logout = True
+
+
+@unittest.skipIf(message_codec.MSGPACK is None, "msgpack is not installed")
+class WebsocketTestMsgpack(BaseWebsocketTestCase):
+
+    @gen.coroutine
+    def start_msgpack_module(self, module_name: str):
+        ws_client = yield self.connect_websocket(module_name, subprotocols=["msgpack", "json"])
+        self.assertEqual(ws_client.selected_subprotocol, "msgpack")
+        ws_client.write_message(message_codec.MSGPACK.encode({"type": "module_start", "module_name": module_name,
+                                                              "port": 1001, "resolve_id": "start"}), binary=True)
+        response = yield ws_client.read_message()
+        # binary frames arrive as bytes
+        self.assertIsInstance(response, bytes)
+        self.assertTrue(message_codec.MSGPACK.decode(response)["success"])
+        return ws_client
+
+    @gen_test
+    def test_websocket_msgpack_request_response(self):
+        ws_client = yield self.start_msgpack_module("msgpack_module")
+        ws_client.write_message(message_codec.MSGPACK.encode({"type": "get_running_modules", "resolve_id": "1"}), binary=True)
+        response = message_codec.MSGPACK.decode((yield ws_client.read_message()))
+        self.assertEqual(response["type"], "get_running_modules_response")
+        self.assertIn("msgpack_module", response["running_modules"])
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_msgpack_mixed_codecs(self):
+        msgpack_client = yield self.start_msgpack_module("msgpack_module")
+        yield self.module_start()
+
+        # a JSON module messages the msgpack module and gets the response back as JSON
+        self.ws_client.write_message(json.dumps({"type": "message_module", "to": "msgpack_module", "msg": "test", "resolve_id": "1"}))
+        forwarded = message_codec.MSGPACK.decode((yield msgpack_client.read_message()))
+        self.assertEqual(forwarded["origin"], self.module_name)
+        msgpack_client.write_message(message_codec.MSGPACK.encode({"type": "message_module_response", "to": self.module_name,
+                                                                   "msg": "ok", "resolve_id": "1"}), binary=True)
+        self.assertEqual(json.loads((yield self.ws_client.read_message()))["msg"], "ok")
+
+        # a broadcast reaches both in their own codec
+        yield WebsocketHandler.broadcast_message({"type": "unittest"})
+        self.assertEqual(message_codec.MSGPACK.decode((yield msgpack_client.read_message())), {"type": "unittest"})
+        self.assertEqual(json.loads((yield self.ws_client.read_message())), {"type": "unittest"})
+
+        self.ws_client.close()
+        msgpack_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_unknown_subprotocol_uses_json(self):
+        ws_client = yield self.connect_websocket(subprotocols=["unknown"])
+        self.assertIsNone(ws_client.selected_subprotocol)
+        ws_client.write_message(json.dumps({"type": "get_running_modules", "resolve_id": "1"}))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "get_running_modules_response")
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+
+class WebsocketTestCompression(BaseWebsocketTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        global_vars.websocket_compression = {"compression_level": 6, "min_size": 100}
+
+    def tearDown(self) -> None:
+        global_vars.websocket_compression = None
+        super().tearDown()
+
+    @gen_test
+    def test_websocket_private_compressor_attribute(self):
+        # _write_frame() relies on this private attribute of tornado, without it small messages would silently be compressed
+        ws_client = yield self.connect_websocket(compression_options={})
+        ws_client.write_message(json.dumps({"type": "get_running_modules", "resolve_id": "1"}))
+        yield ws_client.read_message()
+        client = WebsocketHandler.modules[self.module_name][0]
+        self.assertIsInstance(client.ws_connection, tornado.websocket.WebSocketProtocol13)
+        self.assertIn("_compressor", vars(client.ws_connection))
+        self.assertTrue(callable(getattr(client.ws_connection._compressor, "compress", None)))
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_compression_min_size(self):
+        ws_client = yield self.connect_websocket(compression_options={})
+        ws_client.write_message(json.dumps({"type": "get_running_modules", "resolve_id": "1"}))
+        yield ws_client.read_message()
+        client = WebsocketHandler.modules[self.module_name][0]
+        self.assertIsNotNone(client.ws_connection._compressor)
+
+        compressed = []
+        compress = client.ws_connection._compressor.compress
+        client.ws_connection._compressor.compress = lambda data: compressed.append(data) or compress(data)
+
+        # only the large message goes through the compressor, both arrive as they were sent
+        client.write_message({"type": "small"})
+        client.write_message({"type": "large", "content": "x" * 1000})
+        self.assertEqual(json.loads((yield ws_client.read_message())), {"type": "small"})
+        self.assertEqual(json.loads((yield ws_client.read_message()))["content"], "x" * 1000)
+        self.assertEqual(len(compressed), 1)
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_compression_disabled(self):
+        global_vars.websocket_compression = None
+        ws_client = yield self.connect_websocket(compression_options={})
+        ws_client.write_message(json.dumps({"type": "get_running_modules", "resolve_id": "1"}))
+        yield ws_client.read_message()
+        self.assertIsNone(ws_client.protocol._compressor)
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+
+class WebsocketTestBatch(BaseWebsocketTestCase):
+
+    @gen_test
+    def test_websocket_batch_keeps_other_messages_separate(self):
+        release = tornado.locks.Event()
+
+        async def wait(handler: WebsocketHandler, json_message: dict) -> None:
+            await release.wait()
+            handler.write_message({"type": "unittest_wait_response", "success": True, "resolve_id": json_message["resolve_id"]})
+
+        WebsocketHandler.register_message_type("unittest_wait", wait)
+        self.addCleanup(WebsocketHandler.message_types.pop, "unittest_wait")
+
+        sender = yield self.connect_websocket("sender_module")
+        yield self.module_start()
+        self.ws_client.write_message(json.dumps({"type": "batch", "messages": [{"type": "unittest_wait", "resolve_id": "1"}],
+                                                 "resolve_id": "batch"}))
+        # while the batch is still running, another module sends a message to this one
+        sender.write_message(json.dumps({"type": "message_module", "to": self.module_name, "msg": "test", "resolve_id": "2"}))
+        forwarded = json.loads((yield self.ws_client.read_message()))
+        self.assertEqual(forwarded["type"], "message_module")
+        self.assertEqual(forwarded["resolve_id"], "2")
+
+        release.set()
+        response = json.loads((yield self.ws_client.read_message()))
+        self.assertEqual(response["type"], "batch_response")
+        self.assertEqual([item["resolve_id"] for item in response["responses"]], ["1"])
+
+        self.ws_client.close()
+        sender.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_batch_success(self):
+        request = {"type": "batch",
+                   "messages": [{"type": "get_running_modules", "resolve_id": "1"},
+                                {"type": "subscribe", "topic": "unittest.*", "resolve_id": "2"},
+                                {"type": "unknown_type", "resolve_id": "3"},
+                                {"type": "get_user", "resolve_id": "4"}],
+                   "resolve_id": "batch"}
+        response = yield self.base_checks(request, True)
+
+        # one response per message, in the order of the messages
+        self.assertEqual([item["resolve_id"] for item in response["responses"]], ["1", "2", "3", "4"])
+        self.assertEqual(response["responses"][0]["type"], "get_running_modules_response")
+        self.assertTrue(response["responses"][1]["success"])
+        self.assertEqual(response["responses"][2]["type"], "protocol_error")
+        self.assertEqual(response["responses"][3]["reason"], MESSAGE_FORMAT_ERROR)
+
+    @gen_test
+    def test_websocket_batch_invalid(self):
+        for messages in ([], "no list", [{"type": "batch", "messages": [], "resolve_id": "1"}]):
+            request = {"type": "batch", "messages": messages, "resolve_id": "batch"}
+            response = yield self.base_checks(request, False)
+            self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+            while WebsocketHandler.connections:
+                yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_batch_too_large(self):
+        request = {"type": "batch",
+                   "messages": [{"type": "get_running_modules", "resolve_id": str(i)} for i in range(global_vars.max_batch_size + 1)],
+                   "resolve_id": "batch"}
+        response = yield self.base_checks(request, False)
+        self.assertEqual(response["reason"], MESSAGE_FORMAT_ERROR)
+
+
+class WebsocketTestSessionAuth(BaseWebsocketTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        # messages are only verified outside of the test mode
+        options.test = False
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp_dir.name, "verify_keys.json")
+        with open(path, "w") as fp:
+            json.dump({self.module_name: self.signing_key.verify_key.encode(nacl.encoding.Base64Encoder).decode("utf8")}, fp)
+        global_vars.verify_key_store = VerifyKeyStore(path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+        options.test = True
+        global_vars.allow_signed_messages = True
+        global_vars.verify_key_store = VerifyKeyStore()
+        super().tearDown()
+
+    @gen.coroutine
+    def connect_session(self, signing_key: nacl.signing.SigningKey):
+        private_key = nacl.public.PrivateKey.generate()
+        public_key = bytes(private_key.public_key)
+        ws_client = yield self.connect_websocket(session_public_key=public_key)
+        platform_public_key = base64.b64decode(ws_client.headers[SESSION_PUBLIC_KEY_HEADER])
+
+        transcript = session_transcript(self.module_name, public_key, platform_public_key)
+        ws_client.write_message(json.dumps({"type": "session_auth",
+                                            "signature": base64.b64encode(signing_key.sign(transcript).signature).decode("ascii"),
+                                            "resolve_id": "auth"}))
+        response = json.loads((yield ws_client.read_message()))
+        return ws_client, derive_session_key(private_key, platform_public_key, transcript), response
+
+    @staticmethod
+    def session_message(key: bytes, seq: int, message: dict) -> str:
+        payload = json.dumps(message)
+        return json.dumps({"origin": message["origin"], "seq": seq, "msg": payload,
+                           "mac": base64.b64encode(session_mac(key, seq, payload.encode("utf8"))).decode("ascii")})
+
+    @gen_test
+    def test_websocket_session_auth_success(self):
+        ws_client, key, response = yield self.connect_session(self.signing_key)
+        self.assertTrue(response["success"])
+
+        message = {"type": "get_running_modules", "origin": self.module_name, "resolve_id": "1"}
+        ws_client.write_message(self.session_message(key, 1, message))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "get_running_modules_response")
+
+        # a replayed message (same sequence number) is rejected
+        ws_client.write_message(self.session_message(key, 1, message))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "signature_verification_error")
+
+        # as well as a message with a MAC of another key
+        ws_client.write_message(self.session_message(b"\x00" * 32, 2, message))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "signature_verification_error")
+
+        ws_client.write_message(self.session_message(key, 2, message))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "get_running_modules_response")
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_session_auth_wrong_key(self):
+        ws_client, _, response = yield self.connect_session(nacl.signing.SigningKey.generate())
+        self.assertFalse(response["success"])
+        self.assertEqual(response["reason"], "authentication_failed")
+        self.assertIsNone((yield ws_client.read_message()))
+        self.assertEqual(ws_client.close_code, 1008)
+
+    @gen_test
+    def test_websocket_signed_messages(self):
+        ws_client = yield self.connect_websocket()
+        message = {"type": "get_running_modules", "origin": self.module_name, "resolve_id": "1"}
+        signed = self.signing_key.sign(json.dumps(message).encode("utf8"), encoder=nacl.encoding.Base64Encoder)
+        ws_client.write_message(json.dumps({"signed_msg": signed.decode("utf8"), "origin": self.module_name, "resolve_id": "1"}))
+        self.assertEqual(json.loads((yield ws_client.read_message()))["type"], "get_running_modules_response")
+
+        ws_client.close()
+        while WebsocketHandler.connections:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_websocket_signed_messages_verification_pool(self):
+        global_vars.verification_pool = VerificationPool(workers=2)
+        try:
+            ws_client = yield self.connect_websocket()
+            # the responses arrive in the order of the messages, although they are verified concurrently
+            for i in range(5):
+                message = {"type": "get_running_modules", "origin": self.module_name, "resolve_id": str(i)}
+                signed = self.signing_key.sign(json.dumps(message).encode("utf8"), encoder=nacl.encoding.Base64Encoder)
+                ws_client.write_message(json.dumps({"signed_msg": signed.decode("utf8"), "origin": self.module_name, "resolve_id": str(i)}))
+            for i in range(5):
+                self.assertEqual(json.loads((yield ws_client.read_message()))["resolve_id"], str(i))
+            self.assertEqual(global_vars.verification_pool.stats()["verified"], 5)
+
+            ws_client.close()
+            while WebsocketHandler.connections:
+                yield gen.sleep(0.01)
+        finally:
+            global_vars.verification_pool.shutdown()
+            global_vars.verification_pool = None
+
+    @gen_test
+    def test_websocket_signed_messages_disabled(self):
+        global_vars.allow_signed_messages = False
+        ws_client = yield self.connect_websocket()
+        self.assertIsNone((yield ws_client.read_message()))
+        self.assertEqual(ws_client.close_code, 1008)
+
+
 class WebsocketTestGetTemplates(BaseWebsocketTestCase):
 
 
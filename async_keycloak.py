@@ -0,0 +1,214 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from keycloak import KeycloakAdmin, KeycloakOpenID
+from keycloak.exceptions import KeycloakConnectionError, KeycloakError, KeycloakGetError, raise_error_from_response
+import tornado.ioloop
+
+from admin_token_manager import AdminTokenManager
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from single_flight import SingleFlight
+
+# python-keycloak has no wrapper for the admin events endpoint
+URL_ADMIN_ADMIN_EVENTS = "admin/realms/{realm-name}/admin-events"
+
+
+class AsyncKeycloak:
+    """
+    awaitable facade for the (blocking) python-keycloak clients.
+    Every call is run in a bounded thread pool, so that a slow Keycloak never blocks the IOLoop (and therefore all the
+    other users and modules). Each call has a timeout, exceeding it raises a KeycloakConnectionError, so that callers
+    can handle it like any other error of Keycloak.
+    Concurrent refreshes and introspections of the same token are coalesced into one call to Keycloak.
+    All calls go through a circuit breaker, while it is open calls fail immediately with a CircuitOpenError.
+    The token of the admin client is kept fresh in the background by an AdminTokenManager.
+    """
+
+    def __init__(self, keycloak_openid: KeycloakOpenID, keycloak_admin: KeycloakAdmin, max_workers: int = 8, timeout: float = 10,
+                 circuit_breaker: Optional[CircuitBreaker] = None):
+        """
+        :param keycloak_openid: the client used for the user's tokens
+        :param keycloak_admin: the client used for the admin API
+        :param max_workers: maximum number of concurrent calls to Keycloak, further calls are queued
+        :param timeout: default timeout of a call in seconds (including the time it is queued, but a call that times out
+                        before a worker picked it up doesn't count as a failure of Keycloak)
+        :param circuit_breaker: the circuit breaker guarding the calls, a default one is created if not supplied
+        """
+
+        self.keycloak_openid = keycloak_openid
+        self.keycloak_admin = keycloak_admin
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="keycloak")
+        self.single_flight = SingleFlight()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.admin_token_manager = AdminTokenManager(self)
+
+    async def run(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        run a blocking function of the python-keycloak clients in the thread pool
+
+        :param func: the function to call
+        :param timeout: timeout of this call in seconds, defaults to the timeout of the facade
+
+        :raises KeycloakConnectionError: if the call did not finish in time
+        :raises CircuitOpenError: if the circuit breaker is open, i.e. Keycloak is considered unavailable
+        :return: the result of the function
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError("Keycloak is unavailable (circuit breaker open), call {} rejected".format(getattr(func, "__name__", func)))
+        # while half open, only the probe call is allowed
+        probe = self.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+
+        # the latency is measured in the worker, the time the call waits for a free worker tells nothing about Keycloak
+        timing: Dict[str, float] = {}
+        future = tornado.ioloop.IOLoop.current().run_in_executor(self._executor, functools.partial(self._timed, timing, func, *args, **kwargs))
+        try:
+            result = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if "started" not in timing:
+                # never reached Keycloak (all workers busy), wait_for cancelled the queued call
+                self.circuit_breaker.release(probe)
+                raise KeycloakConnectionError("Keycloak call {} was not started within {}s, all workers are busy".format(getattr(func, "__name__", func), timeout))
+            self.circuit_breaker.record_failure()
+            # the thread cannot be interrupted, but the python-keycloak clients have their own (socket) timeout as well
+            raise KeycloakConnectionError("Keycloak call {} timed out after {}s".format(getattr(func, "__name__", func), timeout))
+        except KeycloakError as e:
+            if CircuitBreaker.is_failure(e):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success(timing["finished"] - timing["started"])
+            raise
+        except asyncio.CancelledError:
+            self.circuit_breaker.release(probe)
+            raise
+        except Exception:
+            self.circuit_breaker.record_failure()
+            raise
+
+        self.circuit_breaker.record_success(timing["finished"] - timing["started"])
+        return result
+
+    @staticmethod
+    def _timed(timing: Dict[str, float], func: Callable, *args, **kwargs) -> Any:
+        """
+        runs in the worker, records when the call actually started and finished
+        """
+
+        timing["started"] = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timing["finished"] = time.monotonic()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    # --- OpenID (user tokens) ---
+
+    async def token(self, **kwargs) -> dict:
+        return await self.run(self.keycloak_openid.token, **kwargs)
+
+    async def refresh_token(self, refresh_token: str) -> dict:
+        # e.g. the admin page fires several requests at once with the same session, refresh it only once for all of them
+        return await self.single_flight.do(("refresh_token", refresh_token),
+                                           lambda: self.run(self.keycloak_openid.refresh_token, refresh_token))
+
+    async def introspect(self, access_token: str) -> dict:
+        return await self.single_flight.do(("introspect", access_token),
+                                           lambda: self.run(self.keycloak_openid.introspect, access_token))
+
+    async def logout(self, refresh_token: str) -> dict:
+        return await self.run(self.keycloak_openid.logout, refresh_token)
+
+    async def certs(self) -> dict:
+        return await self.run(self.keycloak_openid.certs)
+
+    # --- Admin API ---
+
+    async def run_admin(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        run a function of the admin client. The admin token is refreshed in the background, if it got rejected
+        nonetheless (e.g. because it was revoked), it is refreshed and the call is retried exactly once
+        """
+
+        try:
+            return await self.run(func, *args, **kwargs)
+        except KeycloakError as e:
+            if e.response_code != 401:
+                raise
+
+        await self.admin_token_manager.refresh()
+        return await self.run(func, *args, **kwargs)
+
+    async def get_groups(self) -> List[dict]:
+        return await self.run_admin(self.keycloak_admin.get_groups)
+
+    async def get_group_members(self, group_id: str) -> List[dict]:
+        return await self.run_admin(self.keycloak_admin.get_group_members, group_id)
+
+    async def get_members_of_groups(self, group_ids: List[str], max_concurrency: int = 4,
+                                    deadline: float = 10) -> Tuple[Dict[str, List[dict]], List[str]]:
+        """
+        request the members of several groups concurrently, at most max_concurrency requests are in flight at once.
+        A group whose members could not be fetched (error, or not done before the deadline) does not fail the others
+
+        :param group_ids: the ids of the groups
+        :param max_concurrency: maximum number of concurrent requests
+        :param deadline: seconds until all requests have to be finished, unfinished ones are cancelled
+
+        :return: ({"<group_id>": [<member>]} of the groups that could be fetched, [<group_id>] of the groups that could not)
+        """
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(group_id: str) -> List[dict]:
+            async with semaphore:
+                return await self.get_group_members(group_id)
+
+        tasks = {group_id: asyncio.ensure_future(fetch(group_id)) for group_id in group_ids}
+        if not tasks:
+            return {}, []
+        _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+
+        members, failed = {}, []
+        for group_id, task in tasks.items():
+            if task in pending or task.exception() is not None:
+                failed.append(group_id)
+            else:
+                members[group_id] = task.result()
+        return members, failed
+
+    async def get_user_id(self, username: str) -> Optional[str]:
+        return await self.run_admin(self.keycloak_admin.get_user_id, username)
+
+    async def get_user(self, user_id: str) -> dict:
+        return await self.run_admin(self.keycloak_admin.get_user, user_id)
+
+    async def get_user_groups(self, user_id: str) -> List[dict]:
+        return await self.run_admin(self.keycloak_admin.get_user_groups, user_id)
+
+    async def get_group(self, group_id: str) -> dict:
+        return await self.run_admin(self.keycloak_admin.get_group, group_id)
+
+    def _get_admin_events(self, query: dict) -> List[dict]:
+        params_path = {"realm-name": self.keycloak_admin.realm_name}
+        data_raw = self.keycloak_admin.raw_get(URL_ADMIN_ADMIN_EVENTS.format(**params_path), data=None, **query)
+        return raise_error_from_response(data_raw, KeycloakGetError)
+
+    async def get_admin_events(self, query: dict) -> List[dict]:
+        """
+        :param query: query parameters of the admin events endpoint (e.g. dateFrom, resourceTypes, first, max)
+
+        :return: the admin events, newest first
+        """
+
+        return await self.run_admin(self._get_admin_events, query)
@@ -0,0 +1,144 @@
+from collections import deque
+import time
+
+from keycloak.exceptions import KeycloakConnectionError, KeycloakError
+
+
+class CircuitOpenError(KeycloakConnectionError):
+    """
+    raised instead of calling Keycloak while the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    circuit breaker for the calls to Keycloak.
+    Calls that fail (connection errors, timeouts, server errors) or exceed the latency budget are counted as failures.
+    If the rate of failures in the rolling window exceeds the threshold, the circuit opens and calls are rejected
+    immediately for open_duration seconds. After that, a single probe call is let through (half open): if it succeeds,
+    the circuit closes again, otherwise it stays open for another open_duration.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_rate_threshold: float = 0.5, minimum_calls: int = 10, window: float = 30,
+                 latency_budget: float = 2, open_duration: float = 15):
+        """
+        :param failure_rate_threshold: rate of failed calls (0..1) in the window at which the circuit opens
+        :param minimum_calls: minimum number of calls in the window before the circuit can open
+        :param window: length of the rolling window in seconds
+        :param latency_budget: calls that take longer than this (in seconds) count as failed, even if they succeed
+        :param open_duration: seconds the circuit stays open before a probe call is let through
+        """
+
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.latency_budget = latency_budget
+        self.open_duration = open_duration
+
+        self.state = self.CLOSED
+        self._opened_at: float = 0
+        self._probe_in_flight = False
+        self._calls: deque = deque()  # (timestamp, failed)
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _prune(self, now: float) -> None:
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def allow(self) -> bool:
+        """
+        check if a call may go out now. A caller that is allowed has to report the outcome by record_success/record_failure
+
+        :return: True if the call may go out, False if it has to be rejected
+        """
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_duration:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            # only a single probe at a time
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+
+        return True
+
+    def record_success(self, latency: float) -> None:
+        if latency > self.latency_budget:
+            self.record_failure()
+            return
+
+        if self.state == self.HALF_OPEN:
+            self._close()
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, False))
+        self._prune(now)
+
+    def record_failure(self) -> None:
+        if self.state == self.OPEN:
+            # a call that was already in flight when the circuit opened, it doesn't extend the open duration
+            return
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, True))
+        self._prune(now)
+
+        failures = sum(1 for _, failed in self._calls if failed)
+        if len(self._calls) >= self.minimum_calls and failures / len(self._calls) >= self.failure_rate_threshold:
+            self._open()
+
+    def release(self, probe: bool) -> None:
+        """
+        a call that was allowed finished without telling anything about the health of Keycloak (e.g. it was cancelled)
+
+        :param probe: whether the call was the probe of the half open circuit, only then another probe is let through
+        """
+
+        if probe and self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            self.state = self.OPEN
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self.times_opened += 1
+
+    def _close(self) -> None:
+        self.state = self.CLOSED
+        self._probe_in_flight = False
+        self._calls.clear()
+
+    @staticmethod
+    def is_failure(error: KeycloakError) -> bool:
+        """
+        only errors that indicate that Keycloak is unhealthy count as failures,
+        client errors (e.g. an expired session) are a perfectly healthy answer
+        """
+
+        if isinstance(error, KeycloakConnectionError):
+            return True
+        return error.response_code is None or error.response_code >= 500
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._prune(now)
+        return {"state": self.state,
+                "calls_in_window": len(self._calls),
+                "failures_in_window": sum(1 for _, failed in self._calls if failed),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected}
@@ -1,8 +1,12 @@
 # override those values on application startup
 
+from typing import Optional
+
 from keycloak import KeycloakOpenID
 keycloak = KeycloakOpenID  # only as dummies for IDE function suggestions
 port: int = 0
 platform_host: str = ""
 platform_port: int = 0
-routing_table: dict = {}
\ No newline at end of file
+routing_table: dict = {}
+session_auth: bool = False  # authenticate once per connection and send MACs afterwards, instead of signing every message
+websocket_compression: Optional[dict] = None  # e.g. {"compression_level": 6, "mem_level": 8} to offer permessage-deflate to the platform, None disables it
\ No newline at end of file
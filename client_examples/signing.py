@@ -1,7 +1,12 @@
+import hashlib
+import hmac
 import os
 from typing import Optional
 
+import nacl.bindings
 import nacl.encoding
+import nacl.hash
+import nacl.public
 import nacl.signing
 
 def create_signing_key_if_not_exists() -> None:
@@ -54,6 +59,35 @@ def get_verify_key() -> Optional[nacl.signing.VerifyKey]:
     else:
         return None
 
+def session_transcript(module_name: str, module_public_key: bytes, platform_public_key: bytes) -> bytes:
+    """
+    the bytes that are signed to authenticate a session with the platform (has to match the platform's session_auth.py)
+
+    :return: the transcript of the handshake
+
+    """
+
+    return b"module_session_auth\x00" + module_name.encode("utf8") + b"\x00" + module_public_key + platform_public_key
+
+def derive_session_key(private_key: nacl.public.PrivateKey, platform_public_key: bytes, transcript: bytes) -> bytes:
+    """
+    derive the session key from the key exchange with the platform
+
+    :return: the session key
+
+    """
+
+    shared_secret = nacl.bindings.crypto_scalarmult(bytes(private_key), platform_public_key)
+    return nacl.hash.blake2b(shared_secret + transcript, digest_size=32, encoder=nacl.encoding.RawEncoder)
+
+def session_mac(key: bytes, seq: int, payload: bytes) -> bytes:
+    """
+    :return: the MAC of a message of an authenticated session
+
+    """
+
+    return hmac.new(key, seq.to_bytes(8, "big") + payload, hashlib.sha256).digest()
+
 
 if __name__ == "__main__":  # file is accessed standalone as well as imported
     create_signing_key_if_not_exists()
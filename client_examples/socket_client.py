@@ -1,8 +1,10 @@
 from asyncio import get_event_loop
+import base64
 import json
 from time import sleep
 import uuid
 
+import nacl.public
 import nacl.signing
 import tornado
 from tornado import gen
@@ -13,6 +15,11 @@ from tornado.websocket import websocket_connect
 import global_vars
 import signing
 
+try:
+    import msgpack
+except ImportError:  # optional, without it the messages are exchanged as JSON
+    msgpack = None
+
 
 the_websocket_client = None
 
@@ -33,7 +40,11 @@ class Client(object):
         """
         self.url = url
         self.futures = {}
+        self.batches = {}  # resolve_id of a batch -> resolve_ids of its messages
         self.ws = None
+        self.binary = False  # True if the platform accepted msgpack for this connection
+        self.session_key = None  # key of the authenticated session, None if every message is signed
+        self.seq = 0  # sequence number of the last message sent in the session
 
     async def _await_init(self):
         await self.connect()
@@ -44,7 +55,17 @@ class Client(object):
         while True:
             print("trying to connect to platform")
             try:
-                self.ws = await websocket_connect(self.url)
+                self.session_key = None
+                if global_vars.session_auth:
+                    # a new key pair for every connection, the session key is derived from it
+                    session_private_key = nacl.public.PrivateKey.generate()
+                    body = json.loads(self.url.body)
+                    body["session_public_key"] = base64.b64encode(bytes(session_private_key.public_key)).decode("ascii")
+                    self.url.body = json.dumps(body).encode("utf8")
+                # offer msgpack if it is installed, the platform falls back to JSON otherwise
+                self.ws = await websocket_connect(self.url, subprotocols=["msgpack"] if msgpack is not None else None,
+                                                  compression_options=global_vars.websocket_compression)
+                self.binary = self.ws.selected_subprotocol == "msgpack"
                 print("connected to platform")
                 break
             except ConnectionRefusedError:
@@ -53,6 +74,27 @@ class Client(object):
                 sleep(3)
                 continue
         self.run()
+        if global_vars.session_auth:
+            await self.authenticate_session(session_private_key)
+
+    async def authenticate_session(self, session_private_key):
+        # prove the identity once with the signing key, afterwards the messages only carry a MAC
+        module_public_key = bytes(session_private_key.public_key)
+        platform_public_key = base64.b64decode(self.ws.headers["X-Session-Public-Key"])
+        transcript = signing.session_transcript("<your_module_name_here>", module_public_key, platform_public_key)
+        signature = signing.get_signing_key().sign(transcript).signature
+
+        resolve_id = str(uuid.uuid4())
+        fut = get_event_loop().create_future()
+        self.futures[resolve_id] = fut
+        self.ws.write_message(self.encode({"type": "session_auth",
+                                           "signature": signature if self.binary else base64.b64encode(signature).decode("ascii"),
+                                           "resolve_id": resolve_id}), binary=self.binary)
+        response = await fut
+        if not response["success"]:
+            raise RuntimeError("Platform could not authenticate the session")
+        self.session_key = signing.derive_session_key(session_private_key, platform_public_key, transcript)
+        self.seq = 0
 
     @gen.coroutine
     def run(self):
@@ -65,11 +107,23 @@ class Client(object):
             else:
                 self.on_message(msg)
 
+    def decode(self, msg):
+        if self.binary:
+            return msgpack.unpackb(msg, raw=False)
+        return tornado.escape.json_decode(msg)
+
+    def encode(self, message):
+        if self.binary:
+            return msgpack.packb(message, use_bin_type=True)
+        return tornado.escape.json_encode(message)
+
     def on_message(self, msg):
-        json_message = tornado.escape.json_decode(msg)
+        json_message = self.decode(msg)
         print(
             "<your_module_name_here> received message: \n {}".format(json_message))
+        self.handle_message(json_message)
 
+    def handle_message(self, json_message):
         if "type" in json_message:
             if json_message["type"] == "signature_verification_error":
                 raise RuntimeError("Platform could not validate signature")
@@ -79,32 +133,84 @@ class Client(object):
             elif json_message["type"] == "user_logout":
                 pass
 
+            elif json_message["type"] == "batch_response":
+                resolve_ids = self.batches.pop(json_message["resolve_id"], [])
+                if json_message["success"]:
+                    # the responses to all messages of the batch arrive in one frame
+                    for response in json_message["responses"]:
+                        self.handle_message(response)
+                else:
+                    for resolve_id in resolve_ids:
+                        fut = self.futures.pop(resolve_id, None)
+                        if fut is not None:
+                            fut.set_result(json_message)
+
             else:
-                resolve_id = json_message['resolve_id']
-                if resolve_id in self.futures:
-                    self.futures[resolve_id].set_result(json_message)
+                fut = self.futures.pop(json_message['resolve_id'], None)
+                if fut is not None:
+                    fut.set_result(json_message)
 
     def write(self, message):
+        resolve_id = self.send(message)
+
+        loop = get_event_loop()
+        fut = loop.create_future()
+        self.futures[resolve_id] = fut
+
+        return fut
+
+    def send(self, message):
+        """
+        sign (or MAC) and send a message without waiting for its response, returns its resolve_id
+        """
         message['origin'] = "<your_module_name_here>"
         resolve_id = str(uuid.uuid4())
         message['resolve_id'] = resolve_id
-        sign_key = signing.get_signing_key()
-        msg_str = tornado.escape.json_encode(message)
-        signed = sign_key.sign(msg_str.encode(
-            "utf8"), encoder=nacl.encoding.Base64Encoder)
-        signed_str = signed.decode("utf8")
+        if self.session_key is not None:
+            self.seq += 1
+            payload = self.encode(message)
+            mac = signing.session_mac(self.session_key, self.seq, tornado.escape.utf8(payload))
+            self.ws.write_message(self.encode({"origin": "<your_module_name_here>",
+                                               "seq": self.seq,
+                                               "msg": payload,
+                                               "mac": mac if self.binary else base64.b64encode(mac).decode("ascii")}), binary=self.binary)
+            return resolve_id
 
-        wrapped_message = {"signed_msg": signed_str,
+        sign_key = signing.get_signing_key()
+        if self.binary:
+            # msgpack can carry the signed bytes as they are
+            signed_msg = bytes(sign_key.sign(self.encode(message)))
+        else:
+            msg_str = tornado.escape.json_encode(message)
+            signed = sign_key.sign(msg_str.encode(
+                "utf8"), encoder=nacl.encoding.Base64Encoder)
+            signed_msg = signed.decode("utf8")
+
+        wrapped_message = {"signed_msg": signed_msg,
                            "origin": "<your_module_name_here>",
                            "resolve_id": resolve_id}
 
-        self.ws.write_message(tornado.escape.json_encode(wrapped_message))
+        self.ws.write_message(self.encode(wrapped_message), binary=self.binary)
 
-        loop = get_event_loop()
-        fut = loop.create_future()
-        self.futures[resolve_id] = fut
+        return resolve_id
 
-        return fut
+    def write_batch(self, messages):
+        """
+        send several messages in one frame with only one signature, returns a future per message
+        """
+        loop = get_event_loop()
+        futures = []
+        for message in messages:
+            message['resolve_id'] = str(uuid.uuid4())
+            fut = loop.create_future()
+            self.futures[message['resolve_id']] = fut
+            futures.append(fut)
+
+        # only the messages of the batch get a future, the batch_response resolves them
+        batch_resolve_id = self.send({"type": "batch", "messages": messages})
+        self.batches[batch_resolve_id] = [message['resolve_id'] for message in messages]
+
+        return futures
 
     async def keep_alive(self):
         if self.ws is None:
@@ -1,6 +1,17 @@
 # don't change any of those values manually, they will be populated from the config when the application starts
 
+from typing import Optional
+
 from keycloak import KeycloakAdmin, KeycloakOpenID
+
+from admin_events import AdminEventPoller
+from async_keycloak import AsyncKeycloak
+from session_store import SessionStore
+from token_validation import TokenValidator
+from ttl_cache import TTLCache
+from user_directory import UserDirectory
+from verification_pool import VerificationPool
+from verify_key_store import VerifyKeyStore
 port: int = 0  # port the platform is running on
 config_path: str  = ""  # path to config.json
 domain: str = ""  # domain the platform is running on (important for shared cookies with the modules)
@@ -9,6 +20,30 @@ routing: dict = {}  # received from config, holds URI's to modules
 templates_dir: str = ""  # path to module templates 
 keycloak = KeycloakOpenID  # only as dummies for IDE function suggestions (correct classes with params will be set from main.py when executing the platform)
 keycloak_admin = KeycloakAdmin
+async_keycloak = AsyncKeycloak  # non-blocking facade for keycloak and keycloak_admin, use this one inside of handlers
 keycloak_client_id: str = ""
 keycloak_callback_url: str = ""  # url that is send to keycloak as a callback
 cookie_secret: str = "" # tornado cookie secret
+token_validator: Optional[TokenValidator] = None  # validates access tokens locally against the JWKS, None if offline validation is disabled
+token_refresh_window: int = 60  # seconds before the expiry of an access token in which it gets refreshed
+token_cache: Optional[TTLCache] = None  # caches validated sessions (keyed by a hash of the access token), None if disabled
+stale_session_cache: Optional[TTLCache] = None  # last known-good validation of sessions, served while keycloak is unavailable
+stale_session_grace_period: int = 300  # seconds a last known-good validation may be served while keycloak is unavailable
+session_store: Optional[SessionStore] = None  # server-side sessions, None if the token is stored in the cookie instead
+user_directory = UserDirectory  # in-memory copy of keycloak's users and groups, answers user lookups of the handlers
+permission_cache: Optional[TTLCache] = None  # caches user lookups of check_permission and co. by username (None for unknown users), None if disabled
+permission_cache_negative_ttl: int = 30  # seconds an unknown user is remembered as unknown
+module_load_balancing: str = "round_robin"  # how messages to a module with several replicas are balanced: "round_robin" or "least_outstanding"
+message_module_timeout: float = 30  # seconds a module has to answer a message_module before the sender gets a timeout response
+outbound_queue_size: int = 1000  # maximum number of messages queued for a module connection
+outbound_queue_bytes: int = 16 * 1024 * 1024  # maximum number of bytes queued for a module connection
+slow_consumer_policy: str = "drop_oldest"  # what happens if the queue of a module is full: "drop_oldest", "block" or "disconnect"
+websocket_compression: Optional[dict] = None  # permessage-deflate options of the module websockets ("compression_level", "mem_level", "min_size"), None disables compression
+max_batch_size: int = 100  # maximum number of messages in one batch message
+max_lookup_usernames: int = 100  # maximum number of usernames in one get_users or check_permissions message
+user_lookup_concurrency: int = 4  # maximum number of concurrent keycloak requests of one get_users or check_permissions message
+verify_key_store: VerifyKeyStore = VerifyKeyStore()  # verify keys of the modules (verify_keys.json), kept in memory
+verification_pool: Optional[VerificationPool] = None  # verifies message signatures off the IOLoop, None to verify them inline
+allow_signed_messages: bool = True  # accept connections that sign every message, instead of authenticating a session once
+broadcast_user_logout: bool = True  # send user_logout to all modules, or only publish it to the subscribers of "platform.user_logout"
+admin_event_poller: Optional[AdminEventPoller] = None  # keeps user_directory up to date from keycloak's admin events, None if disabled
@@ -1,10 +1,10 @@
 from abc import ABCMeta
-import json
 
+from keycloak.exceptions import KeycloakConnectionError
 import tornado.web
 
 import global_vars
-from handlers.base_handler import BaseHandler
+from handlers.base_handler import BaseHandler, end_session, invalidate_cached_sessions, reject_keycloak_unavailable, stamp_token, start_session
 from logger_factory import log_access
 
 
@@ -42,14 +42,17 @@ class LoginCallbackHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
 
         #exchange authorization code for token
         # (redirect_uri has to match the uri in keycloak.auth_url(...) as per openID standard)
-        token = global_vars.keycloak.token(code=code, grant_type=[
-                                           "authorization_code"], redirect_uri=global_vars.keycloak_callback_url)
+        try:
+            token = await global_vars.async_keycloak.token(code=code, grant_type=[
+                                                           "authorization_code"], redirect_uri=global_vars.keycloak_callback_url)
+        except KeycloakConnectionError as e:
+            # keycloak is unreachable (or the circuit breaker is open)
+            reject_keycloak_unavailable(self, e)
+            return
 
-        # dump token dict to str and store it in a secure cookie (BaseHandler will decode it later to validate a user is logged in)
-        if global_vars.domain == "localhost":
-            self.set_secure_cookie("access_token", json.dumps(token))
-        else:
-            self.set_secure_cookie("access_token", json.dumps(token), domain="." + global_vars.domain)
+        # store the token (in a secure cookie or the session store, BaseHandler will load it later to validate a user is logged in)
+        # together with its expiry, so that BaseHandler only has to refresh it shortly before it expires
+        start_session(self, stamp_token(token))
 
         self.redirect("/main")
 
@@ -60,7 +63,7 @@ class LogoutHandler(BaseHandler, metaclass=ABCMeta):
     """
 
     @log_access
-    def post(self):
+    async def post(self):
         """
         POST request of /logout
             perform logout, i.e. clear the token cache entry and delete the cookie
@@ -70,13 +73,13 @@ class LogoutHandler(BaseHandler, metaclass=ABCMeta):
             n/a
         """
 
-        if global_vars.domain == "localhost":
-            self.clear_cookie("access_token")
-        else:
-            self.clear_cookie("access_token", domain="." + global_vars.domain)
+        end_session(self)
 
         # perform logout in keycloak
-        global_vars.keycloak.logout(self._access_token["refresh_token"])
+        await global_vars.async_keycloak.logout(self._access_token["refresh_token"])
+
+        # the session is gone, so are the cached validation results of it
+        invalidate_cached_sessions(user_id=self.current_user)
 
         self.set_status(200)
         self.write({"status": 200,
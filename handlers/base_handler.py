@@ -1,12 +1,137 @@
 from abc import ABCMeta
+import hashlib
 import json
+import time
+from typing import Optional, Tuple
 
 from keycloak import KeycloakGetError
-from keycloak.exceptions import KeycloakError
+from keycloak.exceptions import KeycloakConnectionError, KeycloakError
 from tornado.options import options
 import tornado.web
 
 import global_vars
+from logger_factory import get_logger
+
+logger = get_logger(__name__)
+
+
+# seconds before the expiry of a token in which validation results are no longer reused
+TOKEN_EXPIRY_MARGIN = 30
+
+
+def token_cache_key(access_token: str) -> str:
+    """
+    derive the key of a session in the token cache from its access token, so the token itself is not held as a key
+    """
+
+    return hashlib.sha256(access_token.encode("utf8")).hexdigest()
+
+
+def invalidate_cached_sessions(username: Optional[str] = None, user_id: Optional[str] = None) -> None:
+    """
+    drop cached validation results of a user (e.g. after a logout), or all cached validation results if no user is given
+    """
+
+    def matches_user(userinfo: dict) -> bool:
+        return (user_id is not None and userinfo.get("sub") == user_id) \
+            or (username is not None and userinfo.get("preferred_username") == username)
+
+    if global_vars.session_store is not None:
+        global_vars.session_store.invalidate_userinfo(None if username is None and user_id is None else matches_user)
+
+    for cache in (global_vars.token_cache, global_vars.stale_session_cache):
+        if cache is None:
+            continue
+        if username is None and user_id is None:
+            cache.clear()
+        else:
+            cache.invalidate_where(lambda key, value: matches_user(value[0]))
+
+
+def stamp_token(token: dict) -> dict:
+    """
+    record when a token was issued and when its access token expires (as unix timestamps),
+    keycloak only tells us the lifetime in seconds
+
+    :param token: the token dict as returned by keycloak
+
+    :return: a copy of the token dict with added "issued_at" and "expires_at" keys
+    """
+
+    now = int(time.time())
+    stamped = dict(token, issued_at=now, expires_at=now + int(token.get("expires_in", 0)))
+    # offline tokens have no refresh expiry (refresh_expires_in == 0)
+    if token.get("refresh_expires_in"):
+        stamped["refresh_expires_at"] = now + int(token["refresh_expires_in"])
+    return stamped
+
+
+def needs_refresh(token: dict) -> bool:
+    """
+    check if the access token expires soon (i.e. is inside of the refresh window) and should therefore be refreshed.
+    tokens that were not stamped (see stamp_token) always need a refresh
+    """
+
+    if "expires_at" not in token:
+        return True
+    return time.time() >= token["expires_at"] - global_vars.token_refresh_window
+
+
+def cookie_options() -> dict:
+    """
+    cookies have to be shared with the modules on the same domain (except when running on localhost)
+    """
+
+    if global_vars.domain == "localhost":
+        return {}
+    return {"domain": "." + global_vars.domain}
+
+
+def set_token_cookie(handler: tornado.web.RequestHandler, token: dict) -> None:
+    """
+    dump token dict to str and store it in a secure cookie (BaseHandler will decode it later to validate a user is logged in)
+    """
+
+    handler.set_secure_cookie("access_token", json.dumps(token), **cookie_options())
+
+
+def start_session(handler: tornado.web.RequestHandler, token: dict) -> None:
+    """
+    store the token of a freshly logged in user. If a session store is configured, the token stays on the server
+    and the browser only gets the session id, otherwise the whole token is stored in the cookie
+    """
+
+    if global_vars.session_store is not None:
+        session_id = global_vars.session_store.create(token)
+        handler.set_secure_cookie("session_id", session_id, **cookie_options())
+    else:
+        set_token_cookie(handler, token)
+
+
+def end_session(handler: tornado.web.RequestHandler) -> None:
+    """
+    delete the session of the current user (cookie and, if there is one, its entry in the session store)
+    """
+
+    if global_vars.session_store is not None:
+        session_id = handler.get_secure_cookie("session_id")
+        if session_id is not None:
+            global_vars.session_store.delete(session_id.decode())
+        handler.clear_cookie("session_id", **cookie_options())
+    handler.clear_cookie("access_token", **cookie_options())
+
+
+def reject_keycloak_unavailable(handler: tornado.web.RequestHandler, e: KeycloakConnectionError) -> None:
+    """
+    answer a request that needs keycloak while it is unreachable (or the circuit breaker is open) with a 503,
+    telling the client to retry once the circuit breaker lets calls through again
+    """
+
+    logger.info("Keycloak unavailable, rejecting request: {}".format(e))
+    handler.set_status(503)
+    handler.set_header("Retry-After", str(int(global_vars.async_keycloak.circuit_breaker.open_duration)))
+    handler.finish({"status": 503,
+                    "reason": "keycloak_unavailable"})
 
 
 class BaseHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
@@ -39,24 +164,59 @@ class BaseHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
                                   'scope': 'email profile'}
             return
 
-        # grab token from cookie, if there is none, redirect to login
-        token = self.get_secure_cookie("access_token")
-        if token is not None:
-            token = json.loads(token)
-        else:
+        # grab token from cookie (or the session store), if there is none, redirect to login
+        token = self._load_token()
+        if token is None:
             self.redirect("/login")
             return
 
+        # the same session was validated shortly before (e.g. admin page firing multiple requests), reuse that result
+        self._token_cache_key = token_cache_key(token['access_token'])
+        cached = self._get_cached_validation()
+        if cached is not None:
+            userinfo, token = cached
+            self.current_user = userinfo["sub"]
+            self.current_userinfo = userinfo
+            self._access_token = token
+            return
+
         try:
-            # try to refresh the token and fetch user info. this will fail if there is no valid session
-            token = global_vars.keycloak.refresh_token(token['refresh_token'])
-            userinfo = global_vars.keycloak.introspect(token['access_token'])
+            userinfo = None
+            # the access token is still valid for a while, there is no need to refresh it yet
+            if not needs_refresh(token):
+                userinfo = await self._validate_access_token(token['access_token'])
+
+            if not (userinfo and userinfo.get("active", False)):
+                # try to refresh the token and fetch user info. this will fail if there is no valid session
+                token = stamp_token(await global_vars.async_keycloak.refresh_token(token['refresh_token']))
+                userinfo = await self._validate_access_token(token['access_token'])
+                if userinfo and userinfo.get("active", False):
+                    # write the refreshed token back, so that the following requests don't have to refresh again
+                    self._store_token(token)
+                    self._token_cache_key = token_cache_key(token['access_token'])
+
             # if token is still valid --> successfull authentication --> we set the current_user
-            if userinfo:
+            if userinfo and userinfo.get("active", False):
                 # set current_user as user id for legacy reasons, TODO might be able to get rid of that
                 self.current_user = userinfo["sub"]
                 self.current_userinfo = userinfo
                 self._access_token = token
+                self._cache_validation(userinfo, token)
+        except KeycloakConnectionError as e:
+            # keycloak is unreachable (or the circuit breaker is open): serve recently validated sessions from their
+            # last known-good userinfo, instead of sending everyone to a login that would fail anyway
+            stale = self._get_stale_validation()
+            if stale is not None:
+                userinfo, token = stale
+                self.current_user = userinfo["sub"]
+                self.current_userinfo = userinfo
+                self._access_token = token
+                return
+
+            self.current_user = None
+            self.current_userinfo = None
+            self._access_token = None
+            reject_keycloak_unavailable(self, e)
         except KeycloakGetError as e:
             print(e)
             # something wrong with request
@@ -76,6 +236,107 @@ class BaseHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
             self._access_token = None
             self.redirect("/login")
 
+    def _load_token(self) -> Optional[dict]:
+        """
+        get the token of the current user, either from the session store (via the session id cookie) or from the token cookie
+
+        :return: the token dict, or None if there is no session
+        """
+
+        self._session_id = None
+        if global_vars.session_store is not None:
+            session_id = self.get_secure_cookie("session_id")
+            if session_id is None:
+                return None
+            self._session_id = session_id.decode()
+            session = global_vars.session_store.get(self._session_id)
+            return session["token"] if session is not None else None
+
+        token = self.get_secure_cookie("access_token")
+        return json.loads(token) if token is not None else None
+
+    def _store_token(self, token: dict) -> None:
+        """
+        write a (refreshed) token back to where _load_token got it from
+        """
+
+        if self._session_id is not None:
+            global_vars.session_store.update_token(self._session_id, token)
+        else:
+            set_token_cookie(self, token)
+
+    def _get_cached_validation(self) -> Optional[Tuple[dict, dict]]:
+        """
+        :return: (userinfo, token) of a recent successful validation of the current session, or None if there is none
+        """
+
+        if self._session_id is not None:
+            session = global_vars.session_store.get(self._session_id)
+            if session is not None and session["userinfo"] is not None and time.time() < session["validated_until"]:
+                return session["userinfo"], session["token"]
+            return None
+
+        if global_vars.token_cache is not None:
+            return global_vars.token_cache.get(self._token_cache_key)
+        return None
+
+    def _get_stale_validation(self) -> Optional[Tuple[dict, dict]]:
+        """
+        :return: (userinfo, token) of the last successful validation of the current session, if it happened within the
+                 grace period, or None otherwise
+        """
+
+        if self._session_id is not None:
+            session = global_vars.session_store.get(self._session_id)
+            if session is not None and session["userinfo"] is not None \
+                    and time.time() - session["validated_at"] < global_vars.stale_session_grace_period:
+                return session["userinfo"], session["token"]
+            return None
+
+        if global_vars.stale_session_cache is not None:
+            return global_vars.stale_session_cache.get(self._token_cache_key)
+        return None
+
+    def _cache_validation(self, userinfo: dict, token: dict) -> None:
+        """
+        remember a successful validation of the session, but no longer than until shortly before the validated token expires
+        """
+
+        if self._session_id is not None:
+            # always stored, the session also serves as the last known-good state in case keycloak becomes unavailable
+            ttl = global_vars.session_store.userinfo_ttl
+            if "exp" in userinfo:
+                ttl = min(ttl, userinfo["exp"] - time.time() - TOKEN_EXPIRY_MARGIN)
+            global_vars.session_store.set_userinfo(self._session_id, userinfo, time.time() + ttl)
+            return
+
+        # last known-good state of the session, in case keycloak becomes unavailable
+        if global_vars.stale_session_cache is not None:
+            global_vars.stale_session_cache.set(self._token_cache_key, (userinfo, token))
+
+        if global_vars.token_cache is None:
+            return
+        ttl = global_vars.token_cache.ttl
+        if "exp" in userinfo:
+            ttl = min(ttl, userinfo["exp"] - time.time() - TOKEN_EXPIRY_MARGIN)
+        global_vars.token_cache.set(self._token_cache_key, (userinfo, token), ttl=ttl)
+
+    async def _validate_access_token(self, access_token: str) -> dict:
+        """
+        validate the access token locally against the cached JWKS if offline validation is enabled,
+        and fall back to introspection at keycloak if that is not possible (e.g. unknown key id)
+
+        :param access_token: the encoded access token
+
+        :return: the userinfo (i.e. the token claims), containing "active": False if the token is not valid
+        """
+
+        if global_vars.token_validator is not None:
+            userinfo = global_vars.token_validator.validate(access_token)
+            if userinfo is not None:
+                return userinfo
+        return await global_vars.async_keycloak.introspect(access_token)
+
     def is_current_user_admin(self):
         if not self.current_userinfo:
             return False
@@ -1,60 +1,267 @@
-import json
+import asyncio
+import base64
+import binascii
+from collections import deque
+import contextvars
+import inspect
 from abc import ABCMeta
-from typing import Dict, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
 import os
 
 from keycloak.exceptions import KeycloakError
-import nacl.encoding
-import nacl.exceptions
-import nacl.signing
 import tornado.escape
+import tornado.ioloop
 from tornado.options import options
+import tornado.web
 import tornado.websocket
 
 import global_vars
+from handlers.base_handler import invalidate_cached_sessions
 from logger_factory import get_logger
+from message_codec import JSON, SUBPROTOCOLS
+from session_auth import SESSION_PUBLIC_KEY_HEADER, ModuleSession
+from verification_pool import verify_signed_message
 
 logger = get_logger(__name__)
 
+_NOT_CACHED = object()
+
+
+async def lookup_user(username: str) -> Optional[dict]:
+    """
+    look up a user through the permission cache, which also remembers users that don't exist
+    (so that modules asking for them over and over again don't reach keycloak every time)
+
+    :return: {"id", "email", "username", "role"} of the user, or None if the user does not exist
+    """
+
+    cache = global_vars.permission_cache
+    if cache is not None:
+        user_payload = cache.get(username.lower(), _NOT_CACHED)
+        if user_payload is not _NOT_CACHED:
+            return user_payload
+
+    user_payload = await global_vars.user_directory.lookup(username)
+    if cache is not None:
+        cache.set(username.lower(), user_payload, ttl=None if user_payload is not None else global_vars.permission_cache_negative_ttl)
+    return user_payload
+
+
+def invalidate_cached_permissions(username: Optional[str] = None, user_id: Optional[str] = None) -> None:
+    """
+    drop the cached permission decision of a user (e.g. after a logout or a role change), or all of them if no user is given
+    """
+
+    if global_vars.permission_cache is None:
+        return
+    if username is None and user_id is None:
+        global_vars.permission_cache.clear()
+        return
+    global_vars.permission_cache.invalidate_where(
+        lambda key, value: (username is not None and key == username.lower()) or (user_id is not None and value is not None and value["id"] == user_id))
+
+
+class MessageType(NamedTuple):
+    """
+    a message type the WebsocketHandler understands, see WebsocketHandler.register_message_type()
+    """
+
+    handler: Callable[["WebsocketHandler", dict], Optional[Awaitable[None]]]
+    required_keys: Sequence[str]
+    response_type: str
+
+
+class BatchCollector:
+    """
+    collects the responses to the messages of a batch while they are dispatched, see WebsocketHandler._batch()
+    """
+
+    def __init__(self, connection: "WebsocketHandler"):
+        self.connection = connection
+        self.responses: List[dict] = []
+        self.done = False  # callbacks scheduled during the batch (e.g. timeouts) must not collect into it afterwards
+
+
+# the collector of the batch that is dispatched in the current context. Being a context variable, it only applies to
+# the handler calls of that batch, not to messages of other connections that are handled in the meantime
+_batch_collector: contextvars.ContextVar[Optional[BatchCollector]] = contextvars.ContextVar("batch_collector", default=None)
+
+
+class PendingRequest(NamedTuple):
+    """
+    a message_module that was forwarded to a module and awaits its message_module_response
+    """
+
+    origin: "WebsocketHandler"
+    timeout: object  # handle of the IOLoop timeout that answers the origin if the response doesn't arrive in time
+
 
 class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
     """
-    handles communication with the modules
+    handles communication with the modules.
+    Incoming messages are dispatched by their "type" to the handler registered for it (see register_message_type()),
+    several messages can be sent in one "batch" message and are answered in one combined "batch_response".
+    A module can run several replicas (connections with the same module name), messages to the module are balanced
+    across them and their responses are routed back to the exact connection the message originated from.
+    Outgoing messages go through a bounded send queue per connection, a module that doesn't keep up with reading them
+    is handled according to global_vars.slow_consumer_policy.
+    Modules can subscribe to topics ("user.logout") or topic prefixes ("user.*", "*" for all topics), events published
+    to a topic are only delivered to its subscribers.
+    Messages are JSON, unless the module negotiates another codec as websocket subprotocol (e.g. "msgpack", see message_codec).
+    If configured (global_vars.websocket_compression), messages of at least "min_size" bytes are sent compressed (permessage-deflate).
+    Modules either sign every message, or authenticate once per connection and send MACs afterwards (see session_auth.ModuleSession).
 
     """
 
     connections = set()
+    modules: Dict[str, List["WebsocketHandler"]] = {}  # module name -> its open connections
+    started_modules: Dict[str, List["WebsocketHandler"]] = {}  # module name (of module_start) -> connections that started it
+    message_types: Dict[str, MessageType] = {}
+    _round_robin: Dict[str, int] = {}  # module name -> counter to pick the next replica
+    subscribers: Dict[str, Set["WebsocketHandler"]] = {}  # topic -> connections subscribed to exactly this topic
+    prefix_subscribers: Dict[str, Set["WebsocketHandler"]] = {}  # topic prefix ("user." for "user.*") -> subscribed connections
+
+    @classmethod
+    def register_message_type(cls, message_type: str, handler: Callable[["WebsocketHandler", dict], Optional[Awaitable[None]]],
+                              required_keys: Sequence[str] = (), response_type: Optional[str] = None) -> None:
+        """
+        register a handler for a message type, e.g. by plugins at startup. The handler is called with the WebsocketHandler
+        of the connection and the message, it can be a plain function or a coroutine function and is responsible
+        for answering the message (usually via write_message()).
+        Messages that miss one of the required keys are answered with a message_format_error without calling the handler.
+
+        :param message_type: value of the "type" key of the messages to handle
+        :param handler: the function handling the messages
+        :param required_keys: keys that have to be present in the message (besides "type" and "resolve_id")
+        :param response_type: "type" of the error response if a required key is missing, defaults to "<message_type>_response"
 
-    def _verify_msg(self, message: str) -> Optional[Dict]:
+        :raises ValueError: if the message type is already registered
+        """
+
+        if message_type in cls.message_types:
+            raise ValueError("Message type '{}' is already registered".format(message_type))
+        cls.message_types[message_type] = MessageType(handler, tuple(required_keys), response_type or message_type + "_response")
+
+    async def _verify_msg(self, message: Union[bytes, str]) -> Optional[Dict]:
         """
         verify that the signature of a message is from a module that is known (i.e. its verify_key is in verify_keys.json
         and the message signature validates.
+        With a binary codec, "signed_msg" is the raw signed message instead of its base64 encoding.
+        If configured, the signature is verified in the global_vars.verification_pool instead of on the IOLoop.
 
         :param message: the message to verify
 
-        :return: the original message body as a dict (decoded json string), if the signature validates, or None otherwise
+        :return: the original message body as a dict (decoded with the codec of the connection), if the signature validates, or None otherwise
+
+        """
+
+        message = self.codec.decode(message)
+
+        verify_key = global_vars.verify_key_store.get(message["origin"])
+        if verify_key is None:
+            return None
 
+        # verify message signature, None if it doesn't validate
+        if global_vars.verification_pool is not None:
+            # on_message is awaited before the next message of the connection is read, so the order of its messages is kept
+            verified = await global_vars.verification_pool.verify(verify_key, message["signed_msg"], base64_encoded=not self.codec.binary)
+        else:
+            verified = verify_signed_message(verify_key, message["signed_msg"], base64_encoded=not self.codec.binary)
+        if verified is None:
+            return None
+        original_message = self.codec.decode(verified)
+        if original_message["origin"] == message["origin"]:
+            return original_message
+        return None
+
+    def _verify_session_msg(self, message: Union[bytes, str]) -> Optional[Dict]:
         """
+        verify a message of an authenticated session: {"origin", "seq", "msg": the encoded message, "mac"}.
+        With a binary codec, "mac" is raw bytes instead of base64.
 
-        message = tornado.escape.json_decode(message)
-        with open("verify_keys.json", "r") as fp:
-            verify_keys = json.load(fp)
+        :return: the original message body as a dict, if the MAC validates, or None otherwise
+        """
 
-        origin = message["origin"]
-        if origin in verify_keys:
-            verify_key_b64 = verify_keys[origin].encode("utf8")
-            verify_key = nacl.signing.VerifyKey(
-                verify_key_b64, encoder=nacl.encoding.Base64Encoder)
-            try:  # verify message signatrue
-                verified = verify_key.verify(
-                    message["signed_msg"], encoder=nacl.encoding.Base64Encoder)
-                original_message = tornado.escape.json_decode(
-                    verified.decode("utf8"))
-                if original_message["origin"] == message["origin"]:
-                    return original_message
-            # if the signature does it verify, BadSignatureError is thrown automatically
-            except nacl.exceptions.BadSignatureError:
+        message = self.codec.decode(message)
+        try:
+            payload = tornado.escape.utf8(message["msg"])
+            mac = message["mac"] if self.codec.binary else base64.b64decode(message["mac"])
+            if not self.session.verify(message["seq"], payload, mac):
                 return None
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            return None
+        original_message = self.codec.decode(payload)
+        if original_message.get("origin") != self.session.module_name:
+            return None
+        return original_message
+
+    async def _authenticate_session(self, message: Union[bytes, str]) -> None:
+        """
+        the first message of a connection in session mode: {"type": "session_auth", "signature", "resolve_id"}, where
+        signature is the module's signature over session_auth.session_transcript() (base64, raw bytes with a binary codec)
+        """
+
+        json_message = self.codec.decode(message)
+        verify_key = global_vars.verify_key_store.get(self.module_name)
+        try:
+            signature = json_message["signature"] if self.codec.binary else base64.b64decode(json_message["signature"])
+            authenticated = verify_key is not None and self.session.authenticate(self.module_name, signature, verify_key)
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            authenticated = False
+
+        if not authenticated:
+            logger.info("Session authentication failed for: {}".format(self.module_name))
+            # sent right away instead of queued, the connection is closed afterwards
+            self._clear_send_queue()
+            try:
+                await self._write_frame(self.codec.encode({"type": "session_auth_response",
+                                                           "success": False,
+                                                           "reason": "authentication_failed",
+                                                           "resolve_id": json_message.get("resolve_id") if isinstance(json_message, dict) else None}),
+                                        self.codec.binary)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+            self.close(1008, "authentication failed")
+            return
+
+        self.write_message({"type": "session_auth_response",
+                            "success": True,
+                            "resolve_id": json_message.get("resolve_id")})
+
+    def prepare(self):
+        """
+        modules that authenticate once per connection send their ephemeral public key with the connect request,
+        the platform's ephemeral public key is sent back in a header of the handshake response
+        """
+
+        self.session: Optional[ModuleSession] = None
+        try:
+            session_public_key = tornado.escape.json_decode(self.request.body).get("session_public_key")
+            if session_public_key is not None:
+                self.session = ModuleSession(base64.b64decode(session_public_key))
+        except (AttributeError, TypeError, ValueError, binascii.Error):
+            raise tornado.web.HTTPError(400, "Invalid session_public_key")
+        if self.session is not None:
+            self.set_header(SESSION_PUBLIC_KEY_HEADER, base64.b64encode(self.session.public_key).decode("ascii"))
+
+    def get_compression_options(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: the permessage-deflate options for the connection, or None to disable compression
+        """
+
+        if global_vars.websocket_compression is None:
+            return None
+        return {key: value for key, value in global_vars.websocket_compression.items() if key in ("compression_level", "mem_level")}
+
+    def select_subprotocol(self, subprotocols: List[str]) -> Optional[str]:
+        """
+        choose the codec of the connection from the subprotocols the module offers, without one the connection uses JSON
+        """
+
+        for subprotocol in SUBPROTOCOLS:
+            if subprotocol in subprotocols:
+                return subprotocol
+        return None
 
     def open(self):
         """
@@ -64,55 +271,371 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
 
         msg = tornado.escape.json_decode(self.request.body)
         self.module_name = msg["module"]
+        self.codec = SUBPROTOCOLS.get(self.selected_subprotocol, JSON)
+        self.started_as: Optional[str] = None  # module name of this connection's module_start
+        self.port = None
+        # messages forwarded to this connection that await a response: (origin module name, resolve_id) -> PendingRequest
+        self.outstanding: Dict[Tuple[str, str], PendingRequest] = {}
+        self._send_queue: deque = deque()  # (payload, binary)
+        self._blocked: deque = deque()  # (payload, binary, future resolved once queued) waiting for space in the queue ("block" policy)
+        self._queued_bytes = 0
+        self._blocked_bytes = 0
+        self._draining = False
+        self.dropped = 0
+        self.topics: Set[str] = set()  # topics (and wildcard topics) this connection subscribed to
         self.connections.add(self)
+        self.modules.setdefault(self.module_name, []).append(self)
         logger.info("Client connected: {}".format(self.module_name))
+        if self.session is None and not global_vars.allow_signed_messages and not options.test:
+            # only connections that authenticate a session are accepted
+            self.close(1008, "session authentication required")
 
     def on_close(self):
         """
         callback if the connection has been closed by the client. delete it from the connections set.
 
         """
-        try:
-            del global_vars.servers[self.module_name]
-        except KeyError:
+        if self.started_as is not None:
+            replicas = self.started_modules[self.started_as]
+            replicas.remove(self)
+            if replicas:
+                self._update_server_entry(self.started_as)
+            else:
+                del self.started_modules[self.started_as]
+                del global_vars.servers[self.started_as]
+        else:
             logger.info("Client {} was never registered as started module (probably never sent a valid module_start message?)".format(self.module_name))
+
+        self.modules[self.module_name].remove(self)
+        if not self.modules[self.module_name]:
+            del self.modules[self.module_name]
+            self._round_robin.pop(self.module_name, None)
         self.connections.remove(self)
+        self._clear_send_queue()
+        for topic in list(self.topics):
+            self.unsubscribe(topic)
+
+        # nobody is going to answer the messages that were forwarded to this connection anymore
+        for key in list(self.outstanding):
+            self._fail_pending(key, "module_offline")
         logger.info("Client disconnected: {}".format(self.module_name))
 
     @classmethod
-    def broadcast_message(cls, message: Union[bytes, str, Dict]):
+    def _update_server_entry(cls, module_name: str) -> None:
+        replicas = cls.started_modules[module_name]
+        global_vars.servers[module_name] = {"port": replicas[0].port, "replicas": len(replicas)}
+
+    def _fail_pending(self, key: Tuple[str, str], reason: str) -> None:
+        """
+        answer the origin of a message that was forwarded to this connection with a failed message_module_response
+        """
+
+        pending = self.outstanding.pop(key, None)
+        if pending is None:
+            return
+        tornado.ioloop.IOLoop.current().remove_timeout(pending.timeout)
+        if pending.origin in self.connections:
+            try:
+                pending.origin.write_message({"type": "message_module_response",
+                                              "success": False,
+                                              "reason": reason,
+                                              "resolve_id": key[1]})
+            except tornado.websocket.WebSocketClosedError:
+                # the origin is closing right now, it doesn't wait for the response anymore
+                pass
+
+    @classmethod
+    def in_flight(cls, module_name: str) -> int:
+        """
+        :return: number of messages forwarded to (all replicas of) the module that were not answered yet
+        """
+
+        return sum(len(client.outstanding) for client in cls.modules.get(module_name, []))
+
+    @classmethod
+    def pick_replica(cls, module_name: str) -> Optional["WebsocketHandler"]:
+        """
+        choose the connection of a module that a message to the module is sent to,
+        either round robin or the one with the least outstanding messages (ties are broken round robin)
+
+        :return: the connection, or None if the module is offline
+        """
+
+        replicas = cls.modules.get(module_name)
+        if not replicas:
+            return None
+
+        index = cls._round_robin.get(module_name, 0)
+        cls._round_robin[module_name] = index + 1
+        if global_vars.module_load_balancing == "least_outstanding":
+            rotated = replicas[index % len(replicas):] + replicas[:index % len(replicas)]
+            return min(rotated, key=lambda client: len(client.outstanding))
+        return replicas[index % len(replicas)]
+
+    def write_message(self, message: Union[bytes, str, Dict[str, Any]], binary: bool = False) -> "asyncio.Future[None]":
+        """
+        queue a message to be sent to the module, see tornado.websocket.WebSocketHandler.write_message() for the types.
+        Dicts are serialized with the codec of the connection, bytes and strings are sent as they are.
+        If the send queue is full, the slow consumer policy applies:
+            "drop_oldest": the oldest queued message is dropped in favour of this one
+            "block": the message waits for space in the queue, await the returned future to wait with it
+                     (at most as many messages and bytes as fit into the queue wait, beyond that the connection is closed)
+            "disconnect": the connection is closed
+
+        :raises WebSocketClosedError: if the connection is already closed
+
+        :return: a future that is resolved once the message is queued (cancelled if it never will be)
+        """
+
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            raise tornado.websocket.WebSocketClosedError()
+        collector = _batch_collector.get()
+        if collector is not None and collector.connection is self and not collector.done and isinstance(message, dict):
+            # a response to a message of the batch, sent together with the batch_response
+            collector.responses.append(message)
+            queued = asyncio.get_event_loop().create_future()
+            queued.set_result(None)
+            return queued
+        if isinstance(message, dict):
+            payload = self.codec.encode(message)
+            binary = self.codec.binary
+        else:
+            payload = tornado.escape.utf8(message)
+
+        queued = asyncio.get_event_loop().create_future()
+        if self._send_queue_full() or self._blocked:
+            if global_vars.slow_consumer_policy == "block" and not self._blocked_full():
+                self._blocked.append((payload, binary, queued))
+                self._blocked_bytes += len(payload)
+                return queued
+            if global_vars.slow_consumer_policy in ("block", "disconnect"):
+                logger.info("Closing connection to {}, it does not keep up with the messages sent to it".format(self.module_name))
+                self.dropped += 1
+                self._clear_send_queue()
+                self.close(1008, "slow consumer")
+                queued.cancel()
+                return queued
+            while self._send_queue and self._send_queue_full():
+                dropped_payload, _ = self._send_queue.popleft()
+                self._queued_bytes -= len(dropped_payload)
+                self.dropped += 1
+
+        self._enqueue(payload, binary)
+        queued.set_result(None)
+        return queued
+
+    def _send_queue_full(self) -> bool:
+        return len(self._send_queue) >= global_vars.outbound_queue_size or self._queued_bytes >= global_vars.outbound_queue_bytes
+
+    def _blocked_full(self) -> bool:
+        return len(self._blocked) >= global_vars.outbound_queue_size or self._blocked_bytes >= global_vars.outbound_queue_bytes
+
+    def _enqueue(self, payload: bytes, binary: bool) -> None:
+        self._send_queue.append((payload, binary))
+        self._queued_bytes += len(payload)
+        if not self._draining:
+            self._draining = True
+            asyncio.ensure_future(self._drain())
+
+    async def _drain(self) -> None:
+        """
+        send the queued messages one after another, each one only when the previous one was handed to the socket
+        """
+
+        try:
+            while self._send_queue:
+                payload, binary = self._send_queue.popleft()
+                self._queued_bytes -= len(payload)
+                # there is space in the queue now
+                while self._blocked and not self._send_queue_full():
+                    blocked_payload, blocked_binary, queued = self._blocked.popleft()
+                    self._blocked_bytes -= len(blocked_payload)
+                    self._send_queue.append((blocked_payload, blocked_binary))
+                    self._queued_bytes += len(blocked_payload)
+                    queued.set_result(None)
+                await self._write_frame(payload, binary)
+        except tornado.websocket.WebSocketClosedError:
+            self._clear_send_queue()
+        finally:
+            self._draining = False
+
+    def _write_frame(self, payload: bytes, binary: bool) -> "asyncio.Future[None]":
+        """
+        hand a message to the socket, messages below the configured minimum size are sent uncompressed
+        (permessage-deflate allows this per message, the receiver only inflates frames that are flagged as compressed)
+        """
+
+        connection = self.ws_connection
+        compressor = getattr(connection, "_compressor", None)
+        if compressor is None or len(payload) >= global_vars.websocket_compression.get("min_size", 0):
+            return super().write_message(payload, binary=binary)
+
+        # the compression happens synchronously in write_message()
+        connection._compressor = None
+        try:
+            return super().write_message(payload, binary=binary)
+        finally:
+            connection._compressor = compressor
+
+    def _clear_send_queue(self) -> None:
+        self._send_queue.clear()
+        self._queued_bytes = 0
+        self._blocked_bytes = 0
+        while self._blocked:
+            _, _, queued = self._blocked.popleft()
+            # the message will never be sent
+            queued.cancel()
+
+    @classmethod
+    def queue_stats(cls) -> Dict[str, dict]:
+        """
+        :return: {"<module_name>": {"connections", "queue_depth", "queued_bytes", "dropped"}} of the send queues of all modules
+        """
+
+        stats = {}
+        for module_name, clients in cls.modules.items():
+            stats[module_name] = {"connections": len(clients),
+                                  "queue_depth": sum(len(client._send_queue) + len(client._blocked) for client in clients),
+                                  "queued_bytes": sum(client._queued_bytes + client._blocked_bytes for client in clients),
+                                  "dropped": sum(client.dropped for client in clients)}
+        return stats
+
+    @classmethod
+    def broadcast_message(cls, message: Union[bytes, str, Dict]) -> "asyncio.Future[list]":
         """
         broadcast a message to all connected clients (== modules). This function can be used from outside this handler
         by using WebsocketHandler.broadcast_message(), since it is a classmethod.
+        The message is serialized only once per codec for all clients.
 
-        :param message: the message to be broadcasted. check the tornado.websocket.WebSocketHandler.write_message() for further documentation on the types
+        :param message: the message to be broadcasted, a dict or an already JSON encoded string (bytes)
 
+        :return: a future that is resolved once the message is queued for all clients
         """
 
-        for client in cls.connections:
-            client.write_message(message)
+        return asyncio.gather(*cls._fan_out(list(cls.connections), message), return_exceptions=True)
 
-    async def on_message(self, message: str):
+    @staticmethod
+    def _fan_out(clients: List["WebsocketHandler"], message: Union[bytes, str, Dict]) -> List["asyncio.Future[None]"]:
+        """
+        write a message to several clients, serializing it only once per codec
+
+        :return: the futures of write_message() of the clients the message was queued for
+        """
+
+        payloads: Dict[str, bytes] = {}
+        if not isinstance(message, dict):
+            payloads[JSON.name] = tornado.escape.utf8(message)
+            if all(client.codec is JSON for client in clients):
+                message = None
+            else:
+                # only decoded to be encoded again for the clients of other codecs
+                message = tornado.escape.json_decode(message)
+
+        queued = []
+        for client in clients:
+            payload = payloads.get(client.codec.name)
+            if payload is None:
+                payload = payloads[client.codec.name] = client.codec.encode(message)
+            try:
+                queued.append(client.write_message(payload, binary=client.codec.binary))
+            except tornado.websocket.WebSocketClosedError:
+                # client is closing right now
+                pass
+        return queued
+
+    @staticmethod
+    def _topic_index(topic: str) -> Tuple[Dict[str, Set["WebsocketHandler"]], str]:
+        """
+        :return: the index a (wildcard) topic belongs to, and its key in there
+        """
+
+        if topic == "*":
+            return WebsocketHandler.prefix_subscribers, ""
+        if topic.endswith(".*"):
+            return WebsocketHandler.prefix_subscribers, topic[:-1]
+        return WebsocketHandler.subscribers, topic
+
+    def subscribe(self, topic: str) -> None:
+        index, key = self._topic_index(topic)
+        index.setdefault(key, set()).add(self)
+        self.topics.add(topic)
+
+    def unsubscribe(self, topic: str) -> None:
+        index, key = self._topic_index(topic)
+        subscribers = index.get(key)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del index[key]
+        self.topics.discard(topic)
+
+    @classmethod
+    def get_subscribers(cls, topic: str) -> Set["WebsocketHandler"]:
+        """
+        :return: the connections subscribed to the topic, either directly or by one of its prefixes
+        """
+
+        subscribers = set(cls.subscribers.get(topic, ()))
+        subscribers.update(cls.prefix_subscribers.get("", ()))
+        # "a.b.c" is matched by "a.*" and "a.b.*"
+        position = topic.find(".")
+        while position != -1:
+            subscribers.update(cls.prefix_subscribers.get(topic[:position + 1], ()))
+            position = topic.find(".", position + 1)
+        return subscribers
+
+    @classmethod
+    def publish(cls, topic: str, data: Any, origin: str) -> int:
+        """
+        deliver an event to all subscribers of a topic. This function can be used from outside this handler as well.
+        The event is serialized only once per codec for all subscribers.
+
+        :param topic: the topic of the event (no wildcards)
+        :param data: the payload of the event, anything JSON serializable
+        :param origin: name of the module (or "platform") that published the event
+
+        :return: the number of connections the event was delivered to
+        """
+
+        return len(cls._fan_out(list(cls.get_subscribers(topic)), {"type": "event", "topic": topic, "data": data, "origin": origin}))
+
+    @staticmethod
+    def _is_valid_topic(topic: Any, allow_wildcard: bool) -> bool:
+        if not isinstance(topic, str) or not topic:
+            return False
+        if "*" not in topic:
+            return True
+        return allow_wildcard and (topic == "*" or (topic.endswith(".*") and "*" not in topic[:-1]))
+
+    async def on_message(self, message: Union[bytes, str]):
         """
         handles incoming messages. All messages contain a "type" attribute on which they are distinguished
 
-        :param message: the message originating from a module
+        :param message: the message originating from a module (bytes for binary codecs)
 
         """
         # if we are in test mode, messages are not signed
         if options.test:
-            json_message = tornado.escape.json_decode(message)
+            json_message = self.codec.decode(message)
+        elif self.session is not None and not self.session.authenticated:
+            await self._authenticate_session(message)
+            return
         else:
-            # no test mode, check signature
-            json_message = self._verify_msg(message)
+            # no test mode, check signature (or the MAC of the session)
+            json_message = self._verify_session_msg(message) if self.session is not None else (await self._verify_msg(message))
             if json_message is None:
-                logger.info("Signature Verification Error on message from: {}".format(
-                    message["origin"] if "origin" in message else "no_origin_supplied"))
+                logger.info("Signature Verification Error on message from: {}".format(self.module_name))
                 self.write_message({"type": "signature_verification_error"})
                 return
 
-        logger.info("Platform received message: {}".format(
-            tornado.escape.json_encode(json_message)))
+        # formatted by the logger, instead of serializing the message once more
+        logger.info("Platform received message: %s", json_message)
+        await self._dispatch(json_message)
+
+    async def _dispatch(self, json_message: dict) -> None:
+        """
+        hand a (verified) message to the handler of its type
+        """
 
         # general error handling: enforce correct message format, i.e. require "resolve_id" and "type" in every message
         if "resolve_id" not in json_message:
@@ -126,116 +649,86 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
             return
 
         # handle message content
-        if json_message["type"] == "module_start":
-            self._module_start(json_message)
-            return
-
-        elif json_message["type"] == "user_logout":
-            self._user_logout(json_message)
-            return
-
-        elif json_message['type'] == "get_user":
-            self._get_user(json_message)
-            return
-
-        elif json_message['type'] == "get_user_list":
-            self._get_user_list(json_message)
-            return
-
-        elif json_message["type"] == "check_permission":
-            self._check_permission(json_message)
-            return
-
-        elif json_message["type"] == "get_running_modules":
-            self._get_running_modules(json_message)
-            return
-
-        elif json_message["type"] == "message_module":
-            self._message_module(json_message)
-            return
-
-        elif json_message["type"] == "message_module_response":
-            self._message_module_response(json_message)
-            return
-
-        elif json_message["type"] == "get_template":
-            self._get_template(json_message)
-            return
-
-        elif json_message["type"] == "post_template":
-            self._post_template(json_message)
-            return
-
-        # default case
-        else:
+        message_type = self.message_types.get(json_message["type"]) if isinstance(json_message["type"], str) else None
+        if message_type is None:
             self.write_message({"type": "protocol_error",
                                 "success": False,
-                                "reason": "invalid request type"})
+                                "reason": "invalid request type",
+                                "resolve_id": json_message["resolve_id"]})
             return
 
-    def _module_start(self, json_message: dict) -> None:
         # ensure necessary keys are in the message
-        if "module_name" not in json_message:
-            self.write_message({"type": "module_start_response",
-                                "success": False,
-                                "reason": "message_format_error",
-                                "description": "Message misses key 'module_name'",
-                                "resolve_id": json_message["resolve_id"]})
-            return
-        if "port" not in json_message:
-            self.write_message({"type": "module_start_response",
-                                "success": False,
-                                "reason": "message_format_error",
-                                "description": "Message misses key 'port'",
-                                "resolve_id": json_message["resolve_id"]})
-            return
+        for key in message_type.required_keys:
+            if key not in json_message:
+                self.write_message({"type": message_type.response_type,
+                                    "success": False,
+                                    "reason": "message_format_error",
+                                    "description": "Message misses key '{}'".format(key),
+                                    "resolve_id": json_message["resolve_id"]})
+                return
 
+        result = message_type.handler(self, json_message)
+        if inspect.isawaitable(result):
+            await result
+
+    def _module_start(self, json_message: dict) -> None:
         module_name = json_message["module_name"]
 
-        if module_name in global_vars.servers:
-            # module is already running
+        if self.started_as is not None or (module_name in global_vars.servers and module_name not in self.started_modules):
+            # this connection already started a module (or the name is taken by the platform itself)
             self.write_message({"type": "module_start_response",
                                 "success": False,
                                 "reason": "already_running",
                                 "resolve_id": json_message["resolve_id"]})
         else:
-            # recognize appropriate startup
-            global_vars.servers[module_name] = {"port": json_message["port"]}
+            # recognize appropriate startup, a module that is already running gets another replica
+            self.started_as = module_name
+            self.port = json_message["port"]
+            self.started_modules.setdefault(module_name, []).append(self)
+            self._update_server_entry(module_name)
             self.write_message({"type": "module_start_response",
                                 "success": True,
                                 "status": "recognized",
                                 "resolve_id": json_message["resolve_id"]})
 
     def _user_logout(self, json_message: dict) -> None:
-        # broadcast logout to all other modules
-        self.broadcast_message(json_message)
+        # the user's sessions are no longer valid, drop them from the token cache (all of them if we don't know the user)
+        invalidate_cached_sessions(username=json_message.get("username"), user_id=json_message.get("user_id"))
+        invalidate_cached_permissions(username=json_message.get("username"), user_id=json_message.get("user_id"))
+
+        # tell the other modules about the logout, without waiting for slow ones ("block" policy)
+        if global_vars.broadcast_user_logout:
+            self.broadcast_message(json_message)
+        else:
+            # only the modules that are interested in it
+            self.publish("platform.user_logout", json_message, self.module_name)
         self.write_message({"type": "user_logout_response",
                             "success": True,
                             "resolve_id": json_message["resolve_id"]})
 
-    def _get_user(self, json_message: dict) -> None:
-        # check if username is present in the request
-        if "username" not in json_message:
-            self.write_message({"type": "get_user_response",
+    def _check_username(self, json_message: dict, response_type: str) -> bool:
+        """
+        check that the "username" of the message is a string, answer with a message_format_error if not
+        """
+
+        if not isinstance(json_message["username"], str):
+            self.write_message({"type": response_type,
                                 "success": False,
                                 "reason": "message_format_error",
-                                "description": "Message misses key 'username'",
+                                "description": "'username' has to be a string",
                                 "resolve_id": json_message["resolve_id"]})
-            return
+            return False
+        return True
 
+    async def _get_user(self, json_message: dict) -> None:
+        if not self._check_username(json_message, "get_user_response"):
+            return
         username = json_message['username']
 
         # wrap keycloak requests in try/except to catch error that are not our fault here
         try:
-            # refresh the token to keycloak admin portal, because it might have timed out (resulting in the following requests not succeeding)
-            global_vars.keycloak_admin.refresh_token()
-
-            # request user data from keycloak
-            user_id = global_vars.keycloak_admin.get_user_id(username)
-            info = global_vars.keycloak_admin.get_user(user_id)
-            # keycloak returns a list of groups here, simply use first element since we rely on disjunct roles
-            group_of_user = global_vars.keycloak_admin.get_user_groups(user_id)[
-                0]
+            # answered from the user directory, only users unknown to it are requested from keycloak
+            user_payload = await lookup_user(username)
         except KeycloakError as e:
             logger.info(
                 "Keycloak Error occured while trying to request user data: {}".format(e))
@@ -246,30 +739,50 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
                                 "resolve_id": json_message["resolve_id"]})
             return
 
-        user_payload = {"id": info["id"], "email": info["email"],
-                        "username": username, "role": group_of_user["name"]}
+        if user_payload is None:
+            self.write_message({"type": "get_user_response",
+                                "success": False,
+                                "reason": "user_not_found",
+                                "description": "User '{}' does not exist".format(username),
+                                "resolve_id": json_message["resolve_id"]})
+            return
+
         self.write_message({"type": "get_user_response",
                             "success": True,
                             "user": user_payload,
                             "resolve_id": json_message['resolve_id']})
 
-    def _get_user_list(self, json_message: dict) -> None:
+    async def _get_user_list(self, json_message: dict) -> None:
+        # optional paging: "limit" users per page, "cursor" is the "next_cursor" of the previous page
+        limit = json_message.get("limit")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+            self.write_message({"type": "get_user_list_response",
+                                "success": False,
+                                "reason": "message_format_error",
+                                "description": "'limit' has to be a positive integer",
+                                "resolve_id": json_message["resolve_id"]})
+            return
+        cursor = json_message.get("cursor")
+        if cursor is not None and not isinstance(cursor, str):
+            self.write_message({"type": "get_user_list_response",
+                                "success": False,
+                                "reason": "message_format_error",
+                                "description": "'cursor' has to be a string",
+                                "resolve_id": json_message["resolve_id"]})
+            return
+
         # wrap keycloak requests in try/except to catch error that are not our fault here
         try:
-            # refresh the token to keycloak admin portal, because it might have timed out (resulting in the following requests not succeeding)
-            global_vars.keycloak_admin.refresh_token()
-
-            # keycloak api is somewhat fiddly here, have to request groups first and afterwards members of each group separately
-            user_dict = {}
-            keycloak_groups_list = global_vars.keycloak_admin.get_groups()
-            for group in keycloak_groups_list:
-                keycloak_members_list = global_vars.keycloak_admin.get_group_members(
-                    group["id"])
-                for member in keycloak_members_list:
-                    user_dict[member["username"]] = {"id": member["id"],
-                                                     "username": member["username"],
-                                                     "email": member["email"],
-                                                     "role": group["name"]}
+            # only goes to keycloak if the directory was never synced successfully
+            await global_vars.user_directory.ensure_synced()
+            user_dict, next_cursor = global_vars.user_directory.list_users(cursor, limit)
+        except ValueError:
+            self.write_message({"type": "get_user_list_response",
+                                "success": False,
+                                "reason": "message_format_error",
+                                "description": "Malformed 'cursor'",
+                                "resolve_id": json_message["resolve_id"]})
+            return
         except KeycloakError as e:
             logger.info(
                 "Keycloak Error occured while trying to request user data: {}".format(e))
@@ -283,49 +796,161 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
         self.write_message({"type": "get_user_list_response",
                             "success": True,
                             "users": user_dict,
+                            "next_cursor": next_cursor,
+                            # the members of these groups may be outdated, since they could not be fetched from keycloak
+                            "failed_groups": global_vars.user_directory.failed_groups,
                             "resolve_id": json_message['resolve_id']})
 
-    def _check_permission(self, json_message: dict) -> None:
-        # check if username is present in the request
-        if "username" not in json_message:
+    async def _check_permission(self, json_message: dict) -> None:
+        if not self._check_username(json_message, "check_permission_response"):
+            return
+        username = json_message['username']
+
+        # wrap keycloak requests in try/except to catch error that are not our fault here
+        try:
+            user_payload = await lookup_user(username)
+        except KeycloakError as e:
+            logger.info(
+                "Keycloak Error occured while trying to request user data: {}".format(e))
+            self.write_message({"type": "check_permission_response",
+                                "success": False,
+                                "reason": "keycloak_error",
+                                "description": "Keycloak error occured, check platform logs",
+                                "resolve_id": json_message["resolve_id"]})
+            return
+
+        if user_payload is None:
             self.write_message({"type": "check_permission_response",
+                                "success": False,
+                                "reason": "user_not_found",
+                                "description": "User '{}' does not exist".format(username),
+                                "resolve_id": json_message["resolve_id"]})
+            return
+
+        self.write_message({"type": "check_permission_response",
+                            "success": True,
+                            "username": username,
+                            "role": user_payload["role"],
+                            "resolve_id": json_message["resolve_id"]})
+
+    async def _resolve_users(self, usernames: List[str]) -> Dict[str, dict]:
+        """
+        resolve several usernames in one pass: users known to the user directory are answered from memory,
+        the remaining ones are requested from keycloak concurrently, at most user_lookup_concurrency requests at once
+
+        :return: {"<username>": {"success": True, "user": <user_payload>} or {"success": False, "reason": <reason>}}
+        """
+
+        await global_vars.user_directory.ensure_synced()
+
+        results = {}
+        misses = []
+        for username in usernames:
+            user_payload = global_vars.user_directory.get_user(username)
+            if user_payload is not None:
+                results[username] = {"success": True, "user": user_payload}
+            else:
+                misses.append(username)
+
+        semaphore = asyncio.Semaphore(global_vars.user_lookup_concurrency)
+
+        async def lookup(username: str) -> Optional[dict]:
+            async with semaphore:
+                return await lookup_user(username)
+
+        lookups = await asyncio.gather(*[lookup(username) for username in misses], return_exceptions=True)
+        for username, user_payload in zip(misses, lookups):
+            if isinstance(user_payload, KeycloakError):
+                logger.info("Keycloak Error occured while trying to request user data: {}".format(user_payload))
+                results[username] = {"success": False, "reason": "keycloak_error"}
+            elif isinstance(user_payload, BaseException):
+                raise user_payload
+            elif user_payload is None:
+                results[username] = {"success": False, "reason": "user_not_found"}
+            else:
+                results[username] = {"success": True, "user": user_payload}
+        return results
+
+    def _check_usernames(self, json_message: dict, response_type: str) -> bool:
+        """
+        check that the message has a list of usernames in its "usernames" key, answer with a message_format_error if not,
+        or with a protocol_error if it has more than max_lookup_usernames usernames
+        """
+
+        usernames = json_message.get("usernames")
+        if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+            self.write_message({"type": response_type,
                                 "success": False,
                                 "reason": "message_format_error",
-                                "description": "Message misses key 'username'",
+                                "description": "Message misses key 'usernames' or it is not a list of usernames",
+                                "resolve_id": json_message["resolve_id"]})
+            return False
+        if len(usernames) > global_vars.max_lookup_usernames:
+            self.write_message({"type": response_type,
+                                "success": False,
+                                "reason": "protocol_error",
+                                "description": "At most {} usernames can be requested at once".format(global_vars.max_lookup_usernames),
                                 "resolve_id": json_message["resolve_id"]})
+            return False
+        return True
+
+    async def _get_users(self, json_message: dict) -> None:
+        if not self._check_usernames(json_message, "get_users_response"):
             return
 
-        username = json_message['username']
+        # wrap keycloak requests in try/except to catch error that are not our fault here
+        try:
+            users = await self._resolve_users(json_message["usernames"])
+        except KeycloakError as e:
+            logger.info(
+                "Keycloak Error occured while trying to request user data: {}".format(e))
+            self.write_message({"type": "get_users_response",
+                                "success": False,
+                                "reason": "keycloak_error",
+                                "description": "Keycloak error occured, check platform logs",
+                                "resolve_id": json_message["resolve_id"]})
+            return
+
+        self.write_message({"type": "get_users_response",
+                            "success": True,
+                            "users": users,
+                            "resolve_id": json_message["resolve_id"]})
+
+    async def _check_permissions(self, json_message: dict) -> None:
+        if not self._check_usernames(json_message, "check_permissions_response"):
+            return
 
         # wrap keycloak requests in try/except to catch error that are not our fault here
         try:
-            # refresh the token to keycloak admin portal, because it might have timed out (resulting in the following requests not succeeding)
-            global_vars.keycloak_admin.refresh_token()
-            user_id = global_vars.keycloak_admin.get_user_id(username)
-            # keycloak returns a list of groups here, simply use first element since we rely on disjunct roles
-            group_of_user = global_vars.keycloak_admin.get_user_groups(user_id)[
-                0]["name"]
+            users = await self._resolve_users(json_message["usernames"])
         except KeycloakError as e:
             logger.info(
                 "Keycloak Error occured while trying to request user data: {}".format(e))
-            self.write_message({"type": "check_permission_response",
+            self.write_message({"type": "check_permissions_response",
                                 "success": False,
                                 "reason": "keycloak_error",
                                 "description": "Keycloak error occured, check platform logs",
                                 "resolve_id": json_message["resolve_id"]})
             return
 
-        self.write_message({"type": "check_permission_response",
+        permissions = {}
+        for username, result in users.items():
+            if result["success"]:
+                permissions[username] = {"success": True, "role": result["user"]["role"]}
+            else:
+                permissions[username] = result
+        self.write_message({"type": "check_permissions_response",
                             "success": True,
-                            "username": username,
-                            "role": group_of_user,
+                            "permissions": permissions,
                             "resolve_id": json_message["resolve_id"]})
 
     def _get_running_modules(self, json_message: dict) -> None:
         data = {}
         for module_name in global_vars.servers.keys():
             data[module_name] = {
-                "port": global_vars.servers[module_name]["port"]}
+                "port": global_vars.servers[module_name]["port"],
+                "replicas": global_vars.servers[module_name].get("replicas", 1),
+                "in_flight": self.in_flight(module_name)}
 
         self.write_message({"type": "get_running_modules_response",
                             "success": True,
@@ -333,57 +958,115 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
                             "resolve_id": json_message["resolve_id"]})
 
     def _message_module(self, json_message: dict) -> None:
-        # check if adressee is present in the request
-        if "to" not in json_message:
+        # check if the module is online and forward the message to one of its replicas if yes
+        client = self.pick_replica(json_message["to"])
+        if client is not None:
+            json_message["origin"] = self.module_name
+            # remember where the message came from, so that the response goes back to exactly this connection,
+            # and answer it ourselves if the module doesn't in time
+            timeout = json_message.get("timeout")
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                timeout = global_vars.message_module_timeout
+            key = (self.module_name, json_message["resolve_id"])
+            client._fail_pending(key, "timeout")  # a message with the same resolve_id that is still pending is superseded
+            client.outstanding[key] = PendingRequest(self, tornado.ioloop.IOLoop.current().call_later(timeout, client._fail_pending, key, "timeout"))
+            client.write_message(json_message)
+
+        # not found, reply module offline
+        else:
             self.write_message({"type": "message_module_response",
+                                "success": False,
+                                "reason": "module_offline",
+                                "resolve_id": json_message["resolve_id"]})
+
+    def _message_module_response(self, json_message: dict) -> None:
+        # since this is a reply from a message that another module sent to it, we do not need to online check here
+        # either module is still online and awaits the message, or it went offline in the middle of it, making a reply obsolete anyway
+        pending = self.outstanding.pop((json_message["to"], json_message["resolve_id"]), None)
+        if pending is None:
+            # the origin already got a timeout response (or the message never went through the platform)
+            logger.info("Dropped message_module_response of {} to {}, no message is pending for it".format(self.module_name, json_message["to"]))
+            return
+
+        tornado.ioloop.IOLoop.current().remove_timeout(pending.timeout)
+        if pending.origin in self.connections:
+            pending.origin.write_message(json_message)
+
+    def _subscribe(self, json_message: dict) -> None:
+        if not self._is_valid_topic(json_message["topic"], allow_wildcard=True):
+            self.write_message({"type": "subscribe_response",
                                 "success": False,
                                 "reason": "message_format_error",
-                                "description": "Message misses key 'to'",
+                                "description": "'topic' has to be a non-empty string, wildcards are only allowed as last segment ('a.b.*')",
                                 "resolve_id": json_message["resolve_id"]})
             return
 
-        # check if the module is online (name check) and forward them the message if yes
-        online = False
-        for client in self.connections:
-            if client.module_name == json_message["to"]:
-                json_message["origin"] = self.module_name
-                client.write_message(json_message)
-                online = True
-                break
+        self.subscribe(json_message["topic"])
+        self.write_message({"type": "subscribe_response",
+                            "success": True,
+                            "topic": json_message["topic"],
+                            "resolve_id": json_message["resolve_id"]})
 
-        # not found, reply module offline
-        if not online:
-            self.write_message({"type": "message_module_response",
+    def _unsubscribe(self, json_message: dict) -> None:
+        if json_message["topic"] not in self.topics:
+            self.write_message({"type": "unsubscribe_response",
                                 "success": False,
-                                "reason": "module_offline",
+                                "reason": "not_subscribed",
                                 "resolve_id": json_message["resolve_id"]})
+            return
 
-    def _message_module_response(self, json_message: dict) -> None:
-        # check if adressee is present in the request
-        if "to" not in json_message:
-            self.write_message({"type": "message_module_response",
+        self.unsubscribe(json_message["topic"])
+        self.write_message({"type": "unsubscribe_response",
+                            "success": True,
+                            "topic": json_message["topic"],
+                            "resolve_id": json_message["resolve_id"]})
+
+    def _publish(self, json_message: dict) -> None:
+        if not self._is_valid_topic(json_message["topic"], allow_wildcard=False):
+            self.write_message({"type": "publish_response",
                                 "success": False,
                                 "reason": "message_format_error",
-                                "description": "Message misses key 'to'",
+                                "description": "'topic' has to be a non-empty string without wildcards",
                                 "resolve_id": json_message["resolve_id"]})
             return
 
-        # since this is a reply from a message that another module sent to it, we do not need to online check here
-        # either module is still online and awaits the message, or it went offline in the middle of it, making a reply obsolete anyway
-        for client in self.connections:
-            if client.module_name == json_message["to"]:
-                client.write_message(json_message)
+        delivered = self.publish(json_message["topic"], json_message.get("data"), self.module_name)
+        self.write_message({"type": "publish_response",
+                            "success": True,
+                            "delivered": delivered,
+                            "resolve_id": json_message["resolve_id"]})
 
-    def _get_template(self, json_message: dict) -> None:
-        # check if template name is present in the request
-        if "template_name" not in json_message:
-            self.write_message({"type": "get_template_response",
+    async def _batch(self, json_message: dict) -> None:
+        """
+        several messages in one frame (and under one signature). They are handled one after another and their responses
+        are sent back together in one batch_response. Responses that only arrive later (e.g. of message_module) and
+        messages of other modules to this connection are sent on their own.
+        """
+
+        messages = json_message["messages"]
+        if (not isinstance(messages, list) or not 0 < len(messages) <= global_vars.max_batch_size
+                or not all(isinstance(message, dict) and message.get("type") != "batch" for message in messages)):
+            self.write_message({"type": "batch_response",
                                 "success": False,
                                 "reason": "message_format_error",
-                                "description": "Message misses key 'template_name'",
+                                "description": "'messages' has to be a list of 1 to {} messages, batches can't be nested".format(global_vars.max_batch_size),
                                 "resolve_id": json_message["resolve_id"]})
             return
 
+        collector = BatchCollector(self)
+        token = _batch_collector.set(collector)
+        try:
+            for message in messages:
+                await self._dispatch(message)
+        finally:
+            collector.done = True
+            _batch_collector.reset(token)
+        self.write_message({"type": "batch_response",
+                            "success": True,
+                            "responses": collector.responses,
+                            "resolve_id": json_message["resolve_id"]})
+
+    def _get_template(self, json_message: dict) -> None:
         template_name = json_message["template_name"]
 
         # template directory is not a directory, therefore we cannot have any templates
@@ -412,23 +1095,6 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
                                 "resolve_id": json_message["resolve_id"]})
 
     def _post_template(self, json_message: dict) -> None:
-        # check if template name is present in the request
-        if "template_name" not in json_message:
-            self.write_message({"type": "post_template_response",
-                                "success": False,
-                                "reason": "message_format_error",
-                                "description": "Message misses key 'template_name'",
-                                "resolve_id": json_message["resolve_id"]})
-            return
-
-        if "template" not in json_message:
-            self.write_message({"type": "post_template_response",
-                                "success": False,
-                                "reason": "message_format_error",
-                                "description": "Message misses key 'template'",
-                                "resolve_id": json_message["resolve_id"]})
-            return
-
         template_name = json_message["template_name"]
 
         # if the templates directory doesnt exist, simply create it, allowing for following requests to succeed
@@ -442,3 +1108,23 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, metaclass=ABCMeta):
             self.write_message({"type": "post_template_response",
                                 "success": True,
                                 "resolve_id": json_message["resolve_id"]})
+
+
+WebsocketHandler.register_message_type("module_start", WebsocketHandler._module_start, required_keys=["module_name", "port"])
+WebsocketHandler.register_message_type("user_logout", WebsocketHandler._user_logout)
+WebsocketHandler.register_message_type("get_user", WebsocketHandler._get_user, required_keys=["username"])
+WebsocketHandler.register_message_type("get_user_list", WebsocketHandler._get_user_list)
+WebsocketHandler.register_message_type("check_permission", WebsocketHandler._check_permission, required_keys=["username"])
+WebsocketHandler.register_message_type("get_users", WebsocketHandler._get_users)
+WebsocketHandler.register_message_type("check_permissions", WebsocketHandler._check_permissions)
+WebsocketHandler.register_message_type("get_running_modules", WebsocketHandler._get_running_modules)
+WebsocketHandler.register_message_type("message_module", WebsocketHandler._message_module, required_keys=["to"])
+# a response to a forwarded message is answered with a message_module_response as well
+WebsocketHandler.register_message_type("message_module_response", WebsocketHandler._message_module_response, required_keys=["to"],
+                                       response_type="message_module_response")
+WebsocketHandler.register_message_type("get_template", WebsocketHandler._get_template, required_keys=["template_name"])
+WebsocketHandler.register_message_type("post_template", WebsocketHandler._post_template, required_keys=["template_name", "template"])
+WebsocketHandler.register_message_type("subscribe", WebsocketHandler._subscribe, required_keys=["topic"])
+WebsocketHandler.register_message_type("unsubscribe", WebsocketHandler._unsubscribe, required_keys=["topic"])
+WebsocketHandler.register_message_type("publish", WebsocketHandler._publish, required_keys=["topic"])
+WebsocketHandler.register_message_type("batch", WebsocketHandler._batch, required_keys=["messages"])
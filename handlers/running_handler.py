@@ -2,6 +2,7 @@ from abc import ABCMeta
 
 import global_vars
 from handlers.base_handler import BaseHandler
+from handlers.module_communication_handlers import WebsocketHandler
 from logger_factory import log_access
 
 
@@ -17,7 +18,7 @@ class RunningHandler(BaseHandler, metaclass=ABCMeta):
         GET request of /execution/running
 
         success:
-            200, {"running_modules": {"<module_name>": {"port":"<int>"}}, {...} }
+            200, {"running_modules": {"<module_name>": {"port":"<int>", "replicas": "<int>", "in_flight": "<int>"}}, {...} }
         error:
             401 -> no token
 
@@ -26,7 +27,9 @@ class RunningHandler(BaseHandler, metaclass=ABCMeta):
         if self.current_user:
             data = {}
             for module_name in global_vars.servers.keys():
-                data[module_name] = {"port": global_vars.servers[module_name]["port"]}
+                data[module_name] = {"port": global_vars.servers[module_name]["port"],
+                                     "replicas": global_vars.servers[module_name].get("replicas", 1),
+                                     "in_flight": WebsocketHandler.in_flight(module_name)}
             self.set_status(200)
             self.write({"running_modules": data})
         else:
@@ -1,7 +1,10 @@
 from abc import ABCMeta
+import json
+
+from keycloak.exceptions import KeycloakConnectionError
 
 import global_vars
-from handlers.base_handler import BaseHandler
+from handlers.base_handler import BaseHandler, reject_keycloak_unavailable
 from logger_factory import log_access
 
 
@@ -102,33 +105,87 @@ class UserHandler(BaseHandler, metaclass=ABCMeta):
 
     """
 
+    # number of lines after which a streamed user list is flushed to the client
+    STREAM_FLUSH_LINES = 500
+
     @log_access
     async def get(self):
         """
         GET request of /users
             request user information of all users (id, name, email, role).
-            only an account with the "admin" role can perform this action
+            only an account with the "admin" role can perform this action.
+            The users are served from the user directory, ?refresh=true syncs it with keycloak first
+            query params (all optional):
+                limit: page size (number of users), without it all users are returned
+                cursor: next_cursor of the previous page
+                format: "json" (default) or "ndjson" to stream one <user_obj> per line (next cursor and failed groups are
+                        sent in the X-Next-Cursor and X-Failed-Groups headers then)
+            The ETag changes whenever the users change, send it as If-None-Match to get a 304 if nothing changed.
 
         success:
-            200, {"status": 200, "success": True, "user_list": [<user_obj>]}
+            200, {"status": 200, "success": True, "user_list": [<user_obj>], "next_cursor": <cursor>|None, "failed_groups": [<group_name>]}
+                failed_groups names the groups whose members could not be fetched from keycloak, their members may be outdated
+            304 -> user list unchanged
         error:
+            400 -> invalid limit or cursor
             401 -> no token
             401 -> user not admin
+            503 -> keycloak unavailable, Retry-After tells when to try again
 
         """
 
         if self.current_user:
             if self.is_current_user_admin():
-                user_list = []
-                keycloak_groups_list = global_vars.keycloak_admin.get_groups()
-                for group in keycloak_groups_list:
-                    keycloak_members_list = global_vars.keycloak_admin.get_group_members(group["id"])
-                    for member in keycloak_members_list:
-                        user_list.append({"id": member["id"], "name": member["username"], "email": member["email"], "role": group["name"]})
+                try:
+                    if self.get_argument("refresh", "false") == "true":
+                        await global_vars.user_directory.sync()
+                    else:
+                        await global_vars.user_directory.ensure_synced()
+                except KeycloakConnectionError as e:
+                    # keycloak is unreachable (or the circuit breaker is open)
+                    reject_keycloak_unavailable(self, e)
+                    return
+
+                self.set_header("Etag", global_vars.user_directory.etag)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+
+                try:
+                    limit = self.get_argument("limit", None)
+                    limit = int(limit) if limit is not None else None
+                    if limit is not None and limit < 1:
+                        raise ValueError("limit has to be positive")
+                    # snapshot of the page in the version of the Etag, the directory may change while the page is streamed
+                    memberships, next_cursor = global_vars.user_directory.list_memberships(self.get_argument("cursor", None), limit)
+                    failed_groups = list(global_vars.user_directory.failed_groups)
+                except ValueError:
+                    self.clear_header("Etag")
+                    self.set_status(400)
+                    self.write({"status": 400,
+                                "success": False,
+                                "reason": "invalid_paging_parameters"})
+                    return
+
+                if self.get_argument("format", "json") == "ndjson":
+                    # stream the list, so that neither the platform nor the client has to hold it as one big document
+                    self.set_status(200)
+                    self.set_header("Content-Type", "application/x-ndjson")
+                    if next_cursor is not None:
+                        self.set_header("X-Next-Cursor", next_cursor)
+                    self.set_header("X-Failed-Groups", ",".join(failed_groups))
+                    for i, membership in enumerate(memberships, start=1):
+                        self.write(json.dumps(membership) + "\n")
+                        if i % self.STREAM_FLUSH_LINES == 0:
+                            await self.flush()
+                    return
+
                 self.set_status(200)
                 self.write({"status": 200,
                             "success": True,
-                            "user_list": user_list})
+                            "user_list": memberships,
+                            "next_cursor": next_cursor,
+                            "failed_groups": failed_groups})
             else:
                 self.set_status(401)
                 self.write({"status": 401,
@@ -4,6 +4,7 @@ import tornado.web
 
 import global_vars
 from handlers.base_handler import BaseHandler
+from handlers.module_communication_handlers import WebsocketHandler
 from logger_factory import log_access
 
 
@@ -44,8 +45,32 @@ class HealthCheckHandler(tornado.web.RequestHandler):
     def get(self):
         """
         GET /health
+            besides the liveness of the platform itself, reports the state of the connection to keycloak
+
+        success:
+            200, {"status": 200, "success": True, "keycloak": {"circuit_breaker": {"state": "closed"|"open"|"half_open", ...},
+                                                              "single_flight": {...}, "admin_token": {...}},
+                                              "user_directory": {"users": int, "groups": int, "staleness": float|None, "syncs": int, ...},
+                                              "admin_events": {"cursor": int, "applied": int}|None,
+                                              "token_cache": {"size": int, "maxsize": int, "hits": int, "misses": int}|None,
+                                              "stale_session_cache": {"size": int, "maxsize": int, "hits": int, "misses": int}|None,
+                                              "permission_cache": {"size": int, "maxsize": int, "hits": int, "misses": int}|None,
+                                              "verify_keys": {"modules": int, "reloads": int, "loaded_at": float|None},
+                                              "verification_pool": {"queue_depth": int, "busy_workers": int, "latency_avg": float|None, ...}|None,
+                                              "modules": {"<module_name>": {"connections": int, "queue_depth": int, "queued_bytes": int, "dropped": int}}}
         """
 
         self.set_status(200)
         self.write({"status": 200,
-                    "success": True})
+                    "success": True,
+                    "keycloak": {"circuit_breaker": global_vars.async_keycloak.circuit_breaker.stats(),
+                                 "single_flight": global_vars.async_keycloak.single_flight.stats(),
+                                 "admin_token": global_vars.async_keycloak.admin_token_manager.stats()},
+                    "user_directory": global_vars.user_directory.stats(),
+                    "admin_events": global_vars.admin_event_poller.stats() if global_vars.admin_event_poller is not None else None,
+                    "token_cache": global_vars.token_cache.stats() if global_vars.token_cache is not None else None,
+                    "stale_session_cache": global_vars.stale_session_cache.stats() if global_vars.stale_session_cache is not None else None,
+                    "permission_cache": global_vars.permission_cache.stats() if global_vars.permission_cache is not None else None,
+                    "verify_keys": global_vars.verify_key_store.stats(),
+                    "verification_pool": global_vars.verification_pool.stats() if global_vars.verification_pool is not None else None,
+                    "modules": WebsocketHandler.queue_stats()})
@@ -4,25 +4,36 @@ import asyncio
 if sys.platform == 'win32':  # windows bug workaround, see https://github.com/tornadoweb/tornado/issues/2608 for details
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
+import importlib
 import json
 from pprint import pprint
 
 from keycloak import KeycloakOpenID, KeycloakAdmin
+from keycloak.exceptions import KeycloakError
 import tornado.ioloop
 import tornado.locks
 import tornado.httpserver
 from tornado.options import define, options
 import tornado.web
 
+from admin_events import AdminEventPoller
+from async_keycloak import AsyncKeycloak
+from circuit_breaker import CircuitBreaker
 import global_vars
 from handlers.authentification_handlers import LoginHandler, LoginCallbackHandler, LogoutHandler
-from handlers.base_handler import BaseHandler
+from handlers.base_handler import BaseHandler, invalidate_cached_sessions
 from handlers.main_handler import MainHandler
-from handlers.module_communication_handlers import WebsocketHandler
+from handlers.module_communication_handlers import WebsocketHandler, invalidate_cached_permissions
 from handlers.running_handler import RunningHandler
 from handlers.user_management_handlers import AccountDeleteHandler, RoleHandler, UserHandler
 from handlers.util_handlers import HealthCheckHandler, RoutingHandler
 from logger_factory import get_logger
+from session_store import SessionStore, SQLiteSessionStore
+from token_validation import TokenValidator
+from ttl_cache import TTLCache
+from user_directory import UserDirectory
+from verification_pool import VerificationPool
+from verify_key_store import VerifyKeyStore
 
 logger = get_logger(__name__)
 
@@ -50,6 +61,17 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 sys.excepthook = handle_exception
 
 
+def on_user_changed(user_id: str) -> None:
+    """
+    a user changed in keycloak (e.g. its role), drop everything that was cached about it
+    """
+
+    invalidate_cached_sessions(user_id=user_id)
+    # also drops the entry of a new user that was cached as unknown before
+    user = global_vars.user_directory.get_user_by_id(user_id)
+    invalidate_cached_permissions(username=user["username"] if user is not None else None, user_id=user_id)
+
+
 def make_app(cookie_secret: str) -> tornado.web.Application:
     """
     Build the tornado Application
@@ -96,10 +118,17 @@ async def main() -> None:
         config = json.load(json_file)
 
     global_vars.port = int(config["port"])
+    keycloak_timeout = config.get("keycloak_timeout", 10)
     global_vars.keycloak = KeycloakOpenID(config["keycloak_base_url"], realm_name=config["keycloak_realm"], client_id=config["keycloak_client_id"],
-                                          client_secret_key=config["keycloak_client_secret"])
+                                          client_secret_key=config["keycloak_client_secret"], timeout=keycloak_timeout)
     global_vars.keycloak_admin = KeycloakAdmin(config["keycloak_base_url"], realm_name=config["keycloak_realm"], username=config["keycloak_admin_username"],
-                                               password=config["keycloak_admin_password"], verify=True, auto_refresh_token=['get', 'put', 'post', 'delete'])
+                                               password=config["keycloak_admin_password"], verify=True, timeout=keycloak_timeout)
+    global_vars.async_keycloak = AsyncKeycloak(global_vars.keycloak, global_vars.keycloak_admin,
+                                               max_workers=config.get("keycloak_max_workers", 8), timeout=keycloak_timeout,
+                                               circuit_breaker=CircuitBreaker(**config.get("keycloak_circuit_breaker", {})))
+    # the admin token is refreshed in the background (instead of python-keycloak's auto_refresh_token on every 401)
+    global_vars.async_keycloak.admin_token_manager.refresh_margin = config.get("keycloak_admin_token_refresh_margin", 30)
+    global_vars.async_keycloak.admin_token_manager.start()
     global_vars.keycloak_callback_url = config["keycloak_callback_url"]
     global_vars.config_path = options.config
     global_vars.domain = config["domain"]
@@ -110,6 +139,87 @@ async def main() -> None:
     if "routing" in config:
         global_vars.routing = config["routing"]
 
+    global_vars.module_load_balancing = config.get("module_load_balancing", "round_robin")
+    global_vars.message_module_timeout = config.get("message_module_timeout", 30)
+    global_vars.outbound_queue_size = config.get("outbound_queue_size", 1000)
+    global_vars.outbound_queue_bytes = config.get("outbound_queue_bytes", 16 * 1024 * 1024)
+    global_vars.slow_consumer_policy = config.get("slow_consumer_policy", "drop_oldest")
+    global_vars.broadcast_user_logout = config.get("broadcast_user_logout", True)
+    global_vars.max_batch_size = config.get("max_batch_size", 100)
+    global_vars.max_lookup_usernames = config.get("max_lookup_usernames", 100)
+    global_vars.user_lookup_concurrency = config.get("user_lookup_concurrency", 4)
+    global_vars.allow_signed_messages = config.get("allow_signed_messages", True)
+    # parsed once instead of on every message, reloaded when the file changes or on SIGHUP
+    global_vars.verify_key_store = VerifyKeyStore(config.get("verify_keys_path", "verify_keys.json"),
+                                                  check_interval=config.get("verify_keys_check_interval", 5))
+    global_vars.verify_key_store.start()
+    # a busy module would otherwise block the IOLoop for all the others with its signature verifications
+    if config.get("verification_workers", 0) > 0:
+        global_vars.verification_pool = VerificationPool(workers=config["verification_workers"], mode=config.get("verification_pool", "thread"),
+                                                         max_batch_size=config.get("verification_batch_size", 64))
+    # large frames (templates, user lists) are compressed, small control messages are not worth it
+    global_vars.websocket_compression = config.get("websocket_compression", None)
+
+    # plugins register their additional message types (WebsocketHandler.register_message_type()) when they are imported
+    for plugin in config.get("plugins", []):
+        importlib.import_module(plugin)
+
+    # validate access tokens locally against the realm's JWKS instead of introspecting every single one at keycloak
+    if config.get("offline_token_validation", False):
+        global_vars.token_validator = TokenValidator(global_vars.async_keycloak, refresh_interval=config.get("jwks_refresh_interval", 3600))
+        await global_vars.token_validator.load_keys()
+        global_vars.token_validator.start_background_refresh()
+
+    global_vars.token_refresh_window = config.get("token_refresh_window", 60)
+
+    # reuse validation results of a session for a short time instead of asking keycloak on every request
+    if config.get("token_cache_size", 1024) > 0:
+        global_vars.token_cache = TTLCache(maxsize=config.get("token_cache_size", 1024), ttl=config.get("token_cache_ttl", 60))
+
+    # while keycloak is unavailable, recently validated sessions are served from their last known-good userinfo
+    global_vars.stale_session_grace_period = config.get("stale_session_grace_period", 300)
+    if global_vars.stale_session_grace_period > 0:
+        global_vars.stale_session_cache = TTLCache(maxsize=config.get("token_cache_size", 1024), ttl=global_vars.stale_session_grace_period)
+
+    # user lookups of the modules (check_permission on almost every request they serve), including users that don't exist
+    if config.get("permission_cache_size", 1024) > 0:
+        global_vars.permission_cache = TTLCache(maxsize=config.get("permission_cache_size", 1024), ttl=config.get("permission_cache_ttl", 60))
+        global_vars.permission_cache_negative_ttl = config.get("permission_cache_negative_ttl", 30)
+
+    # keep the tokens on the server and only hand out session ids to the browser
+    session_store_mode = config.get("session_store", "cookie")
+    if session_store_mode == "memory":
+        global_vars.session_store = SessionStore(maxsize=config.get("session_store_size", 10000),
+                                                 userinfo_ttl=config.get("session_userinfo_ttl", 60))
+    elif session_store_mode == "sqlite":
+        global_vars.session_store = SQLiteSessionStore(config.get("session_store_path", "sessions.db"), maxsize=config.get("session_store_size", 10000),
+                                                       userinfo_ttl=config.get("session_userinfo_ttl", 60))
+    if global_vars.session_store is not None:
+        tornado.ioloop.PeriodicCallback(global_vars.session_store.evict_expired, 60 * 1000).start()
+
+    # answer user lookups from memory instead of walking all groups and their members at keycloak on every request
+    global_vars.user_directory = UserDirectory(global_vars.async_keycloak, sync_interval=config.get("user_directory_sync_interval", 300),
+                                               max_concurrency=config.get("user_directory_sync_concurrency", 4),
+                                               deadline=config.get("user_directory_sync_deadline", 10))
+    # cached validations and permissions of a user whose name, email or role changed must not be reused
+    global_vars.user_directory.add_listener(on_user_changed)
+    # pick up changes between the syncs from keycloak's admin events
+    if config.get("admin_events_poll_interval", 10) > 0:
+        global_vars.admin_event_poller = AdminEventPoller(global_vars.user_directory, global_vars.async_keycloak.get_admin_events,
+                                                          interval=config.get("admin_events_poll_interval", 10),
+                                                          page_size=config.get("admin_events_page_size", 100))
+    try:
+        if global_vars.admin_event_poller is not None:
+            # before the sync, so that no change between the sync and the first poll gets lost
+            await global_vars.admin_event_poller.init_cursor()
+        await global_vars.user_directory.sync()
+    except KeycloakError as e:
+        # the directory syncs itself on its first lookup or at the next interval
+        logger.info("Keycloak Error occured while trying to sync the user directory: {}".format(e))
+    global_vars.user_directory.start()
+    if global_vars.admin_event_poller is not None:
+        global_vars.admin_event_poller.start()
+
     app = make_app(global_vars.cookie_secret)
     server = tornado.httpserver.HTTPServer(app)
     global_vars.servers['platform'] = {"port": global_vars.port}
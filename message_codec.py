@@ -0,0 +1,30 @@
+from typing import Any, Callable, Dict, NamedTuple, Optional, Union
+
+import tornado.escape
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, without it all connections use JSON
+    msgpack = None
+
+
+class Codec(NamedTuple):
+    """
+    how the messages of a websocket connection are (de)serialized
+    """
+
+    name: str
+    binary: bool  # whether the messages are sent as binary frames
+    encode: Callable[[Any], bytes]
+    decode: Callable[[Union[bytes, str]], Any]
+
+
+JSON = Codec("json", False, lambda obj: tornado.escape.utf8(tornado.escape.json_encode(obj)), tornado.escape.json_decode)
+MSGPACK: Optional[Codec] = Codec("msgpack", True, lambda obj: msgpack.packb(obj, use_bin_type=True),
+                                 lambda data: msgpack.unpackb(data, raw=False)) if msgpack is not None else None
+
+# websocket subprotocol -> codec, in order of preference. Connections that don't negotiate one of them use JSON
+SUBPROTOCOLS: Dict[str, Codec] = {}
+if MSGPACK is not None:
+    SUBPROTOCOLS["msgpack"] = MSGPACK
+SUBPROTOCOLS["json"] = JSON
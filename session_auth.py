@@ -0,0 +1,102 @@
+import hashlib
+import hmac
+from typing import Optional
+
+import nacl.bindings
+import nacl.encoding
+import nacl.exceptions
+import nacl.hash
+import nacl.public
+import nacl.signing
+
+# response header of the websocket handshake that carries the platform's ephemeral public key
+SESSION_PUBLIC_KEY_HEADER = "X-Session-Public-Key"
+
+
+def session_transcript(module_name: str, module_public_key: bytes, platform_public_key: bytes) -> bytes:
+    """
+    the bytes a module signs with its signing key to authenticate a session.
+    Both ephemeral keys are part of it, so a signature can't be replayed for another connection.
+    """
+
+    return b"module_session_auth\x00" + module_name.encode("utf8") + b"\x00" + module_public_key + platform_public_key
+
+
+def derive_session_key(private_key: nacl.public.PrivateKey, peer_public_key: bytes, transcript: bytes) -> bytes:
+    """
+    :return: the key both sides derive from the X25519 key exchange, bound to the transcript of the handshake
+    """
+
+    shared_secret = nacl.bindings.crypto_scalarmult(bytes(private_key), peer_public_key)
+    return nacl.hash.blake2b(shared_secret + transcript, digest_size=32, encoder=nacl.encoding.RawEncoder)
+
+
+def session_mac(key: bytes, seq: int, payload: bytes) -> bytes:
+    """
+    :return: the MAC of a message, the sequence number makes every MAC valid only once
+    """
+
+    return hmac.new(key, seq.to_bytes(8, "big") + payload, hashlib.sha256).digest()
+
+
+class ModuleSession:
+    """
+    authentication of a module once per websocket connection, instead of a signature on every message:
+        1. the module sends an ephemeral X25519 public key with the connect request, the platform answers
+           with its own ephemeral public key (SESSION_PUBLIC_KEY_HEADER)
+        2. the module signs the transcript of both keys with its signing key (the one in verify_keys.json)
+        3. both sides derive a session key from the key exchange, every following message
+           carries a sequence number and a MAC with that key
+    """
+
+    def __init__(self, module_public_key: bytes):
+        """
+        :raises ValueError: if the public key of the module is not a valid X25519 public key
+        """
+
+        if len(module_public_key) != nacl.public.PublicKey.SIZE:
+            raise ValueError("Invalid session public key")
+        self.module_public_key = module_public_key
+        self._private_key: Optional[nacl.public.PrivateKey] = nacl.public.PrivateKey.generate()
+        self.public_key = bytes(self._private_key.public_key)
+        self.module_name: Optional[str] = None  # set once authenticated
+        self._key: Optional[bytes] = None
+        self._seq = 0  # sequence number of the last accepted message
+
+    @property
+    def authenticated(self) -> bool:
+        return self._key is not None
+
+    def authenticate(self, module_name: str, signature: bytes, verify_key: nacl.signing.VerifyKey) -> bool:
+        """
+        check the module's signature over the handshake and derive the session key
+
+        :return: True if the signature is valid
+        """
+
+        if self._private_key is None:
+            # only one attempt per connection
+            return False
+        transcript = session_transcript(module_name, self.module_public_key, self.public_key)
+        private_key, self._private_key = self._private_key, None
+        try:
+            verify_key.verify(transcript, signature)
+        except (nacl.exceptions.BadSignatureError, ValueError):
+            return False
+        self._key = derive_session_key(private_key, self.module_public_key, transcript)
+        self.module_name = module_name
+        return True
+
+    def verify(self, seq: int, payload: bytes, mac: bytes) -> bool:
+        """
+        check the MAC of a message, messages have to arrive with strictly consecutive sequence numbers (no replays)
+
+        :return: True if the message is authentic
+        """
+
+        if self._key is None or seq != self._seq + 1:
+            return False
+        if not hmac.compare_digest(session_mac(self._key, seq, payload), mac):
+            return False
+        self._seq = seq
+        return True
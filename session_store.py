@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import secrets
+import sqlite3
+import time
+from typing import Callable, Optional
+
+from logger_factory import get_logger
+
+logger = get_logger(__name__)
+
+
+class SessionStore:
+    """
+    server-side storage of the user's sessions, the browser only gets an opaque session id in its cookie.
+    A session holds the keycloak token dict and the cached userinfo of its last validation.
+    Sessions expire together with their refresh token (after that, keycloak would not refresh them anyway),
+    and the number of sessions is bounded, if it is exceeded the least recently used session is evicted.
+    This store is in-memory only, use SQLiteSessionStore to keep sessions across restarts.
+    """
+
+    def __init__(self, maxsize: int = 10000, default_ttl: float = 1800, userinfo_ttl: float = 60):
+        """
+        :param maxsize: maximum number of sessions
+        :param default_ttl: lifetime of a session in seconds, if its token doesn't tell when the refresh token expires
+        :param userinfo_ttl: seconds the userinfo of a validation is reused before the session is validated again
+        """
+
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.userinfo_ttl = userinfo_ttl
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expires_at(self, token: dict) -> float:
+        if token.get("refresh_expires_at"):
+            return token["refresh_expires_at"]
+        return time.time() + self.default_ttl
+
+    def create(self, token: dict) -> str:
+        """
+        start a new session
+
+        :param token: the (stamped) token dict of keycloak
+
+        :return: the id of the new session
+        """
+
+        session_id = secrets.token_urlsafe(32)
+        self._sessions[session_id] = {"token": token,
+                                      "expires_at": self._expires_at(token),
+                                      "userinfo": None,
+                                      "validated_at": 0,
+                                      "validated_until": 0}
+        self._persist(session_id)
+        self._enforce_maxsize()
+        return session_id
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """
+        :return: the session, or None if it doesn't exist (anymore)
+        """
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if session["expires_at"] <= time.time():
+            self.delete(session_id)
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def update_token(self, session_id: str, token: dict) -> None:
+        """
+        replace the token of a session (e.g. after it was refreshed), which also extends the session's lifetime
+        """
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        session["token"] = token
+        session["expires_at"] = self._expires_at(token)
+        self._persist(session_id)
+
+    def set_userinfo(self, session_id: str, userinfo: dict, valid_until: float) -> None:
+        """
+        cache the result of a successful validation of the session until valid_until (unix timestamp)
+        """
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        session["userinfo"] = userinfo
+        session["validated_at"] = time.time()
+        session["validated_until"] = valid_until
+
+    def invalidate_userinfo(self, predicate: Optional[Callable[[dict], bool]] = None) -> None:
+        """
+        drop the cached userinfo of all sessions whose userinfo matches predicate (or of all sessions, if no predicate is given),
+        forcing them to be validated again on their next request
+        """
+
+        for session in self._sessions.values():
+            if session["userinfo"] is not None and (predicate is None or predicate(session["userinfo"])):
+                session["userinfo"] = None
+                session["validated_at"] = 0
+                session["validated_until"] = 0
+
+    def delete(self, session_id: str) -> None:
+        if self._sessions.pop(session_id, None) is not None:
+            self._unpersist(session_id)
+
+    def evict_expired(self) -> int:
+        """
+        remove all expired sessions, should be called regularly so that abandoned sessions don't pile up
+
+        :return: the number of removed sessions
+        """
+
+        now = time.time()
+        expired = [session_id for session_id, session in self._sessions.items() if session["expires_at"] <= now]
+        for session_id in expired:
+            self.delete(session_id)
+        return len(expired)
+
+    def _enforce_maxsize(self) -> None:
+        while len(self._sessions) > self.maxsize:
+            session_id, _ = self._sessions.popitem(last=False)
+            self._unpersist(session_id)
+
+    def _persist(self, session_id: str) -> None:
+        # in-memory only
+        pass
+
+    def _unpersist(self, session_id: str) -> None:
+        # in-memory only
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SessionStore that additionally writes the sessions through to a SQLite database, so that users stay logged in
+    when the platform restarts. Reads are still answered from memory, the cached userinfo is not persisted.
+    The writes happen in order on a single background thread, so that a slow disk doesn't block the IOLoop.
+    """
+
+    def __init__(self, path: str, maxsize: int = 10000, default_ttl: float = 1800, userinfo_ttl: float = 60):
+        """
+        :param path: path to the SQLite database file, will be created if it doesn't exist
+        """
+
+        super().__init__(maxsize=maxsize, default_ttl=default_ttl, userinfo_ttl=userinfo_ttl)
+        # only used by the writer thread once the sessions are loaded
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+        self._db.commit()
+        self._load()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session_store")
+
+    def _load(self) -> None:
+        rows = self._db.execute("SELECT id, token, expires_at FROM sessions ORDER BY expires_at DESC LIMIT ?", (self.maxsize,)).fetchall()
+        # oldest first, so that the order of the LRU eviction roughly matches the order of the sessions' activity
+        for session_id, token, expires_at in reversed(rows):
+            self._sessions[session_id] = {"token": json.loads(token),
+                                          "expires_at": expires_at,
+                                          "userinfo": None,
+                                          "validated_at": 0,
+                                          "validated_until": 0}
+        logger.info("Loaded {} sessions from the session store".format(len(rows)))
+
+    def _write(self, statement: str, parameters: tuple) -> None:
+        try:
+            self._db.execute(statement, parameters)
+            self._db.commit()
+        except sqlite3.Error as e:
+            # the session stays valid in memory, it is only lost on a restart
+            logger.info("Could not write to the session store: {}".format(e))
+
+    def _persist(self, session_id: str) -> None:
+        session = self._sessions[session_id]
+        # serialized right away, the session may change before the writer gets to it
+        self._writer.submit(self._write, "INSERT OR REPLACE INTO sessions (id, token, expires_at) VALUES (?, ?, ?)",
+                            (session_id, json.dumps(session["token"]), session["expires_at"]))
+
+    def _unpersist(self, session_id: str) -> None:
+        self._writer.submit(self._write, "DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def close(self) -> None:
+        """
+        wait for the pending writes and close the database
+        """
+
+        self._writer.submit(self._db.close)
+        self._writer.shutdown(wait=True)
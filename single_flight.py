@@ -0,0 +1,51 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls for the same key into a single in-flight call, all callers receive the same result
+    (or the same exception). Once the call has finished, the next call for that key is executed again.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0  # total number of calls
+        self.executed = 0  # calls that actually ran
+        self.coalesced = 0  # calls that joined a call which was already in flight
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        run func, unless a call with the same key is already in flight, in which case its result is awaited instead
+
+        :param key: identifies calls that can share a result
+        :param func: coroutine function without arguments that performs the call
+
+        :return: the result of the (shared) call
+        """
+
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        # shield: a caller that gets cancelled must not cancel the call of the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight),
+                "calls": self.calls,
+                "executed": self.executed,
+                "coalesced": self.coalesced}
@@ -0,0 +1,128 @@
+import time
+from typing import Dict, Optional
+
+from jose import jwt
+from jose.exceptions import JOSEError
+from keycloak.exceptions import KeycloakError
+import tornado.ioloop
+
+from async_keycloak import AsyncKeycloak
+from logger_factory import get_logger
+
+logger = get_logger(__name__)
+
+
+class TokenValidator:
+    """
+    Validates Keycloak access tokens locally against the realm's JWKS (the public keys Keycloak signs its tokens with),
+    which saves the introspection round trip to Keycloak for every request.
+    The keys are cached in memory and refreshed periodically in the background (and immediately, if a token
+    comes in that was signed with a key id that we do not know yet, i.e. Keycloak rotated its keys)
+    """
+
+    def __init__(self, async_keycloak: AsyncKeycloak, refresh_interval: int = 3600, min_refresh_interval: int = 30):
+        """
+        :param async_keycloak: the keycloak facade, used to fetch the JWKS (with its timeout and circuit breaker)
+        :param refresh_interval: seconds between two regular background refreshes of the JWKS
+        :param min_refresh_interval: minimum seconds between two refreshes that were triggered by unknown key ids,
+                                     prevents tokens with forged key ids from hammering Keycloak
+        """
+
+        self._async_keycloak = async_keycloak
+        self._keys: Dict[str, dict] = {}
+        self._fetched_at: float = 0
+        self._refreshing = False
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._periodic_refresh: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    @property
+    def key_ids(self) -> list:
+        return list(self._keys.keys())
+
+    async def load_keys(self) -> None:
+        """
+        fetch the JWKS from Keycloak and replace the cached keys.
+        Only keys that are meant for signatures are kept.
+
+        :raises KeycloakError: if the JWKS could not be fetched
+        """
+
+        jwks = await self._async_keycloak.certs()
+        keys = {key["kid"]: key for key in jwks.get("keys", []) if key.get("use", "sig") == "sig" and "kid" in key}
+        # swap the whole dict at once, so a concurrent validation never sees a half-filled key set
+        self._keys = keys
+        self._fetched_at = time.time()
+        logger.info("Loaded JWKS with key ids: {}".format(list(keys.keys())))
+
+    async def refresh_keys(self) -> None:
+        """
+        fetch the JWKS in the background, errors are only logged so that the old keys stay in use
+        """
+
+        if self._refreshing:
+            return
+        self._refreshing = True
+        try:
+            await self.load_keys()
+        except KeycloakError as e:
+            logger.info("Keycloak Error occured while trying to refresh the JWKS: {}".format(e))
+        finally:
+            self._refreshing = False
+
+    def start_background_refresh(self) -> None:
+        """
+        regularly refresh the JWKS to pick up key rotations
+        """
+
+        if self._periodic_refresh is None:
+            self._periodic_refresh = tornado.ioloop.PeriodicCallback(self.refresh_keys, self.refresh_interval * 1000)
+            self._periodic_refresh.start()
+
+    def stop_background_refresh(self) -> None:
+        if self._periodic_refresh is not None:
+            self._periodic_refresh.stop()
+            self._periodic_refresh = None
+
+    def _trigger_refresh(self) -> None:
+        # rate limit refreshes that are triggered by unknown key ids
+        if time.time() - self._fetched_at >= self.min_refresh_interval:
+            tornado.ioloop.IOLoop.current().spawn_callback(self.refresh_keys)
+
+    def validate(self, access_token: str) -> Optional[dict]:
+        """
+        verify the signature and expiry of an access token locally.
+
+        :param access_token: the encoded access token (JWT)
+
+        :return: the token's claims in the same shape as Keycloak's introspection result, or None if the token could not
+                 be validated locally (invalid, expired or signed with an unknown key id). Callers should fall back to
+                 introspection in that case.
+        """
+
+        try:
+            header = jwt.get_unverified_header(access_token)
+        except JOSEError:
+            return None
+
+        key = self._keys.get(header.get("kid"))
+        if key is None:
+            # most likely Keycloak rotated its keys, fetch the new ones for the next requests
+            self._trigger_refresh()
+            return None
+
+        try:
+            # the audience of keycloak access tokens is not the client, but the token is only valid for our realm anyway
+            claims = jwt.decode(access_token, key, algorithms=[key.get("alg", "RS256")],
+                                options={"verify_aud": False})
+        except JOSEError:
+            return None
+
+        # only accept access tokens (the realm keys also sign e.g. id tokens)
+        if claims.get("typ", "Bearer") != "Bearer":
+            return None
+
+        # mirror the additional keys that keycloak's introspection endpoint sets
+        claims.setdefault("active", True)
+        claims.setdefault("username", claims.get("preferred_username"))
+        return claims
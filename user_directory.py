@@ -0,0 +1,386 @@
+import base64
+import bisect
+import secrets
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from keycloak.exceptions import KeycloakError
+import tornado.ioloop
+
+from logger_factory import get_logger
+from single_flight import SingleFlight
+
+logger = get_logger(__name__)
+
+
+def encode_cursor(username: str) -> str:
+    return base64.urlsafe_b64encode(username.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    :raises ValueError: if the cursor is malformed
+    """
+
+    return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+
+
+class UserDirectory:
+    """
+    in-memory copy of the users, groups and group memberships of the keycloak realm, indexed by username and user id.
+    It is populated at startup and re-synced in the background, so that user lookups of the handlers are answered
+    from memory instead of walking all groups and their members at keycloak on every request.
+    Users that were created since the last sync are looked up at keycloak on demand (see lookup()).
+    The role of a user is the name of its (first) group, since we rely on disjunct roles.
+    Listings are ordered by username and can be paged with a cursor, the etag changes whenever the content changes.
+    Between the syncs, single users and groups are updated from keycloak's admin events (see apply_events()),
+    listeners are told about every user that changed that way.
+    """
+
+    def __init__(self, async_keycloak, sync_interval: float = 300, max_concurrency: int = 4, deadline: float = 10):
+        """
+        :param async_keycloak: the AsyncKeycloak facade used to fetch the data
+        :param sync_interval: seconds between two background syncs
+        :param max_concurrency: maximum number of groups whose members are requested concurrently during a sync
+        :param deadline: seconds until the members of all groups have to be fetched during a sync
+        """
+
+        self._async_keycloak = async_keycloak
+        self.sync_interval = sync_interval
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self._users: Dict[str, dict] = {}  # user id -> {"id", "username", "email"}
+        self._user_ids: Dict[str, str] = {}  # username -> user id
+        self._groups: Dict[str, dict] = {}  # group id -> {"id", "name"}, in the order keycloak returns them
+        self._members: Dict[str, List[str]] = {}  # group id -> [user id]
+        self._groups_of_user: Dict[str, List[str]] = {}  # user id -> [group id]
+        self.failed_groups: List[str] = []  # names of the groups whose members could not be fetched during the last sync
+        self._sorted_usernames: Optional[List[str]] = None  # usernames of all users with a group, built on demand
+        self._instance_id = secrets.token_hex(4)
+        self.version = 0
+        self.last_sync: Optional[float] = None
+        self.syncs = 0
+        self._single_flight = SingleFlight()
+        self._periodic_sync: Optional[tornado.ioloop.PeriodicCallback] = None
+        self._listeners: List[Callable[[str], None]] = []
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    @property
+    def staleness(self) -> Optional[float]:
+        """
+        seconds since the last complete sync, None if the directory was never synced
+        """
+
+        if self.last_sync is None:
+            return None
+        return time.time() - self.last_sync
+
+    async def sync(self) -> None:
+        """
+        (re-)load all groups and their members from keycloak and replace the directory with them.
+        Concurrent syncs are coalesced into one.
+        """
+
+        await self._single_flight.do("sync", self._sync)
+
+    async def _sync(self) -> None:
+        # keycloak api is somewhat fiddly here, have to request groups first and afterwards members of each group separately
+        groups = await self._async_keycloak.get_groups()
+        members_by_group, failed = await self._async_keycloak.get_members_of_groups([group["id"] for group in groups],
+                                                                                    max_concurrency=self.max_concurrency,
+                                                                                    deadline=self.deadline)
+        for group_id in failed:
+            # keep what we knew about the members of this group instead of dropping them
+            members_by_group[group_id] = [self._users[user_id] for user_id in self._members.get(group_id, [])]
+        if failed:
+            logger.info("Could not fetch the members of {} groups while syncing the user directory".format(len(failed)))
+        self._replace(groups, members_by_group)
+        self.failed_groups = [group["name"] for group in groups if group["id"] in failed]
+
+    def _replace(self, groups: List[dict], members_by_group: Dict[str, List[dict]]) -> None:
+        """
+        build the indexes from scratch and swap them in at once, so lookups never see a half-built directory
+        """
+
+        users, user_ids, group_index, members, groups_of_user = {}, {}, {}, {}, {}
+        for group in groups:
+            group_index[group["id"]] = {"id": group["id"], "name": group["name"]}
+            members[group["id"]] = []
+            for member in members_by_group[group["id"]]:
+                users[member["id"]] = {"id": member["id"], "username": member["username"], "email": member.get("email")}
+                user_ids[member["username"].lower()] = member["id"]
+                members[group["id"]].append(member["id"])
+                groups_of_user.setdefault(member["id"], []).append(group["id"])
+
+        if (users, group_index, members) != (self._users, self._groups, self._members):
+            # users that were added, removed, renamed or whose roles changed since the last sync
+            before = {user_id: (user, sorted(self._groups[group_id]["name"] for group_id in self._groups_of_user.get(user_id, [])))
+                      for user_id, user in self._users.items()}
+            after = {user_id: (user, sorted(group_index[group_id]["name"] for group_id in groups_of_user.get(user_id, [])))
+                     for user_id, user in users.items()}
+            changed_ids = [user_id for user_id in before.keys() | after.keys() if before.get(user_id) != after.get(user_id)]
+
+            self._users, self._user_ids, self._groups, self._members, self._groups_of_user = users, user_ids, group_index, members, groups_of_user
+            self._changed()
+            # nothing can have been cached from the directory before its first sync
+            if self.last_sync is not None:
+                self._notify(changed_ids)
+        self.last_sync = time.time()
+        self.syncs += 1
+
+    def _add_user(self, info: dict, groups: List[dict]) -> None:
+        """
+        add (or replace) a single user in the directory
+        """
+
+        user_id = info["id"]
+        self._remove_user(user_id)
+        self._users[user_id] = {"id": user_id, "username": info["username"], "email": info.get("email")}
+        self._user_ids[info["username"].lower()] = user_id
+        self._groups_of_user[user_id] = []
+        for group in groups:
+            self._groups.setdefault(group["id"], {"id": group["id"], "name": group["name"]})
+            members = self._members.setdefault(group["id"], [])
+            if user_id not in members:
+                members.append(user_id)
+            self._groups_of_user[user_id].append(group["id"])
+        self._changed()
+
+    def _remove_user(self, user_id: str) -> bool:
+        """
+        :return: True if the user was in the directory
+        """
+
+        user = self._users.pop(user_id, None)
+        if user is None:
+            return False
+        if self._user_ids.get(user["username"].lower()) == user_id:
+            del self._user_ids[user["username"].lower()]
+        for group_id in self._groups_of_user.pop(user_id, []):
+            if user_id in self._members.get(group_id, []):
+                self._members[group_id].remove(user_id)
+        self._changed()
+        return True
+
+    def _remove_group(self, group_id: str) -> List[str]:
+        """
+        :return: the ids of the users that were member of the group
+        """
+
+        self._groups.pop(group_id, None)
+        member_ids = self._members.pop(group_id, [])
+        for user_id in member_ids:
+            self._groups_of_user[user_id].remove(group_id)
+        self._changed()
+        return member_ids
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._sorted_usernames = None
+
+    @property
+    def etag(self) -> str:
+        """
+        ETag of the current content of the directory
+        """
+
+        return '"{}-{}"'.format(self._instance_id, self.version)
+
+    async def ensure_synced(self) -> None:
+        if self.last_sync is None:
+            await self.sync()
+
+    async def _periodic(self) -> None:
+        try:
+            await self.sync()
+        except KeycloakError as e:
+            # keep serving the old data, the next sync will try again
+            logger.info("Keycloak Error occured while trying to sync the user directory: {}".format(e))
+
+    def start(self) -> None:
+        if self._periodic_sync is None:
+            self._periodic_sync = tornado.ioloop.PeriodicCallback(self._periodic, self.sync_interval * 1000)
+            self._periodic_sync.start()
+
+    def stop(self) -> None:
+        if self._periodic_sync is not None:
+            self._periodic_sync.stop()
+            self._periodic_sync = None
+
+    def _payload(self, user_id: str) -> dict:
+        user = self._users[user_id]
+        group_ids = self._groups_of_user.get(user_id)
+        role = self._groups[group_ids[0]]["name"] if group_ids else None
+        return {"id": user["id"], "email": user["email"], "username": user["username"], "role": role}
+
+    def get_user(self, username: str) -> Optional[dict]:
+        """
+        :return: {"id", "email", "username", "role"} of the user, or None if the user is not in the directory
+        """
+
+        user_id = self._user_ids.get(username.lower())
+        if user_id is None:
+            return None
+        return self._payload(user_id)
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        if user_id not in self._users:
+            return None
+        return self._payload(user_id)
+
+    def page(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        a page of the users that are member of a group, ordered by username
+
+        :param cursor: cursor of the previous page, None to start at the beginning
+        :param limit: maximum number of users on the page, None for all remaining users
+
+        :raises ValueError: if the cursor is malformed
+        :return: ([<user_id>] of the page, cursor of the next page or None if this is the last page)
+        """
+
+        if self._sorted_usernames is None:
+            self._sorted_usernames = sorted(username for username, user_id in self._user_ids.items() if self._groups_of_user.get(user_id))
+
+        start = 0 if cursor is None else bisect.bisect_right(self._sorted_usernames, decode_cursor(cursor))
+        end = len(self._sorted_usernames) if limit is None else min(start + limit, len(self._sorted_usernames))
+        usernames = self._sorted_usernames[start:end]
+        next_cursor = encode_cursor(usernames[-1]) if usernames and end < len(self._sorted_usernames) else None
+        return [self._user_ids[username] for username in usernames], next_cursor
+
+    def iter_users(self, user_ids: List[str]) -> Iterator[dict]:
+        """
+        :return: {"id", "email", "username", "role"} of each of the users
+        """
+
+        for user_id in user_ids:
+            yield self._payload(user_id)
+
+    def iter_memberships(self, user_ids: List[str]) -> Iterator[dict]:
+        """
+        :return: {"id", "name", "email", "role"} of each group membership of the users
+        """
+
+        for user_id in user_ids:
+            user = self._users[user_id]
+            for group_id in self._groups_of_user[user_id]:
+                yield {"id": user["id"], "name": user["username"], "email": user["email"], "role": self._groups[group_id]["name"]}
+
+    def list_users(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, dict], Optional[str]]:
+        """
+        :raises ValueError: if the cursor is malformed
+        :return: ({"<username>": {"id", "email", "username", "role"}} of the page, cursor of the next page or None)
+        """
+
+        user_ids, next_cursor = self.page(cursor, limit)
+        return {user["username"]: user for user in self.iter_users(user_ids)}, next_cursor
+
+    def list_memberships(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        :raises ValueError: if the cursor is malformed
+        :return: ([{"id", "name", "email", "role"}], one entry per group membership of the users of the page, cursor of the next page or None)
+        """
+
+        user_ids, next_cursor = self.page(cursor, limit)
+        return list(self.iter_memberships(user_ids)), next_cursor
+
+    async def lookup(self, username: str) -> Optional[dict]:
+        """
+        get a user from the directory, or from keycloak if it is unknown to the directory (e.g. created since the last sync)
+
+        :return: {"id", "email", "username", "role"} of the user, or None if the user does not exist
+        """
+
+        await self.ensure_synced()
+        user = self.get_user(username)
+        if user is not None:
+            return user
+
+        user_id = await self._async_keycloak.get_user_id(username)
+        if user_id is None:
+            return None
+        info = await self._async_keycloak.get_user(user_id)
+        groups = await self._async_keycloak.get_user_groups(user_id)
+        self._add_user(info, groups)
+        return self.get_user_by_id(user_id)
+
+    def add_listener(self, callback: Callable[[str], None]) -> None:
+        """
+        :param callback: called with the id of each user that changed by an admin event
+        """
+
+        self._listeners.append(callback)
+
+    def _notify(self, user_ids: List[str]) -> None:
+        for user_id in user_ids:
+            for callback in self._listeners:
+                callback(user_id)
+
+    async def refresh_user(self, user_id: str) -> None:
+        """
+        update a single user (its name, email and groups) from keycloak, or remove it if it doesn't exist anymore
+        """
+
+        try:
+            info = await self._async_keycloak.get_user(user_id)
+        except KeycloakError as e:
+            if e.response_code != 404:
+                raise
+            self._remove_user(user_id)
+        else:
+            groups = await self._async_keycloak.get_user_groups(user_id)
+            self._add_user(info, groups)
+        self._notify([user_id])
+
+    async def refresh_group(self, group_id: str) -> None:
+        """
+        update the name of a single group from keycloak, or remove it (and its memberships) if it doesn't exist anymore
+        """
+
+        try:
+            group = await self._async_keycloak.get_group(group_id)
+        except KeycloakError as e:
+            if e.response_code != 404:
+                raise
+            self._notify(self._remove_group(group_id))
+            return
+
+        if group_id in self._groups and self._groups[group_id]["name"] == group["name"]:
+            return
+        self._groups[group_id] = {"id": group_id, "name": group["name"]}
+        self._members.setdefault(group_id, [])
+        self._changed()
+        # the role of all members changed
+        self._notify(list(self._members[group_id]))
+
+    async def apply_events(self, events: List[dict]) -> None:
+        """
+        apply keycloak admin events (AdminEventRepresentation) to the directory.
+        Instead of replaying each event, every user and group an event refers to is updated from keycloak once,
+        which gives the same result no matter how many events there were and in which order they arrived.
+        """
+
+        user_ids, group_ids = [], []
+        for event in events:
+            path = event.get("resourcePath", "").split("/")
+            if event.get("resourceType") in ("USER", "GROUP_MEMBERSHIP") and len(path) >= 2 and path[0] == "users":
+                # users/<user_id> or users/<user_id>/groups/<group_id>
+                if path[1] not in user_ids:
+                    user_ids.append(path[1])
+            elif event.get("resourceType") == "GROUP" and len(path) >= 2 and path[0] == "groups":
+                if path[1] not in group_ids:
+                    group_ids.append(path[1])
+
+        for group_id in group_ids:
+            await self.refresh_group(group_id)
+        for user_id in user_ids:
+            await self.refresh_user(user_id)
+
+    def stats(self) -> dict:
+        return {"users": len(self._users),
+                "groups": len(self._groups),
+                "staleness": self.staleness,
+                "syncs": self.syncs,
+                "failed_groups": self.failed_groups}
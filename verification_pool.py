@@ -0,0 +1,136 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import time
+from typing import List, Optional, Tuple, Union
+
+import nacl.encoding
+import nacl.exceptions
+import nacl.signing
+import tornado.ioloop
+
+
+def verify_signed_message(verify_key: Union[nacl.signing.VerifyKey, bytes], signed_message: Union[bytes, str],
+                          base64_encoded: bool) -> Optional[bytes]:
+    """
+    verify the signature of a message
+
+    :param verify_key: the verify key of the module (raw bytes for the process pool, which can't share the key objects)
+    :param signed_message: the signed message, as received from the module
+    :param base64_encoded: whether the signed message is base64 encoded (JSON connections) or raw bytes
+
+    :return: the original message, or None if the signature doesn't validate
+    """
+
+    if isinstance(verify_key, bytes):
+        verify_key = nacl.signing.VerifyKey(verify_key)
+    try:
+        if base64_encoded:
+            return verify_key.verify(signed_message, encoder=nacl.encoding.Base64Encoder)
+        return verify_key.verify(signed_message)
+    except (nacl.exceptions.BadSignatureError, ValueError, TypeError):
+        return None
+
+
+def verify_signed_messages(items: List[Tuple[Union[nacl.signing.VerifyKey, bytes], Union[bytes, str], bool]]) -> List[Optional[bytes]]:
+    """
+    verify a batch of messages in a worker, see verify_signed_message() for the items
+    """
+
+    return [verify_signed_message(*item) for item in items]
+
+
+class VerificationPool:
+    """
+    Verifies message signatures in worker threads (PyNaCl releases the GIL while verifying) or processes, instead of
+    on the IOLoop, so that a busy module doesn't starve the others.
+    Every idle worker picks up the pending messages right away, messages that arrive while all workers are busy
+    are verified together in one batch by the next free worker.
+    """
+
+    def __init__(self, workers: int = 4, mode: str = "thread", max_batch_size: int = 64, latency_window: int = 1000):
+        """
+        :param workers: number of worker threads or processes
+        :param mode: "thread" or "process"
+        :param max_batch_size: maximum number of messages a worker verifies at once
+        :param latency_window: number of recent verifications the latency stats are computed from
+        """
+
+        if mode == "thread":
+            self._executor: Executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verification")
+        elif mode == "process":
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError("Unknown verification pool mode '{}', use 'thread' or 'process'".format(mode))
+        self.mode = mode
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self._pending: deque = deque()  # (verify key, signed message, base64 encoded, future, enqueued at)
+        self._busy = 0  # workers that are verifying a batch right now
+        self._latencies: deque = deque(maxlen=latency_window)
+        self.verified = 0
+        self.failed = 0
+        self.batches = 0
+
+    def verify(self, verify_key: nacl.signing.VerifyKey, signed_message: Union[bytes, str], base64_encoded: bool) -> "asyncio.Future[Optional[bytes]]":
+        """
+        queue a message for verification
+
+        :return: a future that resolves to the original message, or None if the signature doesn't validate
+        """
+
+        future = asyncio.get_event_loop().create_future()
+        if self.mode == "process":
+            # key objects can't be sent to another process
+            verify_key = bytes(verify_key)
+        self._pending.append((verify_key, signed_message, base64_encoded, future, time.monotonic()))
+        self._schedule()
+        return future
+
+    def _schedule(self) -> None:
+        while self._pending and self._busy < self.workers:
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            self._busy += 1
+            self.batches += 1
+            verification = tornado.ioloop.IOLoop.current().run_in_executor(
+                self._executor, verify_signed_messages, [(verify_key, signed_message, base64_encoded)
+                                                         for verify_key, signed_message, base64_encoded, _, _ in batch])
+            verification.add_done_callback(lambda verification, batch=batch: self._finish(batch, verification))
+
+    def _finish(self, batch: list, verification: "asyncio.Future[List[Optional[bytes]]]") -> None:
+        self._busy -= 1
+        now = time.monotonic()
+        try:
+            results = verification.result()
+        except Exception as e:
+            # e.g. a broken process pool, none of the messages of the batch could be verified
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            self._schedule()
+            return
+
+        for (_, _, _, future, enqueued_at), result in zip(batch, results):
+            self._latencies.append(now - enqueued_at)
+            if result is None:
+                self.failed += 1
+            else:
+                self.verified += 1
+            # the connection may have given up on the message in the meantime
+            if not future.done():
+                future.set_result(result)
+        self._schedule()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {"mode": self.mode,
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "queue_depth": len(self._pending),
+                "verified": self.verified,
+                "failed": self.failed,
+                "batches": self.batches,
+                "latency_avg": sum(self._latencies) / len(self._latencies) if self._latencies else None,
+                "latency_max": max(self._latencies) if self._latencies else None}
@@ -0,0 +1,109 @@
+import json
+import os
+import signal
+import time
+from typing import Dict, Optional, Tuple
+
+import nacl.encoding
+import nacl.exceptions
+import nacl.signing
+import tornado.ioloop
+
+from logger_factory import get_logger
+
+logger = get_logger(__name__)
+
+
+class VerifyKeyStore:
+    """
+    The verify keys of the modules (verify_keys.json), parsed once and kept in memory instead of reading the file
+    for every message. The file is reloaded when it changes (checked every check_interval seconds) or on SIGHUP,
+    so adding the key of a new module still doesn't need a restart.
+    """
+
+    def __init__(self, path: str = "verify_keys.json", check_interval: float = 5):
+        """
+        :param path: path to the verify keys file, {"<module_name>": "<base64 encoded verify key>"}
+        :param check_interval: seconds between two checks of the file's modification time
+        """
+
+        self.path = path
+        self.check_interval = check_interval
+        self._keys: Optional[Dict[str, nacl.signing.VerifyKey]] = None
+        self._file_signature: Optional[Tuple[int, int]] = None  # (mtime_ns, size) of the loaded file
+        self._loaded_at: Optional[float] = None
+        self.reloads = 0
+        self._periodic_check: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    def get(self, module_name: str) -> Optional[nacl.signing.VerifyKey]:
+        """
+        :return: the verify key of the module, or None if the module is unknown
+        """
+
+        if self._keys is None:
+            # first use
+            self.reload()
+        return self._keys.get(module_name)
+
+    def reload(self) -> bool:
+        """
+        read and parse the file and replace the keys. If the file can't be read or contains an invalid key,
+        the keys that were loaded before stay in use.
+
+        :return: True if the keys were replaced
+        """
+
+        try:
+            stat = os.stat(self.path)
+            with open(self.path, "r") as fp:
+                verify_keys = json.load(fp)
+            keys = {module_name: nacl.signing.VerifyKey(verify_key.encode("utf8"), encoder=nacl.encoding.Base64Encoder)
+                    for module_name, verify_key in verify_keys.items()}
+        except (OSError, ValueError, TypeError, AttributeError, nacl.exceptions.CryptoError) as e:
+            logger.info("Could not load the verify keys from {}: {}".format(self.path, e))
+            if self._keys is None:
+                self._keys = {}
+            return False
+
+        # swap the whole dict at once, so a concurrent verification never sees a half-filled key set
+        self._keys = keys
+        self._file_signature = (stat.st_mtime_ns, stat.st_size)
+        self._loaded_at = time.time()
+        self.reloads += 1
+        logger.info("Loaded verify keys of the modules: {}".format(list(keys.keys())))
+        return True
+
+    def check_for_changes(self) -> None:
+        """
+        reload the keys if the file was modified since it was loaded
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_mtime_ns, stat.st_size) != self._file_signature:
+            self.reload()
+
+    def start(self) -> None:
+        """
+        load the keys, watch the file for changes and reload it on SIGHUP (where available)
+        """
+
+        if self._keys is None:
+            self.reload()
+        if self._periodic_check is None:
+            self._periodic_check = tornado.ioloop.PeriodicCallback(self.check_for_changes, self.check_interval * 1000)
+            self._periodic_check.start()
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: tornado.ioloop.IOLoop.current().add_callback_from_signal(self.reload))
+
+    def stop(self) -> None:
+        if self._periodic_check is not None:
+            self._periodic_check.stop()
+            self._periodic_check = None
+
+    def stats(self) -> dict:
+        return {"modules": len(self._keys) if self._keys is not None else 0,
+                "reloads": self.reloads,
+                "loaded_at": self._loaded_at}